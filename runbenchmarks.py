@@ -0,0 +1,109 @@
+# Copyright (C) 2015 - The MITRE Corporation
+# For license information, see the LICENSE.txt file
+
+"""
+Runs the end-to-end benchmarks in tests/benchmarks against a throwaway test
+database and writes the results as JSON.
+
+    python runbenchmarks.py --size 100000 --output results.json
+    python runbenchmarks.py --size 100000 --baseline baseline.json
+
+With --baseline, the run fails if any benchmark's median latency is more
+than --tolerance above the baseline's. --save-baseline stores the results
+of this run as the new baseline. Baselines are only meaningful on the
+machine and database they were recorded on.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+import django
+from django.conf import settings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the django-taxii-services benchmarks.')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='Number of Content Blocks in the polled collection (default: 1000)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of times each request is timed (default: 10)')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Content Blocks per Poll Response part (default: 100)')
+    parser.add_argument('--inbox-batch-size', type=int, default=100,
+                        help='Content Blocks per Inbox Message (default: 100)')
+    parser.add_argument('--benchmark', action='append', dest='benchmarks',
+                        help='Run only this benchmark (may be given more than once)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file as a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline, as a fraction (default: 0.2)')
+    return parser.parse_args()
+
+
+def runbenchmarks():
+    args = parse_args()
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_settings'
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    from tests.benchmarks import fixtures, suite
+
+    benchmarks = args.benchmarks or suite.BENCHMARKS
+    for name in benchmarks:
+        if name not in suite.BENCHMARKS:
+            sys.exit('Unknown benchmark: %s (choose from %s)' % (name, ', '.join(suite.BENCHMARKS)))
+
+    settings.DEBUG = False
+    # Inbox Messages of many Content Blocks exceed Django's default limit
+    settings.DATA_UPLOAD_MAX_MEMORY_SIZE = None
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        fixtures.setup_services(args.page_size)
+        fixtures.build_collection(args.size)
+        results = suite.run_benchmarks(benchmarks, args.repeat, args.inbox_batch_size)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    output = {'meta': {'date': datetime.datetime.utcnow().isoformat(),
+                       'python': platform.python_version(),
+                       'django': django.get_version(),
+                       'database': connection.vendor,
+                       'size': args.size,
+                       'repeat': args.repeat,
+                       'page_size': args.page_size,
+                       'inbox_batch_size': args.inbox_batch_size},
+              'results': results}
+
+    for name, result in results.iteritems():
+        print '%-24s median %10.2f ms  (min %.2f, max %.2f)' % (name, result['median_ms'],
+                                                               result['min_ms'], result['max_ms'])
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta']['size'] != args.size:
+            print 'Warning: the baseline was recorded with --size %s' % baseline['meta']['size']
+        regressions = suite.compare(results, baseline['results'], args.tolerance)
+        for name, baseline_median, median in regressions:
+            print 'REGRESSION: %s median %.2f ms, baseline %.2f ms' % (name, median, baseline_median)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    runbenchmarks()
@@ -5,6 +5,8 @@ from __future__ import absolute_import
 
 from .version import __version__  # noqa
 
+default_app_config = 'taxii_services.apps.TaxiiServicesConfig'
+
 
 def register_admins(admin_list=None):
     """
@@ -25,6 +25,12 @@ class InboxServiceAdmin(admin.ModelAdmin):
         ('Destination Collection Options', {
             # 'classes': ('collapse', ),
             'fields': ('destination_collection_status', 'destination_collections', )
+        }),
+        ('Validation Options', {
+            'fields': ('validation_mode', 'validation_sample_rate', 'trusted_clients', )
+        }),
+        ('Response Options', {
+            'fields': ('pretty_print', )
         })
     )
 
@@ -37,6 +43,18 @@ class InboxMessageAdmin(admin.ModelAdmin):
                        'original_message', 'content_block_count', 'content_blocks_saved')
 
 
+class ContentBindingCountInline(admin.TabularInline):
+    model = models.ContentBindingCount
+    readonly_fields = ['content_binding_and_subtype', 'count']
+
+
+class DataCollectionStatisticsAdmin(admin.ModelAdmin):
+    list_display = ['data_collection', 'total_content_blocks', 'bytes_stored',
+                    'min_timestamp_label', 'max_timestamp_label']
+    readonly_fields = list_display
+    inlines = [ContentBindingCountInline]
+
+
 class DiscoveryServiceAdmin(admin.ModelAdmin):
     pass
 
@@ -82,6 +100,13 @@ class ResultSetAdmin(admin.ModelAdmin):
     inlines = [ResultSetPartInline]
 
 
+class PollJobAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'poll_service', 'status', 'cost', 'duration', 'date_created', 'date_finished']
+    list_filter = ['status']
+    readonly_fields = ['result_set', 'poll_service', 'handler', 'poll_request', 'cost', 'duration',
+                       'message', 'date_started', 'date_finished']
+
+
 class QueryScopeInline(admin.TabularInline):
     model = models.QueryScope
 
@@ -110,10 +135,12 @@ def register_admins(admin_list=None):
     admin.site.register(models.ContentBinding, ContentBindingAdmin)
     admin.site.register(models.ContentBlock, ContentBlockAdmin)
     admin.site.register(models.DataCollection, DataCollectionAdmin)
+    admin.site.register(models.DataCollectionStatistics, DataCollectionStatisticsAdmin)
     admin.site.register(models.DiscoveryService, DiscoveryServiceAdmin)
     admin.site.register(models.InboxMessage, InboxMessageAdmin)
     admin.site.register(models.InboxService, InboxServiceAdmin)
     admin.site.register(models.MessageBinding, MessageBindingAdmin)
+    admin.site.register(models.PollJob, PollJobAdmin)
     admin.site.register(models.PollService, PollServiceAdmin)
     admin.site.register(models.ProtocolBinding, ProtocolBindingAdmin)
     admin.site.register(models.ResultSet, ResultSetAdmin)
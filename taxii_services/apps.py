@@ -0,0 +1,15 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from django.apps import AppConfig
+
+
+class TaxiiServicesConfig(AppConfig):
+    name = 'taxii_services'
+
+    def ready(self):
+        # Connects the Poll Response cache's signal receivers in every process
+        # that loads the app, not only those that handle Poll Requests
+        from taxii_services.util import poll_cache  # noqa
@@ -5,14 +5,19 @@ from __future__ import absolute_import
 
 from copy import deepcopy
 import datetime
-from importlib import import_module
-import sys
+import time
+import zlib
 
 from dateutil.tz import tzutc
-from django.http import Http404, HttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from libtaxii.constants import *
 
-from taxii_services import models
+from taxii_services import metrics, models, util
 from taxii_services.exceptions import StatusMessageException
 
 # TODO: Do these headers belong somewhere else?
@@ -29,6 +34,8 @@ DJANGO_X_TAXII_PROTOCOL = 'HTTP_X_TAXII_PROTOCOL'
 DJANGO_X_TAXII_ACCEPT = 'HTTP_X_TAXII_ACCEPT'
 #: Django version of X-TAXII-Services
 DJANGO_X_TAXII_SERVICES = 'HTTP_X_TAXII_SERVICES'
+#: Django version of Accept-Encoding
+DJANGO_ACCEPT_ENCODING = 'HTTP_ACCEPT_ENCODING'
 
 # TODO: Maybe these header values belong in libtaxii.constants?
 
@@ -44,39 +51,91 @@ HTTP_X_TAXII_PROTOCOL = 'X-TAXII-Protocol'
 HTTP_X_TAXII_ACCEPT = 'X-TAXII-Accept'
 #: HTTP X-TAXII-Services header. Used in response message.
 HTTP_X_TAXII_SERVICES = 'X-TAXII-Services'
+#: HTTP Content-Encoding header. Used in response message.
+HTTP_CONTENT_ENCODING = 'Content-Encoding'
 
 REQUIRED_RESPONSE_HEADERS = (HTTP_CONTENT_TYPE, HTTP_X_TAXII_CONTENT_TYPE, HTTP_X_TAXII_PROTOCOL, HTTP_X_TAXII_SERVICES)
 
 
+#: The TAXII Service models that requests can be routed to, paired with the
+#: MessageHandler foreign keys that are resolved when the routing index is built
+ROUTABLE_SERVICES = ((models.InboxService, ('inbox_message_handler', )),
+                     (models.DiscoveryService, ('discovery_handler', )),
+                     (models.PollService, ('poll_request_handler', 'poll_fulfillment_handler')),
+                     (models.CollectionManagementService, ('collection_information_handler',
+                                                           'subscription_management_handler')))
+
+# The routing index is a dict of {path: TAXII Service model object}. It is built
+# lazily by get_service_from_path and thrown away whenever a TAXII Service or
+# MessageHandler changes. The generation counter keeps a build that raced with
+# an invalidation from being installed.
+_service_index = None
+_service_index_built = None
+_service_index_generation = 0
+
+
+def build_service_index():
+    """
+    Builds a dict of {path: TAXII Service model object} containing every
+    enabled TAXII Service. Each service is the concrete subclass with its
+    MessageHandler foreign keys already resolved.
+    """
+    index = {}
+    for service_model, handler_fields in ROUTABLE_SERVICES:
+        for service in service_model.objects.filter(enabled=True).select_related(*handler_fields):
+            index[service.path] = service
+    return index
+
+
+def invalidate_service_index(sender=None, **kwargs):
+    """
+    Discards the routing index so that the next call to
+    get_service_from_path rebuilds it. Connected to the
+    post_save and post_delete signals of the TAXII Service
+    and MessageHandler models.
+    """
+    global _service_index, _service_index_generation
+    _service_index_generation += 1
+    _service_index = None
+
+
 def get_service_from_path(path):
     """
     Given a path, return a TAXII Service model object.
     If no service is found, raise Http404.
+
+    Lookups are served from an in-process routing index. Signals only reach
+    the process that made the change, so the index is also rebuilt once it is
+    older than settings.TAXII_SERVICES_SERVICE_INDEX_TTL seconds (default: 60,
+    None means never).
     """
-    # Note that because these objects all inherit from models.TaxiService,
-    # which defines the path field, paths are guaranteed to be unique.
-    # That said, this can probably be done more efficiently
-    try:
-        return models.InboxService.objects.get(path=path, enabled=True)
-    except:
-        pass
+    global _service_index, _service_index_built
 
-    try:
-        return models.DiscoveryService.objects.get(path=path, enabled=True)
-    except:
-        pass
+    index = _service_index
+    ttl = getattr(settings, 'TAXII_SERVICES_SERVICE_INDEX_TTL', 60)
+    if index is not None and ttl is not None and time.time() - _service_index_built > ttl:
+        index = None
 
-    try:
-        return models.PollService.objects.get(path=path, enabled=True)
-    except Exception as e:
-        pass
+    metrics.cache_lookup('service_index', index is not None)
+    if index is None:
+        generation = _service_index_generation
+        index = build_service_index()
+        if generation == _service_index_generation:
+            _service_index = index
+            _service_index_built = time.time()
 
+    # Note that because these objects all inherit from models.TaxiService,
+    # which defines the path field, paths are guaranteed to be unique.
     try:
-        return models.CollectionManagementService.objects.get(path=path, enabled=True)
-    except:
-        pass
+        return index[path]
+    except KeyError:
+        raise Http404("No TAXII service at specified path")
 
-    raise Http404("No TAXII service at specified path")
+for service_model, handler_fields in ROUTABLE_SERVICES:
+    post_save.connect(invalidate_service_index, sender=service_model)
+    post_delete.connect(invalidate_service_index, sender=service_model)
+post_save.connect(invalidate_service_index, sender=models.MessageHandler)
+post_delete.connect(invalidate_service_index, sender=models.MessageHandler)
 
 
 def get_message_handler(service, taxii_message):
@@ -115,33 +174,150 @@ def get_message_handler(service, taxii_message):
                                      "Message Type: %s is not supported by %s" %
                                      (mt, st))
 
-    module_name, class_name = handler.handler.rsplit('.', 1)
+    return handler.get_handler_class()
 
-    try:
-        module = import_module(module_name)
-        handler_class = getattr(module, class_name)
-    except Exception as e:
-        type_, value, traceback = sys.exc_info()
-        raise type_, ("Error importing handler: %s" % handler.handler, type, value), traceback
 
-    return handler_class
+#: gzip Content-Encoding
+GZIP_ENCODING = 'gzip'
+#: deflate Content-Encoding
+DEFLATE_ENCODING = 'deflate'
+#: Content-Encodings that responses can be compressed with, in order of preference
+SUPPORTED_CONTENT_ENCODINGS = (GZIP_ENCODING, DEFLATE_ENCODING)
+# zlib window bits for each Content-Encoding. Adding 16 selects the gzip container
+_ENCODING_WBITS = {GZIP_ENCODING: 16 + zlib.MAX_WBITS,
+                   DEFLATE_ENCODING: zlib.MAX_WBITS}
+
+
+def get_content_encoding(django_request):
+    """
+    Picks the Content-Encoding for a response from the request's
+    Accept-Encoding header.
+
+    Returns:
+        One of SUPPORTED_CONTENT_ENCODINGS, or None if the client
+        did not accept any of them.
+    """
+    accept_encoding = django_request.META.get(DJANGO_ACCEPT_ENCODING)
+    if not accept_encoding:
+        return None
+
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = GZIP_ENCODING
+        if not coding:
+            continue
+
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+
+    content_encoding = None
+    best_qvalue = 0.0
+    for coding in SUPPORTED_CONTENT_ENCODINGS:
+        qvalue = qvalues.get(coding, qvalues.get('*', 0.0))
+        if qvalue > best_qvalue:
+            content_encoding = coding
+            best_qvalue = qvalue
+    return content_encoding
+
+
+def get_compressor(content_encoding):
+    """
+    Returns a zlib compression object for content_encoding. The
+    compression level comes from the TAXII_SERVICES_COMPRESSION_LEVEL
+    setting.
+    """
+    level = getattr(settings, 'TAXII_SERVICES_COMPRESSION_LEVEL', 6)
+    return zlib.compressobj(level, zlib.DEFLATED, _ENCODING_WBITS[content_encoding])
+
+
+def compress(content, content_encoding):
+    """
+    Compresses content (a str) with content_encoding
+    """
+    compressor = get_compressor(content_encoding)
+    return compressor.compress(content) + compressor.flush()
+
+
+def compress_chunks(chunks, content_encoding):
+    """
+    Compresses an iterable of str chunks with content_encoding, yielding
+    the compressed data as it becomes available
+    """
+    compressor = get_compressor(content_encoding)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
 
 
 class HttpResponseTaxii(HttpResponse):
     """
     A Django TAXII HTTP Response. Extends the base django.http.HttpResponse
     to allow quick and easy specification of TAXII HTTP headers.in
+
+    If the content_encoding keyword argument is given (see
+    get_content_encoding) and the body is at least
+    TAXII_SERVICES_COMPRESSION_THRESHOLD bytes (default 1024; None disables
+    compression), the body is compressed.
     """
     def __init__(self, taxii_xml, taxii_headers, *args, **kwargs):
+        content_encoding = kwargs.pop('content_encoding', None)
         super(HttpResponseTaxii, self).__init__(*args, **kwargs)
+        for h in REQUIRED_RESPONSE_HEADERS:
+            if h not in taxii_headers:
+                raise ValueError("Required response header not specified: %s" % h)
+
+        threshold = getattr(settings, 'TAXII_SERVICES_COMPRESSION_THRESHOLD', 1024)
+        if content_encoding is not None and threshold is not None and len(taxii_xml) >= threshold:
+            taxii_xml = compress(taxii_xml, content_encoding)
+            self[HTTP_CONTENT_ENCODING] = content_encoding
         self.content = taxii_xml
+
+        for k, v in taxii_headers.iteritems():
+            self[k.lower()] = v
+
+        patch_vary_headers(self, ('Accept-Encoding', ))
+
+
+class StreamingHttpResponseTaxii(StreamingHttpResponse):
+    """
+    A streaming HttpResponseTaxii, whose body is an iterable of str chunks
+    (e.g., models.FragmentPollResponseMixin.iter_xml) that is sent as it is
+    consumed.
+
+    The length of the body isn't known ahead of time, so when the
+    content_encoding keyword argument is given the body is always compressed, chunk by chunk, unless
+    TAXII_SERVICES_COMPRESSION_THRESHOLD is None.
+    """
+    def __init__(self, taxii_xml_chunks, taxii_headers, *args, **kwargs):
+        content_encoding = kwargs.pop('content_encoding', None)
+        super(StreamingHttpResponseTaxii, self).__init__(*args, **kwargs)
         for h in REQUIRED_RESPONSE_HEADERS:
             if h not in taxii_headers:
                 raise ValueError("Required response header not specified: %s" % h)
 
+        threshold = getattr(settings, 'TAXII_SERVICES_COMPRESSION_THRESHOLD', 1024)
+        if content_encoding is not None and threshold is not None:
+            taxii_xml_chunks = compress_chunks(taxii_xml_chunks, content_encoding)
+            self[HTTP_CONTENT_ENCODING] = content_encoding
+        self.streaming_content = taxii_xml_chunks
+
         for k, v in taxii_headers.iteritems():
             self[k.lower()] = v
 
+        patch_vary_headers(self, ('Accept-Encoding', ))
+
 TAXII_11_HTTPS_Headers = {HTTP_CONTENT_TYPE: 'application/xml',
                           HTTP_X_TAXII_CONTENT_TYPE: VID_TAXII_XML_11,
                           HTTP_X_TAXII_PROTOCOL: VID_TAXII_HTTPS_10,
@@ -179,44 +355,108 @@ def get_headers(taxii_services_version, is_secure):
         raise ValueError("Unknown combination for taxii_services_version and is_secure!")
 
 
-def create_result_set(poll_service, prp, results):
+def _iter_parts(keys, part_size):
     """
-    Creates a result set and result set parts depending on parameters
+    Splits an iterable of (timestamp_label, id) keys into lists of at most
+    part_size keys.
+
+    Yields:
+        (keys, more) tuples, where more is False for the last list
     """
+    part = []
+    for key in keys:
+        if len(part) == part_size:
+            yield part, True
+            part = []
+        part.append(key)
+    if part:
+        yield part, False
 
-    # Create the parent result set
+
+def new_result_set(poll_service, prp):
+    """
+    Returns an unsaved models.ResultSet for the Poll Request described by prp,
+    expiring poll_service's Result Set lifetime from now. Expired Result Sets
+    are deleted by the reap_result_sets management command (or a
+    taxii_services.reaper.ResultSetReaper).
+    """
     result_set = models.ResultSet()
     result_set.data_collection = prp.collection
-    result_set.total_content_blocks = len(results)
+    result_set.subscription = prp.subscription
+    result_set.total_content_blocks = 0
     result_set.last_part_returned = None
-    result_set.expires = datetime.datetime.now(tzutc()) + datetime.timedelta(days=7)  # Result Sets expire after a week
-    # TODO: Make some part of the database that actually clears out old ResultSets
+    result_set.expires = datetime.datetime.now(tzutc()) + poll_service.get_result_set_lifetime()
+    return result_set
+
+
+@transaction.atomic
+def create_result_set(poll_service, prp, results, total_content_blocks=None, result_set=None,
+                      use_boundaries=False):
+    """
+    Creates a result set and result set parts depending on parameters,
+    in one transaction.
+
+    The parts do not store their Content Blocks. When use_boundaries is True
+    and results is a queryset, each part stores the keys of its first and
+    last Content Block, and prp's database filters are frozen on the result
+    set. Otherwise each part stores its Content Block ids packed into one
+    value. Either way, creating a result set takes a handful of inserts.
+
+    Arguments:
+        poll_service (models.PollService) - Parts hold poll_service.max_result_size Content Blocks
+        prp (util.PollRequestProperties) - The Poll Request Properties of the Poll Request
+        results - A queryset or list of models.ContentBlock objects
+        total_content_blocks (int) - The number of items in results, if already known
+        result_set (models.ResultSet) - A saved Result Set without parts to fill in, \
+                instead of creating one (e.g., the Result Set of a models.PollJob)
+        use_boundaries (bool) - True only if results is exactly the queryset that \
+                prp's database filters select (i.e., nothing else narrowed it), since \
+                parts with boundaries fetch their Content Blocks by those filters
+    """
+    content_blocks_per_result_set = poll_service.max_result_size
+
+    use_boundaries = use_boundaries and isinstance(results, QuerySet)
+    if isinstance(results, QuerySet):
+        # Keep an existing (timestamp_label, id) ordering, e.g. DataCollection.filter_content_blocks'
+        if not results.query.order_by:
+            results = results.order_by(*util.CONTENT_BLOCK_ORDERING)
+        keys = results.values_list(*util.CONTENT_BLOCK_ORDERING).iterator()
+    else:
+        keys = ((cb.timestamp_label, cb.pk) for cb in results)
+
+    # Create the parent result set
+    if result_set is None:
+        result_set = new_result_set(poll_service, prp)
+    result_set.total_content_blocks = total_content_blocks or 0
+    if use_boundaries:
+        result_set.exclusive_begin_timestamp_label = prp.exclusive_begin_timestamp_label
+        result_set.inclusive_end_timestamp_label = prp.inclusive_end_timestamp_label
     result_set.save()
+    if use_boundaries and prp.content_bindings:
+        result_set.content_bindings.add(*prp.content_bindings)
+    metrics.inc(metrics.RESULT_SETS_CREATED)
 
     # Create the individual parts
-    content_blocks_per_result_set = poll_service.max_result_size
-    part_number = 1
-    i = 0
-    while i < len(results):
+    result_set_parts = []
+    previous_key = None
+    for part_keys, more in _iter_parts(keys, content_blocks_per_result_set):
         rsp = models.ResultSetPart()
         rsp.result_set = result_set
-        rsp.part_number = part_number
-
-        # Pick out the content blocks that will be part of this result set
-        content_blocks = results[i: i + content_blocks_per_result_set]
-        rsp.content_block_count = len(content_blocks)
+        rsp.part_number = len(result_set_parts) + 1
+        rsp.content_block_count = len(part_keys)
+        rsp.more = more
 
         if prp.collection.type == CT_DATA_FEED:  # Need to set timestamp label fields
             # Set the begin TS label
             # For the first part, use the exclusive begin timestamp label supplied as an arg,
             # as that's the exclusive begin timestmap label for the whole result set and
             # is not necessarily equal to the timestamp label of the first content block.
-            # For all subsequent parts, use the timestamp label of the i-1 content block
-            # as the exclusive begin timestamp label
-            if part_number == 1:  # This is the first result set part
+            # For all subsequent parts, use the timestamp label of the last content block
+            # of the previous part as the exclusive begin timestamp label
+            if previous_key is None:  # This is the first result set part
                 rsp.exclusive_begin_timestamp_label = prp.exclusive_begin_timestamp_label
-            else:  # This is not the first result set, use the i-1 Content Block's timestamp label
-                rsp.exclusive_begin_timestamp_label = results[i - 1].timestamp_label
+            else:  # This is not the first result set, use the previous Content Block's timestamp label
+                rsp.exclusive_begin_timestamp_label = previous_key[0]
 
             # Set the end TS label
             # For the last part, use the inclusive end timestamp label supplied as an arg,
@@ -224,23 +464,38 @@ def create_result_set(poll_service, prp, results):
             # is not necessariy equal to the timestamp label of the last content block.
             # For all other parts, use the timestamp label of the last content block in the
             # result part.
-            if i + content_blocks_per_result_set >= len(results):  # There won't be any more result parts
+            if not more:  # There won't be any more result parts
                 rsp.inclusive_end_timestamp_label = prp.inclusive_end_timestamp_label
             else:  # There will be more result parts
-                rsp.inclusive_end_timestamp_label = content_blocks[-1].timestamp_label
+                rsp.inclusive_end_timestamp_label = part_keys[-1][0]
 
-        if i + content_blocks_per_result_set >= len(results):  # This is the last result set part
-            rsp.more = False
+        if use_boundaries:
+            rsp.first_timestamp_label, rsp.first_content_block_id = part_keys[0]
+            rsp.last_timestamp_label, rsp.last_content_block_id = part_keys[-1]
         else:
-            rsp.more = True
-
-        rsp.save()
-        i += len(content_blocks)
-        part_number += 1
-
-        # Add content_blocks to the result set part
-        for cb in content_blocks:
-            rsp.content_blocks.add(cb)
-        rsp.save()
+            rsp.content_block_ids = models.pack_ids([pk for timestamp_label, pk in part_keys])
+
+        result_set_parts.append(rsp)
+        previous_key = part_keys[-1]
+
+    if not result_set_parts:  # Nothing matched; there is still a (empty) first part to fulfill
+        rsp = models.ResultSetPart(result_set=result_set, part_number=1, content_block_count=0, more=False,
+                                   content_block_ids=models.pack_ids([]))
+        if prp.collection.type == CT_DATA_FEED:
+            rsp.exclusive_begin_timestamp_label = prp.exclusive_begin_timestamp_label
+            rsp.inclusive_end_timestamp_label = prp.inclusive_end_timestamp_label
+        result_set_parts.append(rsp)
+
+    models.ResultSetPart.objects.bulk_create(result_set_parts)
+
+    if poll_service.result_set_part_rendering == models.RENDER_EAGER[0]:
+        for rsp in result_set.resultsetpart_set.all():
+            rsp.render_poll_response_11(poll_service.pretty_print)
+            rsp.save(update_fields=['rendered_poll_response'])
+
+    total = sum(rsp.content_block_count for rsp in result_set_parts)
+    if total != result_set.total_content_blocks:  # Content changed since it was counted
+        result_set.total_content_blocks = total
+        result_set.save()
 
     return result_set
@@ -0,0 +1,18 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from taxii_services.models import backfill_collection_membership
+
+
+class Command(BaseCommand):
+    help = ('Brings the CollectionMembership table up to date with the Content Blocks of every Data Collection. '
+            'Run it once after upgrading, and after adding Content Blocks to Data Collections without signals '
+            '(e.g., with bulk_create).')
+
+    def handle(self, *args, **options):
+        created, deleted = backfill_collection_membership()
+        self.stdout.write('Created %s and deleted %s Collection Memberships' % (created, deleted))
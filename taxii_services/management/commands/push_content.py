@@ -0,0 +1,35 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from taxii_services.push import ConnectionPool, push_all
+
+
+class Command(BaseCommand):
+    help = 'Pushes new Content Blocks to the inboxes of PUSH and BOTH subscriptions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Push once and exit, instead of pushing every --interval seconds')
+        parser.add_argument('--interval', type=float, default=10.0,
+                            help='Seconds between pushes (default: 10)')
+
+    def handle(self, *args, **options):
+        pool = ConnectionPool()
+        try:
+            while True:
+                subscriptions, content_blocks = push_all(pool)
+                if options['verbosity'] > 1 or (options['once'] and options['verbosity'] > 0):
+                    self.stdout.write('Pushed %s Content Blocks to %s subscriptions' % (content_blocks, subscriptions))
+                if options['once']:
+                    return
+                close_old_connections()
+                time.sleep(options['interval'])
+        finally:
+            pool.close()
@@ -0,0 +1,32 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from taxii_services.reaper import describe, reap
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired Result Sets and their parts, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows to delete per statement (default: TAXII_SERVICES_RESULT_SET_REAP_BATCH_SIZE '
+                                 'or 500)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running, reaping every INTERVAL seconds, instead of reaping once')
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = reap(options['batch_size'])
+            if options['verbosity'] > 0:
+                self.stdout.write('Deleted %s' % describe(deleted))
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
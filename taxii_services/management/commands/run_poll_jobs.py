@@ -0,0 +1,56 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from multiprocessing import Process
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from taxii_services.models import PollJob
+
+
+def run_poll_jobs(once=False, sleep=1.0):
+    """
+    Runs pending Poll Jobs one at a time. Unless once is True, waits sleep
+    seconds for more whenever there are none.
+    """
+    while True:
+        poll_job = PollJob.claim_next()
+        if poll_job is not None:
+            poll_job.run()
+            close_old_connections()
+        elif once:
+            return
+        else:
+            close_old_connections()
+            time.sleep(sleep)
+
+
+class Command(BaseCommand):
+    help = ('Runs the Poll Requests that were answered with a Pending Status Message. '
+            'Several copies of this command (or --processes) share the work.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of worker processes (default: 1)')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when there are no pending Poll Jobs, instead of waiting for more')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Seconds to wait between checks for new Poll Jobs (default: 1)')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            run_poll_jobs(options['once'], options['sleep'])
+            return
+
+        # Each worker opens its own database connections
+        connections.close_all()
+        workers = [Process(target=run_poll_jobs, args=(options['once'], options['sleep']))
+                   for i in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
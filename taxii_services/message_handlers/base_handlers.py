@@ -51,6 +51,34 @@ class BaseMessageHandler(object):
             raise ValueError('The variable \'supported_request_messages\' has not been defined by the subclass!')
         return cls.supported_request_messages
 
+    @classmethod
+    def get_supported_taxii_versions(cls):
+        """
+        Infers which versions of TAXII this MessageHandler supports from
+        the supported_request_messages property. The result is computed
+        once per class.
+
+        Returns:
+            A frozenset containing VID_TAXII_SERVICES_11 and/or VID_TAXII_SERVICES_10
+        """
+        taxii_versions = cls.__dict__.get('_supported_taxii_versions')
+        if taxii_versions is not None:
+            return taxii_versions
+
+        taxii_versions = set()
+        for message in cls.get_supported_request_messages():
+            if message.__module__ == 'libtaxii.messages_11':
+                taxii_versions.add(VID_TAXII_SERVICES_11)
+            elif message.__module__ == 'libtaxii.messages_10':
+                taxii_versions.add(VID_TAXII_SERVICES_10)
+            else:
+                raise ValueError(("The variable \'supported_request_messages\' "
+                                 "contained a non-libtaxii message module: %s") %
+                                 message.__module__)
+
+        cls._supported_taxii_versions = frozenset(taxii_versions)
+        return cls._supported_taxii_versions
+
     @classmethod
     def validate_headers(cls, django_request, in_response_to='0'):
         """
@@ -107,17 +135,9 @@ class BaseMessageHandler(object):
         # print '%s: %s' % (k, v)
 
         # Identify which TAXII versions the message handler supports
-        supports_taxii_11 = False
-        supports_taxii_10 = False
-        for message in cls.get_supported_request_messages():
-            if message.__module__ == 'libtaxii.messages_11':
-                supports_taxii_11 = True
-            elif message.__module__ == 'libtaxii.messages_10':
-                supports_taxii_10 = True
-            else:
-                raise ValueError(("The variable \'supported_request_messages\' "
-                                 "contained a non-libtaxii message module: %s") %
-                                 message.__module__)
+        taxii_versions = cls.get_supported_taxii_versions()
+        supports_taxii_11 = VID_TAXII_SERVICES_11 in taxii_versions
+        supports_taxii_10 = VID_TAXII_SERVICES_10 in taxii_versions
 
         # Next, determine whether the MessageHandler supports the headers
         # Validate the X-TAXII-Services header
@@ -3,12 +3,13 @@
 
 from __future__ import absolute_import
 
+from django.db import transaction
 from libtaxii.common import generate_message_id
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
 import libtaxii.messages_11 as tm11
 
-from taxii_services import models
+from taxii_services import metrics, models
 from taxii_services.exceptions import StatusMessageException
 
 from .base_handlers import BaseMessageHandler
@@ -35,11 +36,13 @@ class InboxMessage11Handler(BaseMessageHandler):
             supporting_collections (list of models.DataCollection) - The Data Collections to add this content_block to
         """
         # TODO: Could/should this take an InboxService model object?
-        cb = models.ContentBlock.from_content_block_11(content_block)
-        cb.save()
+        # The Data Collections' statistics are updated in the same transaction
+        with transaction.atomic():
+            cb = models.ContentBlock.from_content_block_11(content_block)
+            cb.save()
 
-        for collection in supporting_collections:
-            collection.content_blocks.add(cb)
+            for collection in supporting_collections:
+                collection.content_blocks.add(cb)
 
     @classmethod
     def handle_message(cls, inbox_service, inbox_message, django_request):
@@ -95,6 +98,7 @@ class InboxMessage11Handler(BaseMessageHandler):
         # Update the Inbox Message model with the number of ContentBlocks that were saved
         inbox_message_db.content_blocks_saved = saved_blocks
         inbox_message_db.save()
+        metrics.inc(metrics.CONTENT_BLOCKS_INGESTED, saved_blocks, service=inbox_service.path)
 
         # Create and return a Status Message indicating success
         status_message = tm11.StatusMessage(message_id=generate_message_id(),
@@ -144,6 +148,7 @@ class InboxMessage10Handler(BaseMessageHandler):
         # Update the Inbox Message model with the number of ContentBlocks that were saved
         inbox_message_db.content_blocks_saved = saved_blocks
         inbox_message_db.save()
+        metrics.inc(metrics.CONTENT_BLOCKS_INGESTED, saved_blocks, service=inbox_service.path)
 
         # Create and return a Status Message indicating success
         status_message = tm11.StatusMessage(message_id=generate_message_id(),
@@ -3,6 +3,7 @@
 
 from __future__ import absolute_import
 
+from django.utils import timezone
 from libtaxii.constants import *
 import libtaxii.messages_11 as tm11
 
@@ -28,19 +29,41 @@ class PollFulfillmentRequest11Handler(BaseMessageHandler):
             1. Look in models.ResultSetPart for a ResultSetPart that matches the criteria of the request
             2. Update the ResultSetPart's parent (models.ResultSet) to store which ResultSetPart was most recently returned
             3. Turn the ResultSetPart into a PollResponse, and return it
+
+        A Result Set whose models.PollJob has not finished has no parts yet;
+        requests for it are answered with a Pending Status Message (or a
+        Failure, if the job failed). Expired Result Sets are not found, even
+        if they have not been deleted yet.
         """
         try:
-            rsp = models.ResultSetPart.objects.get(result_set__pk=poll_fulfillment_request.result_id,
-                                                   part_number=poll_fulfillment_request.result_part_number,
-                                                   result_set__data_collection__name=poll_fulfillment_request.collection_name)
+            result_set_parts = models.ResultSetPart.objects.select_related('result_set__data_collection',
+                                                                           'result_set__subscription')
+            rsp = result_set_parts.get(result_set__pk=poll_fulfillment_request.result_id,
+                                       part_number=poll_fulfillment_request.result_part_number,
+                                       result_set__data_collection__name=poll_fulfillment_request.collection_name,
+                                       result_set__expires__gt=timezone.now())
 
-            poll_response = rsp.to_poll_response_11(poll_fulfillment_request.message_id)
+            poll_response = poll_service.get_result_set_part_response(rsp, poll_fulfillment_request.message_id)
             rsp.result_set.last_part_returned = rsp
-            rsp.save()
+            rsp.result_set.save()
             return poll_response
         except models.ResultSetPart.DoesNotExist:
+            poll_job = models.PollJob.objects.filter(result_set__pk=poll_fulfillment_request.result_id,
+                                                     status__in=(models.POLL_JOB_PENDING[0],
+                                                                 models.POLL_JOB_RUNNING[0],
+                                                                 models.POLL_JOB_FAILED[0])).first()
+            if poll_job is not None and poll_job.status == models.POLL_JOB_FAILED[0]:
+                raise StatusMessageException(poll_fulfillment_request.message_id,
+                                             ST_FAILURE,
+                                             "The poll failed: %s" % poll_job.message)
+            if poll_job is not None:
+                raise StatusMessageException(poll_fulfillment_request.message_id,
+                                             ST_PENDING,
+                                             status_detail={SD_ESTIMATED_WAIT: poll_job.get_estimated_wait(),
+                                                            SD_RESULT_ID: str(poll_job.result_set_id),
+                                                            SD_WILL_PUSH: False})
             raise StatusMessageException(poll_fulfillment_request.message_id,
                                          ST_NOT_FOUND,
-                                         {SD_ITEM: str(poll_fulfillment_request.result_id)})
+                                         status_detail={SD_ITEM: str(poll_fulfillment_request.result_id)})
 
 # PollFulfillment is new in TAXII 1.1, so there aren't any TAXII 1.0 handlers for it
@@ -5,6 +5,9 @@ from __future__ import absolute_import
 
 from datetime import timedelta
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
 from libtaxii.common import generate_message_id
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
@@ -12,7 +15,7 @@ import libtaxii.messages_11 as tm11
 
 from taxii_services import handlers, models
 from taxii_services.exceptions import StatusMessageException
-from taxii_services.util import PollRequestProperties
+from taxii_services.util import PollRequestProperties, poll_cache, timing
 
 from .base_handlers import BaseMessageHandler
 
@@ -27,6 +30,9 @@ class PollRequest11Handler(BaseMessageHandler):
 
     supported_request_messages = [tm11.PollRequest]
     version = "1"
+    #: Related objects fetched along with the Content Blocks. Classes that
+    #: use more of each Content Block's relations can add to this
+    select_related = models.CONTENT_BLOCK_SELECT_RELATED
 
     @classmethod
     def get_content(cls, prp, query_kwargs):
@@ -43,10 +49,62 @@ class PollRequest11Handler(BaseMessageHandler):
             this method only need to return an iterable where each class has \
             a 'to_content_block_11()' function.
         """
-        content = prp.collection.content_blocks.filter(**query_kwargs).order_by('timestamp_label')
+        content = prp.collection.filter_content_blocks(**query_kwargs)
+        content = content.select_related(*cls.select_related)
 
         return content
 
+    @classmethod
+    def count_content(cls, prp, query_kwargs, content):
+        """
+        Counts the content of a "Count Only" Poll Request that has no query.
+
+        When get_content is not overridden, query_kwargs filter by nothing
+        but Content Binding and timestamp labels, and the timestamp labels
+        include every Content Block in the Data Collection, the count comes
+        from the Data Collection's statistics without touching the Content
+        Blocks. Otherwise a queryset is counted by the database.
+
+        Arguments:
+            prp (util.PollRequestProperties) - The Poll Request Properties of the Poll Request
+            query_kwargs (dict) - The parameters of the search for content
+            content - The result of get_content
+
+        Returns:
+            The number of items in content
+        """
+        other_kwargs = dict(query_kwargs)
+        content_bindings = other_kwargs.pop('content_binding_and_subtype__in', None)
+        begin = other_kwargs.pop('timestamp_label__gt', None)
+        end = other_kwargs.pop('timestamp_label__lte', None)
+        if cls.uses_default_get_content() and not other_kwargs:
+            statistics = prp.collection.get_statistics()
+            min_label, max_label = statistics.min_timestamp_label, statistics.max_timestamp_label
+            if ((begin is None or min_label is None or begin < min_label) and
+                    (end is None or max_label is None or end >= max_label)):
+                return statistics.count_content_blocks(content_bindings)
+
+        if isinstance(content, QuerySet):
+            return content.count()
+        return len(content)
+
+    @classmethod
+    def uses_default_get_content(cls):
+        """
+        Returns True if get_content is not overridden, meaning content is
+        selected from the Data Collection by the database query alone.
+        """
+        return cls.get_content.__func__ is PollRequest11Handler.get_content.__func__
+
+    @classmethod
+    def content_is_db_filtered(cls, prp):
+        """
+        Returns True if the content of prp's Poll Request is selected by
+        nothing but prp's database filters: get_content is not overridden
+        and there is no query handler to narrow it further.
+        """
+        return cls.uses_default_get_content() and prp.supported_query is None
+
     @classmethod
     def create_poll_response(cls, poll_service, prp, content):
         """
@@ -62,52 +120,94 @@ class PollRequest11Handler(BaseMessageHandler):
         number of contents are greater than the
         poll_service's max_result_size, a ResultSet
         is created, and a PollResponse w/more=True is used.
-        """
 
-        content_count = len(content)
+        When content is a queryset, at most max_result_size + 1 Content Blocks
+        are read to decide between 2. and 4., and the record count comes from a
+        COUNT query. Result Set parts are then built with keyset pagination, so
+        the whole of content is never held in memory.
+
+        In case 3., when content is a queryset and the poll_service streams
+        Poll Responses, the Poll Response is given the queryset itself and
+        is written while the queryset is read (see
+        models.FragmentPollResponseMixin).
+        """
 
         # RT_COUNT_ONLY - Always use a single result
         # RT_FULL - Use a single response if
         #           poll_service.max_result_size is None or
         #           len(content) <= poll_service.max_result_size
         #           Use a Multi-Part response otherwise
-
-        if (prp.response_type == RT_COUNT_ONLY or
-            poll_service.max_result_size is None or
-            content_count <= poll_service.max_result_size):
-
-            poll_response = tm11.PollResponse(message_id=generate_message_id(),
-                                              in_response_to=prp.message_id,
-                                              collection_name=prp.collection.name,
-                                              result_part_number=1,
-                                              more=False,
-                                              exclusive_begin_timestamp_label=prp.exclusive_begin_timestamp_label,
-                                              inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label,
-                                              record_count=tm11.RecordCount(content_count, False))
-            if prp.subscription:
-                    poll_response.subscription_id = prp.subscription.subscription_id
-
-            if prp.response_type == RT_FULL:
-                for c in content:
+        max_result_size = poll_service.max_result_size
+        is_queryset = isinstance(content, QuerySet)
+
+        if prp.response_type == RT_COUNT_ONLY:
+            return cls.create_count_response(poll_service, prp, content.count() if is_queryset else len(content))
+
+        if max_result_size is None and is_queryset and poll_service.stream_poll_responses:
+            poll_response = cls.create_count_response(poll_service, prp, content.count())
+            poll_response.content_block_queryset = content
+            return poll_response
+
+        if max_result_size is None:
+            page = list(content)
+            content_count = len(page)
+        elif is_queryset:
+            page = list(content[:max_result_size + 1])
+            content_count = len(page)
+            if content_count > max_result_size:
+                content_count = content.count()
+        else:
+            page = content
+            content_count = len(content)
+
+        if max_result_size is None or content_count <= max_result_size:
+            poll_response = cls.create_count_response(poll_service, prp, content_count)
+            for c in page:
+                if isinstance(c, models.ContentBlock):
+                    poll_response.content_block_models.append(c)
+                else:
                     poll_response.content_blocks.append(c.to_content_block_11())
         else:
             # Split into multiple result sets
-            result_set = handlers.create_result_set(poll_service, prp, content)
+            result_set = handlers.create_result_set(poll_service, prp, content, content_count,
+                                                    use_boundaries=cls.content_is_db_filtered(prp))
             rsp_1 = models.ResultSetPart.objects.get(result_set__pk=result_set.pk, part_number=1)
-            poll_response = rsp_1.to_poll_response_11(prp.message_id)
+            rsp_1.result_set = result_set
+            poll_response = poll_service.get_result_set_part_response(rsp_1, prp.message_id)
             result_set.last_part_returned = rsp_1
             result_set.save()
-            response = poll_response
 
         return poll_response
 
     @classmethod
-    def create_pending_response(cls, poll_service, prp, content):
+    def create_count_response(cls, poll_service, prp, content_count):
+        """
+        Creates a single poll response (more=False) with a record count of
+        content_count and no Content Blocks. This is the response to a
+        "Count Only" Poll Request, and the start of a single "Full" one.
+        """
+        poll_response = models.FragmentPollResponse11(message_id=generate_message_id(),
+                                                      in_response_to=prp.message_id,
+                                                      collection_name=prp.collection.name,
+                                                      result_part_number=1,
+                                                      more=False,
+                                                      exclusive_begin_timestamp_label=prp.exclusive_begin_timestamp_label,
+                                                      inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label,
+                                                      record_count=tm11.RecordCount(content_count, False))
+        if prp.subscription:
+            poll_response.subscription_id = prp.subscription.subscription_id
+
+        return poll_response
+
+    @classmethod
+    def create_pending_response(cls, poll_service, prp, content, cost=None):
         """
         Arguments:
             poll_service (models.PollService) - The TAXII Poll Service being invoked
             prp (util.PollRequestProperties) - The Poll Request Properties of the Poll Request
-            content - A list of content (nominally, models.ContentBlock objects).
+            content - A list of content (nominally, models.ContentBlock objects). Not used: \
+                    the Poll Request is run again in the background
+            cost (int) - The estimated cost of the Poll Request, in Content Blocks to evaluate
 
         This method returns a StatusMessage with a Status Type
         of Pending OR raises a StatusMessageException
@@ -116,33 +216,37 @@ class PollRequest11Handler(BaseMessageHandler):
             asynch | Delivery_Params | can_push || Response Type
             ----------------------------------------------------
             True   | -               | -        || Pending - Asynch
-            False  | Yes             | Yes      || Pending - Push
+            False  | Yes             | Yes      || StatusMessageException (push is not supported)
             False  | Yes             | No       || StatusMessageException
             False  | No              | -        || StatusMessageException
-        """
 
-        # Identify the Exception conditions first (e.g., rows #3 and #4)
-        if (prp.allow_asynch is False and
-            (prp.delivery_parameters is None or prp.can_push is False)):
+        A Pending - Asynch response queues a models.PollJob, which the
+        run_poll_jobs management command runs later. The Status Message holds
+        the id of the job's Result Set, which the requester polls for with
+        Poll Fulfillment Requests, and the estimated wait in seconds.
+        """
 
+        if not prp.allow_asynch:
             raise StatusMessageException(prp.message_id,
                                          ST_FAILURE,
                                          "The content was not available now and \
-                                         the request had allow_asynch=False and no \
-                                         Delivery Parameters were specified.")
-
-        # Rows #1 and #2 are both Status Messages with a type of Pending
-        result_set = cls.create_result_set(content, prp, poll_service)
-        sm = tm11.StatusMessage(message_id=generate_message_id(),
-                                in_response_to=prp.message_id,
-                                status_type=ST_PENDING)
-        if prp.allow_asynch:
-            sm.status_details = {SD_ESTIMATED_WAIT: 300, SD_RESULT_ID: result_set.pk, SD_WILL_PUSH: False}
-        else:
-            # TODO: Check and see if the requested delivery parameters are supported
-            sm.status_details = {SD_ESTIMATED_WAIT: 300, SD_RESULT_ID: result_set.pk, SD_WILL_PUSH: True}
-            # TODO: Need to try pushing or something.
-        return sm
+                                         the request had allow_asynch=False.")
+
+        with transaction.atomic():
+            result_set = handlers.new_result_set(poll_service, prp)
+            result_set.save()
+            poll_job = models.PollJob.objects.create(result_set=result_set,
+                                                     poll_service=poll_service,
+                                                     handler='%s.%s' % (cls.__module__, cls.__name__),
+                                                     poll_request=prp.poll_request.to_xml(),
+                                                     cost=cost or 0)
+
+        return tm11.StatusMessage(message_id=generate_message_id(),
+                                  in_response_to=prp.message_id,
+                                  status_type=ST_PENDING,
+                                  status_detail={SD_ESTIMATED_WAIT: poll_job.get_estimated_wait(),
+                                                 SD_RESULT_ID: str(result_set.pk),
+                                                 SD_WILL_PUSH: False})
 
     @classmethod
     def handle_message(cls, poll_service, poll_request, django_request):
@@ -159,44 +263,126 @@ class PollRequest11Handler(BaseMessageHandler):
             4. If a Query Handler exists, call the `QueryHandler.filter_content( ... )`
                function. This allows the QueryHandler a hook to modify the results after they have been returned
                from the database, but before they are returned to the requestor.
+               For a "Count Only" Poll Request, `QueryHandler.count_content( ... )` is called
+               instead (or, without a Query Handler, `cls.count_content( ... )`), and the result
+               of calling `create_count_response` is returned.
             5. If the results are available "now", return the result of calling
                `create_poll_response`.
-            6. (Experimental) If the results are not available "now", return the result
-                of calling `create_pending_response`.
+            6. If the results are not available "now", return the result
+                of calling `create_pending_response`. Results are not available "now" when
+                the requester allows asynchronous responses and a query handler would filter
+                more than settings.TAXII_SERVICES_BACKGROUND_POLL_THRESHOLD Content Blocks
+                (default: None, never). Step 4 is then skipped and the poll runs in the background.
+
+        A Poll Request that starts at or past the newest Content Block in the Data
+        Collection (see util.PollRequestProperties.is_past_high_water_mark) is answered
+        with an empty response right after step 1, unless get_content is overridden.
+
+        When the Poll Response cache is enabled (see util.poll_cache), a Poll Request
+        whose normalized properties match an earlier one is answered with the earlier
+        single-part Poll Response before step 2, and single-part Poll Responses are
+        cached after step 5.
         """
         # Populate a PollRequestProperties object from the poll request
         # A lot of magic happens in this function call
         prp = PollRequestProperties.from_poll_request_11(poll_service, poll_request)
         supported_query = prp.supported_query
+        query_handler_class = None
+        if supported_query is not None:
+            query_handler_class = supported_query.query_handler.get_handler_class()
+
+        # "Is there anything new?" polls are answered without touching the Content Blocks
+        if cls.uses_default_get_content() and prp.is_past_high_water_mark():
+            return cls.create_count_response(poll_service, prp, 0)
+
+        # Identical Poll Requests get identical responses until the collection changes
+        cache = poll_cache.get_cache()
+        cache_key = None
+        if cache is not None:
+            cache_key = poll_cache.get_key(cache, cls, poll_service, prp)
+            if cache_key is not None:
+                response = poll_cache.get_response(cache, cache_key, prp)
+                if response is not None:
+                    return response
 
         # Get the kwargs to search the DB with
         db_kwargs = prp.get_db_kwargs()
 
         # If a query handler exists, allow it to
         # inject kwargs
-        if supported_query is not None:
-            supported_query.query_handler.get_handler_class().update_db_kwargs(prp, db_kwargs)
+        if query_handler_class is not None:
+            query_handler_class.update_db_kwargs(prp, db_kwargs)
 
         # Get content from the database.
         # content MUST be an iterable where each
         # object has a `to_content_block_11()` function
         content_blocks = cls.get_content(prp, db_kwargs)
 
+        # Count Only responses don't need the Content Blocks, just how many there are.
+        # Querysets are counted by the database, query handlers count without
+        # keeping the Content Blocks
+        if prp.response_type == RT_COUNT_ONLY:
+            if query_handler_class is not None:
+                with timing.timed(django_request, timing.PHASE_FILTER):
+                    content_count = query_handler_class.count_content(prp, content_blocks)
+            else:
+                content_count = cls.count_content(prp, db_kwargs, content_blocks)
+            response = cls.create_count_response(poll_service, prp, content_count)
+            if cache_key is not None:
+                response = poll_cache.set_response(cache, cache_key, response, prp, poll_service.pretty_print)
+            return response
+
+        # Query handlers read every Content Block they filter, so when the requester
+        # allows it, a poll that would filter too many of them runs in the background
+        results_available = True
+        cost = None
+        threshold = getattr(settings, 'TAXII_SERVICES_BACKGROUND_POLL_THRESHOLD', None)
+        if query_handler_class is not None and threshold is not None and prp.allow_asynch:
+            cost = cls.count_content(prp, db_kwargs, content_blocks)
+            results_available = cost <= threshold
+
         # If there is a query handler,
         # allow it do to post-dbquery filtering
-        if supported_query:
-            content_blocks = supported_query.query_handler.get_handler_class().filter_content(prp, content_blocks)
-
-        # The way this handler is written, this will never be false
-        results_available = True  # TODO: Can this flag be usefully implemented?
+        if query_handler_class is not None and results_available:
+            with timing.timed(django_request, timing.PHASE_FILTER):
+                content_blocks = query_handler_class.filter_content(prp, content_blocks)
 
         if results_available:
             response = cls.create_poll_response(poll_service, prp, content_blocks)
+            # Multi-part responses belong to their own Result Set, so only single parts are cached.
+            # Streamed responses are left out, since caching them would hold them in memory
+            if (cache_key is not None and isinstance(response, tm11.PollResponse) and not response.more and
+                    getattr(response, 'content_block_queryset', None) is None):
+                response = poll_cache.set_response(cache, cache_key, response, prp, poll_service.pretty_print)
         else:
-            response = cls.create_pending_response(poll_service, prp, content_blocks)
+            response = cls.create_pending_response(poll_service, prp, content_blocks, cost)
 
         return response
 
+    @classmethod
+    def run_poll_job(cls, poll_job):
+        """
+        Runs a models.PollJob created by create_pending_response: repeats
+        steps 1 to 4 of handle_message for the job's Poll Request and puts
+        the results into the job's Result Set.
+        """
+        poll_service = poll_job.poll_service
+        poll_request = tm11.get_message_from_xml(poll_job.poll_request)
+        prp = PollRequestProperties.from_poll_request_11(poll_service, poll_request)
+        query_handler_class = None
+        if prp.supported_query is not None:
+            query_handler_class = prp.supported_query.query_handler.get_handler_class()
+
+        db_kwargs = prp.get_db_kwargs()
+        if query_handler_class is not None:
+            query_handler_class.update_db_kwargs(prp, db_kwargs)
+        content_blocks = cls.get_content(prp, db_kwargs)
+        if query_handler_class is not None:
+            content_blocks = query_handler_class.filter_content(prp, content_blocks)
+
+        handlers.create_result_set(poll_service, prp, content_blocks, result_set=poll_job.result_set,
+                                   use_boundaries=cls.content_is_db_filtered(prp))
+
 
 class PollRequest10Handler(BaseMessageHandler):
     """
@@ -204,6 +390,9 @@ class PollRequest10Handler(BaseMessageHandler):
     """
     supported_request_messages = [tm10.PollRequest]
     version = "1"
+    #: Related objects fetched along with the Content Blocks. Classes that
+    #: use more of each Content Block's relations can add to this
+    select_related = models.CONTENT_BLOCK_SELECT_RELATED
 
     @classmethod
     def get_content(cls, prp, query_kwargs):
@@ -215,10 +404,18 @@ class PollRequest10Handler(BaseMessageHandler):
                  method only need to return an iterable where each instance has a \
                  'to_content_block_10()' function.
         """
-        content = prp.collection.content_blocks.filter(**query_kwargs).order_by('timestamp_label')
+        content = prp.collection.filter_content_blocks(**query_kwargs)
+        content = content.select_related(*cls.select_related)
 
         return content
 
+    @classmethod
+    def uses_default_get_content(cls):
+        """
+        Returns True if get_content is not overridden.
+        """
+        return cls.get_content.__func__ is PollRequest10Handler.get_content.__func__
+
     @classmethod
     def create_poll_response(cls, poll_service, prp, content_blocks):
         """
@@ -226,21 +423,30 @@ class PollRequest10Handler(BaseMessageHandler):
         :param poll_service:
         :param prp:
         :param content_blocks:
-        :return:
+        :return: A Poll Response holding every Content Block. When content_blocks is a queryset \
+                 and poll_service streams Poll Responses, it holds the queryset instead and is \
+                 written while the queryset is read (see models.FragmentPollResponseMixin).
         """
 
         ietl = prp.exclusive_begin_timestamp_label
         if ietl is not None:
             ietl += timedelta(milliseconds=1)
 
-        pr = tm10.PollResponse(message_id=generate_message_id(),
-                               in_response_to=prp.message_id,
-                               feed_name=prp.collection.name,
-                               inclusive_begin_timestamp_label=ietl,
-                               inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label)
+        pr = models.FragmentPollResponse10(message_id=generate_message_id(),
+                                           in_response_to=prp.message_id,
+                                           feed_name=prp.collection.name,
+                                           inclusive_begin_timestamp_label=ietl,
+                                           inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label)
+
+        if poll_service.stream_poll_responses and isinstance(content_blocks, QuerySet):
+            pr.content_block_queryset = content_blocks
+            return pr
 
         for content_block in content_blocks:
-            pr.content_blocks.append(content_block.to_content_block_10())
+            if isinstance(content_block, models.ContentBlock):
+                pr.content_block_models.append(content_block)
+            else:
+                pr.content_blocks.append(content_block.to_content_block_10())
 
         return pr
 
@@ -250,6 +456,8 @@ class PollRequest10Handler(BaseMessageHandler):
         TODO: This isn't tested
         """
         prp = PollRequestProperties.from_poll_request_10(poll_service, poll_message)
+        if cls.uses_default_get_content() and prp.is_past_high_water_mark():
+            return cls.create_poll_response(poll_service, prp, [])
         query_kwargs = prp.get_db_kwargs()
         content_blocks = cls.get_content(prp, query_kwargs)
         response = cls.create_poll_response(poll_service, prp, content_blocks)
@@ -3,6 +3,9 @@
 
 from __future__ import absolute_import
 
+import datetime
+
+from dateutil.tz import tzutc
 from libtaxii.common import generate_message_id
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
@@ -127,6 +130,43 @@ class SubscriptionRequest11Handler(BaseMessageHandler):
             subscription_list.append(subscription.to_subscription_instance_11())
         return subscription_list
 
+    @staticmethod
+    def validate_push_parameters(data_collection, push_parameters, in_response_to, response_type=RT_FULL):
+        """
+        Raises a StatusMessageException if push_parameters (a tm11.PushParameters)
+        name a protocol or message binding that content can't be pushed with,
+        or if the subscription's response_type is Count Only. Pushes always
+        carry full Content Blocks.
+        """
+        if response_type == RT_COUNT_ONLY:
+            raise StatusMessageException(in_response_to,
+                                         ST_FAILURE,
+                                         message='Push delivery is not supported for Count Only subscriptions')
+        push_protocols = [pm.push_protocol for pm in data_collection.get_push_methods_11()]
+        if push_parameters.inbox_protocol not in push_protocols:
+            raise StatusMessageException(in_response_to,
+                                         ST_UNSUPPORTED_PROTOCOL,
+                                         status_detail={SD_SUPPORTED_PROTOCOL: push_protocols})
+        if push_parameters.delivery_message_binding != VID_TAXII_XML_11:
+            raise StatusMessageException(in_response_to,
+                                         ST_UNSUPPORTED_MESSAGE_BINDING,
+                                         status_detail={SD_SUPPORTED_BINDING: [VID_TAXII_XML_11]})
+
+    @staticmethod
+    def set_push_parameters(subscription, push_parameters):
+        """
+        Makes subscription a PUSH subscription to the inbox in push_parameters
+        (a tm11.PushParameters). Content Blocks saved from now on are pushed
+        (see taxii_services.push).
+        """
+        subscription.delivery = models.SUBS_PUSH[0]
+        subscription.push_protocol = push_parameters.inbox_protocol
+        subscription.push_address = push_parameters.inbox_address
+        subscription.push_message_binding = push_parameters.delivery_message_binding
+        subscription.push_watermark_timestamp_label = datetime.datetime.now(tzutc())
+        subscription.push_watermark_content_block_id = 0
+        subscription.save()
+
     @staticmethod
     def subscribe(subscription_management_request, data_collection):
         """
@@ -145,7 +185,11 @@ class SubscriptionRequest11Handler(BaseMessageHandler):
             accept_all_content = False
             supported_contents = data_collection.get_binding_intersection_11(smr.subscription_parameters.content_bindings, '0')
 
-        # TODO: Check for supported push methods (e.g., inbox protocol, delivery message binding)
+        push_parameters = smr.push_parameters
+        if push_parameters is not None:
+            SubscriptionRequest11Handler.validate_push_parameters(data_collection, push_parameters, smr.message_id,
+                                                                  smr.subscription_parameters.response_type)
+
         # TODO: Check the query format and see if it works
         # TODO: Implement query
 
@@ -157,10 +201,13 @@ class SubscriptionRequest11Handler(BaseMessageHandler):
                                                                           data_collection=data_collection,
                                                                           accept_all_content=accept_all_content,
                                                                           #supported_content=supported_contents,  # TODO: This is probably wrong
+                                                                          push_address=getattr(push_parameters, 'inbox_address', ''),
                                                                           query=None)  # TODO: Implement query
         if supported_contents is not None:
             subscription.supported_content = supported_contents
             subscription.save()
+        if created and push_parameters is not None:
+            SubscriptionRequest11Handler.set_push_parameters(subscription, push_parameters)
         #print 'created subscription! id=', subscription.subscription_id
         #print 'total num of subs: ', len(models.Subscription.objects.all())
         return subscription.to_subscription_instance_11()
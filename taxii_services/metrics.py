@@ -0,0 +1,273 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Counters and histograms describing what django-taxii-services is doing,
+exported in the Prometheus text exposition format by views.prometheus_metrics.
+
+Each process keeps its own values in memory. When the
+TAXII_SERVICES_METRICS_DIR setting names a directory, each process also
+writes a JSON snapshot of its values to a file in that directory (at most
+every TAXII_SERVICES_METRICS_FLUSH_INTERVAL seconds, default 5) and the
+export adds up the snapshots of every process, so any worker can report
+for all of them. Snapshot files are never removed by this module, so the
+totals of workers that have exited are kept; clear the directory when the
+counters should start over (e.g., on deployment).
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+#: TAXII requests handled, by service path, request message type and Status Type
+REQUESTS = 'taxii_requests_total'
+#: Time spent handling TAXII requests, by service path and request message type
+REQUEST_DURATION = 'taxii_request_duration_seconds'
+#: Content Blocks saved from Inbox Messages, by service path
+CONTENT_BLOCKS_INGESTED = 'taxii_content_blocks_ingested_total'
+#: Content Blocks sent in Poll Responses, by service path
+CONTENT_BLOCKS_SERVED = 'taxii_content_blocks_served_total'
+#: Result Sets created for multi-part Poll Responses
+RESULT_SETS_CREATED = 'taxii_result_sets_created_total'
+#: Content Blocks evaluated against a query, by query handler
+QUERY_EVALUATIONS = 'taxii_query_evaluations_total'
+#: Cache lookups, by cache name and result (hit or miss)
+CACHE_LOOKUPS = 'taxii_cache_lookups_total'
+
+#: {metric name: (type, help text)}
+METRICS = {
+    REQUESTS: (COUNTER, 'TAXII requests handled.'),
+    REQUEST_DURATION: (HISTOGRAM, 'Time spent handling TAXII requests.'),
+    CONTENT_BLOCKS_INGESTED: (COUNTER, 'Content Blocks saved from Inbox Messages.'),
+    CONTENT_BLOCKS_SERVED: (COUNTER, 'Content Blocks sent in Poll Responses.'),
+    RESULT_SETS_CREATED: (COUNTER, 'Result Sets created for multi-part Poll Responses.'),
+    QUERY_EVALUATIONS: (COUNTER, 'Content Blocks evaluated against a query.'),
+    CACHE_LOOKUPS: (COUNTER, 'Cache lookups.'),
+}
+
+#: Upper bounds, in seconds, of the REQUEST_DURATION buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+# {(name, ((label, value), ...)): value}
+_counters = {}
+# {(name, ((label, value), ...)): [bucket count, ..., +Inf bucket count, sum]}
+_histograms = {}
+# Identifies this process' snapshot file. Reset after a fork
+_pid = None
+_snapshot_name = None
+_last_flush = 0
+
+
+def _check_process():
+    # Values recorded before a fork belong to the parent
+    global _pid, _snapshot_name
+    if _pid != os.getpid():
+        _counters.clear()
+        _histograms.clear()
+        _pid = os.getpid()
+        _snapshot_name = 'taxii-metrics-%s-%s.json' % (_pid, uuid.uuid4().hex)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.iteritems()))
+
+
+def inc(name, amount=1, **labels):
+    """
+    Adds amount to the counter name with the given labels
+    """
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + amount
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    """
+    Adds value to the histogram name with the given labels
+    """
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(DURATION_BUCKETS)
+        histogram[i] += 1
+        histogram[-1] += value
+    _maybe_flush()
+
+
+def cache_lookup(cache_name, hit):
+    """
+    Counts a lookup in the cache called cache_name
+    """
+    inc(CACHE_LOOKUPS, cache=cache_name, result='hit' if hit else 'miss')
+
+
+def snapshot():
+    """
+    Returns this process' values as a JSON-serializable dict
+    """
+    with _lock:
+        _check_process()
+        return {'counters': [[name, labels, value] for (name, labels), value in _counters.iteritems()],
+                'histograms': [[name, labels, list(values)] for (name, labels), values in _histograms.iteritems()]}
+
+
+def flush():
+    """
+    Writes this process' snapshot to TAXII_SERVICES_METRICS_DIR, if it is set
+    """
+    global _last_flush
+    metrics_dir = getattr(settings, 'TAXII_SERVICES_METRICS_DIR', None)
+    if not metrics_dir:
+        return
+
+    data = snapshot()
+    _last_flush = time.time()
+    try:
+        # Write to a temporary file and rename it, so readers never see a partial snapshot
+        fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, os.path.join(metrics_dir, _snapshot_name))
+    except (IOError, OSError):
+        # Metrics must never break request handling
+        logging.getLogger(__name__).exception('Could not write metrics snapshot to %s', metrics_dir)
+
+
+def _maybe_flush():
+    if (getattr(settings, 'TAXII_SERVICES_METRICS_DIR', None) and
+            time.time() - _last_flush >= getattr(settings, 'TAXII_SERVICES_METRICS_FLUSH_INTERVAL', 5)):
+        flush()
+
+
+def _load_snapshots():
+    """
+    Returns the snapshot of every process: this one from memory, the others
+    from TAXII_SERVICES_METRICS_DIR
+    """
+    snapshots = [snapshot()]
+    metrics_dir = getattr(settings, 'TAXII_SERVICES_METRICS_DIR', None)
+    if not metrics_dir:
+        return snapshots
+
+    for filename in os.listdir(metrics_dir):
+        if not filename.startswith('taxii-metrics-') or filename == _snapshot_name:
+            continue
+        try:
+            with open(os.path.join(metrics_dir, filename)) as f:
+                snapshots.append(json.load(f))
+        except (IOError, ValueError):
+            continue  # Removed or being replaced; skip it this time
+    return snapshots
+
+
+def collect():
+    """
+    Adds up the snapshots of every process.
+
+    Returns:
+        A tuple of ({(name, labels): value}, {(name, labels): histogram values})
+    """
+    counters = {}
+    histograms = {}
+    for data in _load_snapshots():
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in data['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            totals = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+    return counters, histograms
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """
+    Renders the values of every process in the Prometheus text
+    exposition format (version 0.0.4)
+    """
+    counters, histograms = collect()
+
+    # Derived from CACHE_LOOKUPS, for convenience
+    lookups = {}
+    for (name, labels), value in counters.iteritems():
+        if name == CACHE_LOOKUPS:
+            labels = dict(labels)
+            hits_total = lookups.setdefault(labels['cache'], [0, 0])
+            hits_total[1] += value
+            if labels['result'] == 'hit':
+                hits_total[0] += value
+
+    lines = []
+    for name in sorted(METRICS):
+        metric_type, help_text = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        if metric_type == COUNTER:
+            for (n, labels), value in sorted(counters.iteritems()):
+                if n == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        else:
+            for (n, labels), values in sorted(histograms.iteritems()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ('+Inf', ), values[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (name, _format_labels(labels + (('le', bound), )), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(values[-1])))
+                lines.append('%s_count%s %s' % (name, _format_labels(labels), cumulative))
+
+    lines.append('# HELP taxii_cache_hit_ratio Fraction of cache lookups that were hits.')
+    lines.append('# TYPE taxii_cache_hit_ratio gauge')
+    for cache_name, (hits, total) in sorted(lookups.iteritems()):
+        lines.append('taxii_cache_hit_ratio%s %s' % (_format_labels((('cache', cache_name), )),
+                                                      repr(float(hits) / total)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Throws away this process' values
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
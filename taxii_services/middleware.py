@@ -9,8 +9,9 @@ from django.conf import settings
 from django.http import HttpResponse, HttpResponseServerError
 from libtaxii.constants import *
 
-from taxii_services import handlers
+from taxii_services import handlers, metrics
 from taxii_services.exceptions import StatusMessageException
+from taxii_services.util import timing
 
 
 class StatusMessageExceptionMiddleware(object):
@@ -32,6 +33,12 @@ class StatusMessageExceptionMiddleware(object):
         if not isinstance(exception, StatusMessageException):
             return None  # This class only handles StatusMessageExceptions
 
+        request_metrics = getattr(request, 'taxii_metrics', {})
+        metrics.inc(metrics.REQUESTS,
+                    service=request_metrics.get('service_path', ''),
+                    message_type=request_metrics.get('message_type', ''),
+                    status_type=exception.status_type)
+
         version = None
 
         a = request.META.get('HTTP_ACCEPT', None)
@@ -66,4 +73,8 @@ class StatusMessageExceptionMiddleware(object):
             version = VID_TAXII_SERVICES_11
 
         response_headers = handlers.get_headers(version, request.is_secure())
-        return handlers.HttpResponseTaxii(sm.to_xml(pretty_print=True), response_headers)
+        response = handlers.HttpResponseTaxii(sm.to_xml(pretty_print=True),
+                                              response_headers,
+                                              content_encoding=handlers.get_content_encoding(request))
+        timing.set_server_timing_header(response, request)
+        return response
@@ -3,22 +3,34 @@
 
 from __future__ import absolute_import
 
+from datetime import timedelta
 from importlib import import_module
-from itertools import chain
+from itertools import chain, count
+import logging
+import struct
 import sys
+from timeit import default_timer
 import uuid
+from xml.sax.saxutils import quoteattr
+import zlib
 
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Max, Min, Q, Sum, Value, When
+from django.db.models.functions import Length
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.utils import timezone
 from libtaxii import validation
-from libtaxii.common import generate_message_id
+from libtaxii.common import generate_message_id, parse
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
 import libtaxii.messages_11 as tm11
 import libtaxii.taxii_default_query as tdq
+from lxml import etree
 
+from taxii_services import metrics
 from taxii_services.exceptions import StatusMessageException
 
 MAX_NAME_LENGTH = 255
@@ -122,6 +134,44 @@ ALLOWED_SCOPE = ('ALLOWED', 'Allowed')
 #: Tuple of scope choices
 SCOPE_CHOICES = (PREFERRED_SCOPE, ALLOWED_SCOPE)
 
+#: Validate every request against the TAXII XML Schema
+VALIDATE_FULL = ('FULL', 'Full schema validation')
+#: Only check that requests are well-formed XML
+VALIDATE_WELL_FORMED = ('WELL_FORMED', 'Well-formedness only')
+#: Schema validate every Nth request, check the rest for well-formedness
+VALIDATE_SAMPLED = ('SAMPLED', 'Sampled schema validation')
+#: Tuple of all validation modes
+VALIDATION_CHOICES = (VALIDATE_FULL, VALIDATE_WELL_FORMED, VALIDATE_SAMPLED)
+#: Recorded (not selectable) when a request from a trusted client is not validated
+VALIDATION_SKIPPED = 'SKIPPED'
+
+#: Build each Poll Response from the Result Set Part's Content Blocks
+RENDER_NEVER = ('NEVER', 'Never')
+#: Render a Result Set Part's Poll Response the first time it is requested
+RENDER_LAZY = ('LAZY', 'When first requested')
+#: Render the Poll Response of every part when the Result Set is created
+RENDER_EAGER = ('EAGER', 'When the Result Set is created')
+#: Tuple of Result Set Part rendering choices
+RENDER_CHOICES = (RENDER_NEVER, RENDER_LAZY, RENDER_EAGER)
+
+#: The Poll Job is waiting for a worker
+POLL_JOB_PENDING = ('PENDING', 'Pending')
+#: A worker is running the Poll Job
+POLL_JOB_RUNNING = ('RUNNING', 'Running')
+#: The Poll Job's Result Set is ready
+POLL_JOB_DONE = ('DONE', 'Done')
+#: The Poll Job raised an error
+POLL_JOB_FAILED = ('FAILED', 'Failed')
+#: Tuple of Poll Job statuses
+POLL_JOB_STATUS_CHOICES = (POLL_JOB_PENDING, POLL_JOB_RUNNING, POLL_JOB_DONE, POLL_JOB_FAILED)
+#: Seconds a Poll Job may run before it's assumed that its worker died
+POLL_JOB_TIMEOUT = 3600
+
+#: How long Result Sets are kept when their Poll Service doesn't say
+RESULT_SET_LIFETIME = timedelta(days=7)
+#: The number of rows ResultSet.delete_expired deletes per statement
+RESULT_SET_REAP_BATCH_SIZE = 500
+
 
 # TODO: Can SupportInfo be moved somewhere else that makes more sense?
 
@@ -183,18 +233,10 @@ class Handler(models.Model):
     def get_handler_class(self):
         """
         Returns:
-            An handle on the handler class
+            An handle on the handler class, resolved through the
+            process-wide handler registry (see resolve_handler)
         """
-
-        if (self.module_name is None or
-                    len(self.module_name) == 0 or
-                    self.class_name is None or
-                    len(self.class_name) == 0):
-            self.clean()
-
-        module = import_module(self.module_name)
-        handler_class = getattr(module, self.class_name)
-        return handler_class
+        return resolve_handler(self.handler)
 
     def clean(self):
         """
@@ -247,6 +289,52 @@ class Handler(models.Model):
         ordering = ['name']
 
 
+# Process-wide registry of {handler string: handler class}. Entries are added
+# on first use and dropped whenever a Handler model changes.
+_handler_registry = {}
+
+
+def resolve_handler(handler_string):
+    """
+    Resolves a handler string (e.g., 'taxii_services.message_handlers.PollRequestHandler')
+    to its class, importing the handler's module only the first time the
+    handler string is seen.
+
+    Arguments:
+        handler_string (str) - The dotted path of the handler class
+
+    Returns:
+        The handler class
+    """
+    try:
+        handler_class = _handler_registry[handler_string]
+        metrics.cache_lookup('handler_registry', True)
+        return handler_class
+    except KeyError:
+        metrics.cache_lookup('handler_registry', False)
+
+    module_name, class_name = handler_string.rsplit('.', 1)
+    try:
+        module = import_module(module_name)
+        handler_class = getattr(module, class_name)
+    except Exception as e:
+        type_, value, traceback = sys.exc_info()
+        raise type_, ("Error importing handler: %s" % handler_string, type_, value), traceback
+
+    _handler_registry[handler_string] = handler_class
+    return handler_class
+
+
+def invalidate_handler_registry(sender, **kwargs):
+    """
+    Empties the handler registry. Connected to the post_save and
+    post_delete signals of each Handler subclass. The whole registry is
+    emptied because the saved row's previous handler string isn't known
+    (e.g., after a rename).
+    """
+    _handler_registry.clear()
+
+
 class Tag(models.Model):
     """
     Not to be used by users directly. Defines common tags used for certain other models.
@@ -274,6 +362,10 @@ def get_protocol(binding_id):
         raise ValueError("Unknown Protocol Binding ID %s" % binding_id)
 
 
+# Per-process request counters for sampled validation, keyed by service pk
+_validation_counters = {}
+
+
 class TaxiiService(models.Model):
     """
     Not to be used by users directly. Defines common fields that all
@@ -286,9 +378,67 @@ class TaxiiService(models.Model):
     supported_message_bindings = models.ManyToManyField('MessageBinding')
     supported_protocol_bindings = models.ManyToManyField('ProtocolBinding')
     enabled = models.BooleanField(default=True)
+    validation_mode = models.CharField(max_length=MAX_NAME_LENGTH, choices=VALIDATION_CHOICES,
+                                       default=VALIDATE_FULL[0])
+    validation_sample_rate = models.PositiveIntegerField(default=100,
+                                                         help_text='In sampled mode, every Nth request '
+                                                                   'is schema validated')
+    trusted_clients = models.TextField(blank=True,
+                                       help_text='Client addresses or certificate subjects whose requests '
+                                                 'are not validated. One per line')
+    pretty_print = models.BooleanField(default=True,
+                                       help_text='Indent response XML. Turn off for smaller, faster responses')
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
+    def clean(self):
+        if self.validation_mode == VALIDATE_SAMPLED[0] and not self.validation_sample_rate:
+            raise ValidationError('Validation Sample Rate must be at least 1 for sampled validation.')
+
+    def get_trusted_clients(self):
+        """
+        Returns:
+            The set of trusted client addresses and certificate subjects
+        """
+        return set(line.strip() for line in self.trusted_clients.splitlines() if line.strip())
+
+    def is_trusted_client(self, django_request):
+        """
+        Returns True if the client that sent django_request is listed
+        in trusted_clients, either by address or by the subject of the
+        client certificate (read from the request META key named by
+        the TAXII_SERVICES_CLIENT_CERT_META_KEY setting).
+        """
+        trusted_clients = self.get_trusted_clients()
+        if not trusted_clients:
+            return False
+
+        if django_request.META.get('REMOTE_ADDR') in trusted_clients:
+            return True
+
+        cert_meta_key = getattr(settings, 'TAXII_SERVICES_CLIENT_CERT_META_KEY', 'SSL_CLIENT_S_DN')
+        return django_request.META.get(cert_meta_key) in trusted_clients
+
+    def get_validation_mode(self, django_request):
+        """
+        Applies this service's validation policy to django_request.
+
+        Returns:
+            VALIDATE_FULL[0] if the request should be schema validated,
+            VALIDATE_WELL_FORMED[0] if it only needs to be well-formed, or
+            VALIDATION_SKIPPED if it comes from a trusted client.
+        """
+        if self.trusted_clients and self.is_trusted_client(django_request):
+            return VALIDATION_SKIPPED
+
+        if self.validation_mode == VALIDATE_SAMPLED[0]:
+            counter = _validation_counters.setdefault(self.pk, count())
+            if next(counter) % max(self.validation_sample_rate, 1) == 0:
+                return VALIDATE_FULL[0]
+            return VALIDATE_WELL_FORMED[0]
+
+        return self.validation_mode
+
     def build_service_address(self, binding_id):
         """
         Build the service URL for a given binding ID
@@ -398,6 +548,7 @@ class CollectionManagementService(TaxiiService):
                                      message="Message not supported by this service")
 
     def clean(self):
+        super(CollectionManagementService, self).clean()
         if (not self.collection_information_handler and
                 not self.subscription_management_handler):
             raise ValidationError('At least one of Collection Information Handler or \
@@ -572,9 +723,32 @@ post_save.connect(update_content_binding, sender=ContentBinding)
 post_save.connect(update_content_binding_subtype, sender=ContentBindingSubtype)
 
 
+#: The objects that ContentBlock.to_content_block_10 and to_content_block_11
+#: reach through. Content Blocks read for Poll Responses are fetched with
+#: select_related(*CONTENT_BLOCK_SELECT_RELATED), so that building a Poll
+#: Response doesn't cost extra queries per Content Block
+CONTENT_BLOCK_SELECT_RELATED = ('content_binding_and_subtype__content_binding',
+                                'content_binding_and_subtype__subtype')
+
+#: {ContentBlock XML fragment field: the method that returns its libtaxii Content Block}
+XML_FRAGMENT_FIELDS = {'xml_fragment_10': 'to_content_block_10',
+                       'xml_fragment_11': 'to_content_block_11'}
+#: The ContentBlock fields that the XML fragments are built from
+XML_FRAGMENT_SOURCE_FIELDS = frozenset(['content', 'padding', 'timestamp_label', 'content_binding_and_subtype'])
+# Content Blocks whose fragments are saved per UPDATE query. Each one takes
+# three query parameters, which keeps queries within every database's limits
+XML_FRAGMENT_UPDATE_SIZE = 100
+
+
 class ContentBlock(models.Model):
     """
     Model for a Content Block
+
+    The serialized <Content_Block> elements of a Content Block are cached in
+    xml_fragment_11 and xml_fragment_10 the first time it is polled, so that
+    later Poll Responses don't have to parse and serialize its content again
+    (see get_xml_fragment_11). Saving a Content Block discards them, unless
+    update_fields leaves out every field in XML_FRAGMENT_SOURCE_FIELDS.
     """
     message = models.TextField(blank=True)
 
@@ -583,10 +757,74 @@ class ContentBlock(models.Model):
     content_binding_and_subtype = models.ForeignKey('ContentBindingAndSubtype')
     content = models.TextField()
     padding = models.TextField(blank=True)
+    xml_fragment_11 = models.TextField(blank=True, null=True)
+    xml_fragment_10 = models.TextField(blank=True, null=True)
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        # The cached XML fragments may no longer match the Content Block
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            self.xml_fragment_11 = None
+            self.xml_fragment_10 = None
+        elif XML_FRAGMENT_SOURCE_FIELDS.intersection(update_fields):
+            self.xml_fragment_11 = None
+            self.xml_fragment_10 = None
+            kwargs['update_fields'] = set(update_fields).union(XML_FRAGMENT_FIELDS)
+        super(ContentBlock, self).save(*args, **kwargs)
+
+    def get_xml_fragment(self, field):
+        """
+        Returns the Content_Block element cached in field (xml_fragment_10
+        or xml_fragment_11) as a unicode string, serializing it first if
+        needed. A newly serialized fragment is not saved; see get_xml_fragments.
+        """
+        fragment = getattr(self, field)
+        if fragment is None:
+            to_content_block = getattr(self, XML_FRAGMENT_FIELDS[field])
+            fragment = etree.tostring(to_content_block().to_etree(), encoding=unicode)
+            setattr(self, field, fragment)
+        return fragment
+
+    @staticmethod
+    def get_xml_fragments(content_blocks, field):
+        """
+        Returns the Content_Block elements cached in field (xml_fragment_10
+        or xml_fragment_11) of a list of ContentBlock objects. Fragments that
+        had to be serialized are saved with one UPDATE query per
+        XML_FRAGMENT_UPDATE_SIZE Content Blocks.
+        """
+        missing = [content_block for content_block in content_blocks if getattr(content_block, field) is None]
+        fragments = [content_block.get_xml_fragment(field) for content_block in content_blocks]
+        for i in range(0, len(missing), XML_FRAGMENT_UPDATE_SIZE):
+            chunk = missing[i: i + XML_FRAGMENT_UPDATE_SIZE]
+            # A Content Block that was saved since it was read keeps its fragment (or lack of one):
+            # this one was built from the old content
+            fragment_cases = Case(*[When(pk=cb.pk, date_updated=cb.date_updated, then=Value(getattr(cb, field)))
+                                    for cb in chunk],
+                                  default=F(field), output_field=models.TextField())
+            ContentBlock.objects.filter(pk__in=[cb.pk for cb in chunk], **{field + '__isnull': True}).update(
+                **{field: fragment_cases})
+        return fragments
+
+    def get_xml_fragment_10(self):
+        """
+        Returns:
+            The TAXII 1.0 Content_Block element for this Content Block, as
+            a unicode string
+        """
+        return ContentBlock.get_xml_fragments([self], 'xml_fragment_10')[0]
+
+    def get_xml_fragment_11(self):
+        """
+        Returns:
+            The TAXII 1.1 Content_Block element for this Content Block, as
+            a unicode string
+        """
+        return ContentBlock.get_xml_fragments([self], 'xml_fragment_11')[0]
+
     def to_content_block_10(self):
         """
         Returns a tm10.ContentBlock
@@ -699,6 +937,92 @@ class ContentBlock(models.Model):
         verbose_name = "Content Block"
 
 
+# Marks where the Content Block fragments go in a serialized Poll Response
+FRAGMENTS_MARKER = 'content-block-fragments'
+#: The number of Content Block fragments in each chunk of a streamed Poll Response
+STREAM_CHUNK_SIZE = 100
+
+
+class FragmentPollResponseMixin(object):
+    """
+    Mixin for Poll Responses that can hold models.ContentBlock objects, in
+    content_block_models, as well as libtaxii Content Blocks, in
+    content_blocks. to_xml() writes the cached XML fragment of each model
+    (see ContentBlock.get_xml_fragment_11) after the libtaxii Content Blocks,
+    which is where Content Blocks go in both TAXII 1.0 and 1.1 Poll Responses.
+
+    A Poll Response can also be given a queryset of Content Blocks, in
+    content_block_queryset, whose fragments come last. iter_xml() yields the
+    XML in chunks while it reads the queryset with iterator(), so neither
+    the Content Blocks nor the whole XML are ever held in memory (see
+    views.service_router, which streams such Poll Responses). Fragments
+    serialized for the queryset's Content Blocks are not saved.
+    """
+
+    #: The ContentBlock field that caches the fragment
+    fragment_field = None
+
+    def __init__(self, *args, **kwargs):
+        super(FragmentPollResponseMixin, self).__init__(*args, **kwargs)
+        self.content_block_models = []
+        self.content_block_queryset = None
+        self.streamed_content_block_count = 0
+
+    @property
+    def content_block_count(self):
+        """
+        The number of Content Blocks in the Poll Response. Content Blocks
+        from content_block_queryset are counted as iter_xml() writes them
+        """
+        return len(self.content_blocks) + len(self.content_block_models) + self.streamed_content_block_count
+
+    def iter_xml(self, pretty_print=False):
+        """
+        Yields the UTF-8 encoded XML of the Poll Response in chunks
+        """
+        xml = super(FragmentPollResponseMixin, self).to_etree()
+        xml.append(etree.Comment(FRAGMENTS_MARKER))
+        head, tail = etree.tostring(xml, pretty_print=pretty_print, encoding='utf-8').split(
+            '<!--%s-->' % FRAGMENTS_MARKER)
+        fragments = ContentBlock.get_xml_fragments(self.content_block_models, self.fragment_field)
+        yield head + ''.join(fragment.encode('utf-8') for fragment in fragments)
+
+        if self.content_block_queryset is not None:
+            self.streamed_content_block_count = 0
+            chunk = []
+            for content_block in self.content_block_queryset.iterator():
+                chunk.append(content_block.get_xml_fragment(self.fragment_field).encode('utf-8'))
+                if len(chunk) == STREAM_CHUNK_SIZE:
+                    self.streamed_content_block_count += len(chunk)
+                    yield ''.join(chunk)
+                    chunk = []
+            if chunk:
+                self.streamed_content_block_count += len(chunk)
+                yield ''.join(chunk)
+
+        yield tail
+
+    def to_xml(self, pretty_print=False):
+        return ''.join(self.iter_xml(pretty_print))
+
+    def to_etree(self):
+        return parse(self.to_xml())
+
+
+class FragmentPollResponse10(FragmentPollResponseMixin, tm10.PollResponse):
+    """
+    A tm10.PollResponse whose content_block_models are written as cached XML fragments
+    """
+    fragment_field = 'xml_fragment_10'
+
+
+class FragmentPollResponse11(FragmentPollResponseMixin, tm11.PollResponse):
+    """
+    A tm11.PollResponse whose content_block_models are written as cached XML fragments
+    """
+    fragment_field = 'xml_fragment_11'
+
+
 class DataCollection(models.Model):
     """
     Model for a TAXII Data Collection
@@ -860,7 +1184,7 @@ class DataCollection(models.Model):
                                         push_methods=self.get_push_methods_11(),
                                         polling_service_instances=self.get_polling_service_instances_11(),
                                         subscription_methods=self.get_subscription_methods_11(),
-                                        collection_volume=None,  # TODO: Maybe add this to the model?
+                                        collection_volume=self.get_statistics().total_content_blocks,
                                         collection_type=self.type,
                                         receiving_inbox_services=self.get_receiving_inbox_services_11())
         return ci
@@ -916,11 +1240,12 @@ class DataCollection(models.Model):
 
     def get_push_methods_11(self):
         """
-        TODO: Implement this.
-        This depends on the ability of taxii_services to push content
-        and includes client capabilities
+        Returns:
+            A list of tm11.PushMethod objects for the protocols and
+            message bindings that taxii_services.push can deliver with
         """
-        return None
+        return [tm11.PushMethod(push_protocol=protocol, push_message_bindings=[VID_TAXII_XML_11])
+                for protocol in (VID_TAXII_HTTP_10, VID_TAXII_HTTPS_10)]
 
     def get_polling_service_instances_10(self):
         """
@@ -1016,6 +1341,36 @@ class DataCollection(models.Model):
 
         return receiving_inbox_services
 
+    def filter_content_blocks(self, *conditions, **query_kwargs):
+        """
+        Returns a queryset of this Data Collection's Content Blocks in
+        (timestamp_label, id) order. The Content Blocks are found through
+        CollectionMembership, so that the database can use its indexes.
+
+        Lookups in query_kwargs on the fields in MEMBERSHIP_FIELDS are made
+        on CollectionMembership; other lookups are made on the Content Blocks.
+        conditions are Q objects, and must name CollectionMembership fields
+        with the MEMBERSHIP_LOOKUP prefix. All of them are applied in a single
+        filter() so that they refer to the same CollectionMembership.
+        """
+        kwargs = {MEMBERSHIP_LOOKUP + 'data_collection': self}
+        for lookup, value in query_kwargs.iteritems():
+            if lookup.split('__')[0] in MEMBERSHIP_FIELDS:
+                lookup = MEMBERSHIP_LOOKUP + lookup
+            kwargs[lookup] = value
+        return ContentBlock.objects.filter(*conditions, **kwargs).order_by(*MEMBERSHIP_ORDERING)
+
+    def get_statistics(self):
+        """
+        Returns:
+            The DataCollectionStatistics of this Data Collection, building
+            them if they don't exist yet
+        """
+        statistics = DataCollectionStatistics.objects.filter(data_collection=self).first()
+        if statistics is None:
+            statistics = rebuild_collection_statistics(self.pk)
+        return statistics
+
     def __unicode__(self):
         return u'%s (%s)' % (self.name, self.type)
 
@@ -1024,6 +1379,411 @@ class DataCollection(models.Model):
         verbose_name = "Data Collection"
 
 
+class DataCollectionStatistics(models.Model):
+    """
+    Model for the statistics of a Data Collection's Content Blocks.
+
+    The statistics are updated, in the same transaction, whenever Content
+    Blocks are added to or removed from the Data Collection and whenever a
+    Content Block in it is changed or deleted (see update_collection_statistics
+    and move_collection_statistics). Changes that don't send signals (e.g.,
+    queryset updates) are not seen; use rebuild_collection_statistics then.
+    """
+    data_collection = models.OneToOneField('DataCollection', related_name='statistics')
+    total_content_blocks = models.BigIntegerField(default=0)
+    # Measured in characters of content, which is bytes for ASCII content
+    bytes_stored = models.BigIntegerField(default=0)
+    min_timestamp_label = models.DateTimeField(blank=True, null=True)
+    max_timestamp_label = models.DateTimeField(blank=True, null=True)
+
+    def count_content_blocks(self, content_bindings=None):
+        """
+        Returns:
+            The number of Content Blocks in the Data Collection, or, if
+            content_bindings (ContentBindingAndSubtype objects) is not
+            empty, the number of them with one of those bindings
+        """
+        if not content_bindings:
+            return self.total_content_blocks
+        counts = self.content_binding_counts.filter(content_binding_and_subtype__in=content_bindings)
+        return counts.aggregate(total=Sum('count'))['total'] or 0
+
+    def __unicode__(self):
+        return u'%s: %s Content Blocks' % (self.data_collection.name, self.total_content_blocks)
+
+    class Meta:
+        verbose_name = "Data Collection Statistics"
+        verbose_name_plural = "Data Collection Statistics"
+
+
+class ContentBindingCount(models.Model):
+    """
+    Model for the number of Content Blocks with a given Content Binding in a
+    Data Collection. Part of DataCollectionStatistics.
+    """
+    statistics = models.ForeignKey('DataCollectionStatistics', related_name='content_binding_counts')
+    content_binding_and_subtype = models.ForeignKey('ContentBindingAndSubtype')
+    count = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.content_binding_and_subtype, self.count)
+
+    class Meta:
+        verbose_name = "Content Binding Count"
+        unique_together = ('statistics', 'content_binding_and_subtype',)
+
+
+# Keeps the number of query parameters within every database's limits
+STATISTICS_CHUNK_SIZE = 500
+#: The ContentBlock fields that DataCollectionStatistics are computed from
+STATISTICS_FIELDS = frozenset(['timestamp_label', 'content_binding_and_subtype', 'content'])
+
+
+def _aggregate_content_blocks(content_blocks):
+    """
+    Returns a tuple of (totals, {ContentBindingAndSubtype id: count}) for a
+    queryset of Content Blocks. totals is a dict of count, bytes, min and max.
+    """
+    totals = content_blocks.aggregate(count=Count('id'),
+                                      bytes=Sum(Length('content')),
+                                      min=Min('timestamp_label'),
+                                      max=Max('timestamp_label'))
+    binding_counts = dict(content_blocks.order_by().values_list('content_binding_and_subtype')
+                          .annotate(Count('id')))
+    return totals, binding_counts
+
+
+def rebuild_collection_statistics(collection_id, exclude_ids=()):
+    """
+    Recomputes the DataCollectionStatistics of a Data Collection from its
+    Content Blocks, leaving out the Content Blocks whose ids are in exclude_ids.
+
+    Returns:
+        The new DataCollectionStatistics object
+    """
+    with transaction.atomic():
+        DataCollectionStatistics.objects.filter(data_collection_id=collection_id).delete()
+        content_blocks = ContentBlock.objects.filter(datacollection__pk=collection_id).exclude(pk__in=exclude_ids)
+        totals, binding_counts = _aggregate_content_blocks(content_blocks)
+        statistics = DataCollectionStatistics.objects.create(data_collection_id=collection_id,
+                                                             total_content_blocks=totals['count'],
+                                                             bytes_stored=totals['bytes'] or 0,
+                                                             min_timestamp_label=totals['min'],
+                                                             max_timestamp_label=totals['max'])
+        ContentBindingCount.objects.bulk_create(
+            ContentBindingCount(statistics=statistics, content_binding_and_subtype_id=cbas_id, count=count)
+            for cbas_id, count in binding_counts.iteritems())
+    return statistics
+
+
+def update_collection_statistics(collection_id, content_block_ids, removed=False):
+    """
+    Adds the Content Blocks whose ids are in content_block_ids to the
+    DataCollectionStatistics of a Data Collection or, if removed is True,
+    subtracts them. The Content Blocks must still exist in the database.
+    """
+    content_block_ids = list(content_block_ids)
+    with transaction.atomic():
+        statistics = DataCollectionStatistics.objects.select_for_update().filter(
+            data_collection_id=collection_id).first()
+        if statistics is None:
+            rebuild_collection_statistics(collection_id, content_block_ids if removed else ())
+            return
+
+        count, bytes_stored, min_label, max_label, binding_counts = 0, 0, None, None, {}
+        for i in range(0, len(content_block_ids), STATISTICS_CHUNK_SIZE):
+            chunk = ContentBlock.objects.filter(pk__in=content_block_ids[i: i + STATISTICS_CHUNK_SIZE])
+            totals, chunk_binding_counts = _aggregate_content_blocks(chunk)
+            count += totals['count']
+            bytes_stored += totals['bytes'] or 0
+            if totals['count']:
+                min_label = min(min_label or totals['min'], totals['min'])
+                max_label = max(max_label or totals['max'], totals['max'])
+            for cbas_id, cbas_count in chunk_binding_counts.iteritems():
+                binding_counts[cbas_id] = binding_counts.get(cbas_id, 0) + cbas_count
+        if not count:
+            return
+
+        sign = -1 if removed else 1
+        statistics.total_content_blocks += sign * count
+        statistics.bytes_stored += sign * bytes_stored
+        if not removed:
+            if statistics.min_timestamp_label is None or min_label < statistics.min_timestamp_label:
+                statistics.min_timestamp_label = min_label
+            if statistics.max_timestamp_label is None or max_label > statistics.max_timestamp_label:
+                statistics.max_timestamp_label = max_label
+        elif min_label <= statistics.min_timestamp_label or max_label >= statistics.max_timestamp_label:
+            # The oldest or newest Content Block is going away; find the new one
+            remaining = ContentBlock.objects.filter(datacollection__pk=collection_id).exclude(pk__in=content_block_ids)
+            bounds = remaining.aggregate(min=Min('timestamp_label'), max=Max('timestamp_label'))
+            statistics.min_timestamp_label = bounds['min']
+            statistics.max_timestamp_label = bounds['max']
+        statistics.save()
+
+        counts = dict((c.content_binding_and_subtype_id, c)
+                      for c in statistics.content_binding_counts.filter(content_binding_and_subtype__in=list(binding_counts)))
+        for cbas_id, cbas_count in binding_counts.iteritems():
+            binding_count = counts.get(cbas_id)
+            if binding_count is None:
+                binding_count = ContentBindingCount(statistics=statistics, content_binding_and_subtype_id=cbas_id)
+            binding_count.count += sign * cbas_count
+            if binding_count.count > 0:
+                binding_count.save()
+            elif binding_count.pk:
+                binding_count.delete()
+
+
+def move_collection_statistics(collection_id, before, after):
+    """
+    Moves a changed Content Block in the DataCollectionStatistics of a Data
+    Collection from its old (timestamp_label, content_binding_and_subtype
+    id, content length) to its new ones. The Content Block must already be
+    saved with the new ones.
+    """
+    old_label, old_cbas_id, old_size = before
+    new_label, new_cbas_id, new_size = after
+    with transaction.atomic():
+        statistics = DataCollectionStatistics.objects.select_for_update().filter(
+            data_collection_id=collection_id).first()
+        if statistics is None:
+            rebuild_collection_statistics(collection_id)
+            return
+
+        statistics.bytes_stored += (new_size or 0) - (old_size or 0)
+        if new_label != old_label:
+            if old_label in (statistics.min_timestamp_label, statistics.max_timestamp_label):
+                # The oldest or newest Content Block may have moved inwards; find the new one
+                content_blocks = ContentBlock.objects.filter(datacollection__pk=collection_id)
+                bounds = content_blocks.aggregate(min=Min('timestamp_label'), max=Max('timestamp_label'))
+                statistics.min_timestamp_label = bounds['min']
+                statistics.max_timestamp_label = bounds['max']
+            else:
+                statistics.min_timestamp_label = min(statistics.min_timestamp_label, new_label)
+                statistics.max_timestamp_label = max(statistics.max_timestamp_label, new_label)
+        statistics.save()
+
+        if new_cbas_id != old_cbas_id:
+            counts = statistics.content_binding_counts
+            old_count = counts.filter(content_binding_and_subtype_id=old_cbas_id).first()
+            if old_count is not None:
+                old_count.count -= 1
+                if old_count.count > 0:
+                    old_count.save()
+                else:
+                    old_count.delete()
+            new_count, created = counts.get_or_create(content_binding_and_subtype_id=new_cbas_id)
+            new_count.count += 1
+            new_count.save()
+
+
+def _get_statistics_fields(content_block_id):
+    """
+    Returns the (timestamp_label, content_binding_and_subtype id, content
+    length) of a saved Content Block, or None if it isn't saved
+    """
+    content_blocks = ContentBlock.objects.filter(pk=content_block_id).annotate(size=Length('content'))
+    return content_blocks.values_list('timestamp_label', 'content_binding_and_subtype_id', 'size').first()
+
+
+def remember_statistics_fields(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Records the statistics fields of a Content Block that is about to be
+    changed, for update_statistics_on_content_block_save
+    """
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not STATISTICS_FIELDS.intersection(update_fields):
+        return
+    instance._statistics_fields = _get_statistics_fields(instance.pk)
+
+
+def update_statistics_on_content_block_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Moves a changed Content Block in the DataCollectionStatistics of the
+    Data Collections it is in
+    """
+    before = instance.__dict__.pop('_statistics_fields', None)
+    if created or raw or before is None:
+        return
+    after = _get_statistics_fields(instance.pk)
+    if after == before:
+        return
+    through = DataCollection.content_blocks.through
+    for collection_id in through.objects.filter(contentblock_id=instance.pk).values_list('datacollection_id', flat=True):
+        move_collection_statistics(collection_id, before, after)
+
+
+def update_statistics_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keeps DataCollectionStatistics up to date when Content Blocks are added
+    to or removed from a DataCollection, from either side of the relation.
+    """
+    through = DataCollection.content_blocks.through
+    if action == 'post_add':
+        if reverse:  # instance is a ContentBlock
+            for collection_id in pk_set:
+                update_collection_statistics(collection_id, [instance.pk])
+        else:
+            update_collection_statistics(instance.pk, pk_set)
+    elif action in ('pre_remove', 'pre_clear'):
+        # Only the current members change the statistics
+        if reverse:
+            memberships = through.objects.filter(contentblock_id=instance.pk)
+            if action == 'pre_remove':
+                memberships = memberships.filter(datacollection_id__in=pk_set)
+            for collection_id in memberships.values_list('datacollection_id', flat=True):
+                update_collection_statistics(collection_id, [instance.pk], removed=True)
+        elif action == 'pre_remove':
+            memberships = through.objects.filter(datacollection_id=instance.pk, contentblock_id__in=pk_set)
+            update_collection_statistics(instance.pk, memberships.values_list('contentblock_id', flat=True),
+                                         removed=True)
+    elif action == 'post_clear' and not reverse:
+        rebuild_collection_statistics(instance.pk)
+
+
+def update_statistics_on_content_block_delete(sender, instance, **kwargs):
+    """
+    Removes a Content Block that is about to be deleted from the
+    DataCollectionStatistics of the Data Collections it is in.
+    """
+    through = DataCollection.content_blocks.through
+    for collection_id in through.objects.filter(contentblock_id=instance.pk).values_list('datacollection_id', flat=True):
+        update_collection_statistics(collection_id, [instance.pk], removed=True)
+
+
+def create_collection_statistics(sender, instance, created, raw=False, **kwargs):
+    """
+    New Data Collections start with empty statistics
+    """
+    if created and not raw:
+        DataCollectionStatistics.objects.create(data_collection=instance)
+
+
+class CollectionMembership(models.Model):
+    """
+    Model for a Content Block's membership in a Data Collection.
+
+    This is a copy of DataCollection.content_blocks that also holds the
+    Content Block's timestamp_label and content_binding_and_subtype, so that
+    polls of a range of timestamp labels are index range scans (see
+    DataCollection.filter_content_blocks). It is kept up to date by signal
+    receivers; backfill_collection_membership fills it in for Content Blocks
+    that were added to Data Collections before it existed.
+    """
+    data_collection = models.ForeignKey('DataCollection')
+    content_block = models.ForeignKey('ContentBlock')
+    timestamp_label = models.DateTimeField()
+    content_binding_and_subtype = models.ForeignKey('ContentBindingAndSubtype')
+
+    class Meta:
+        verbose_name = "Collection Membership"
+        unique_together = ('data_collection', 'content_block',)
+        index_together = (('data_collection', 'timestamp_label', 'content_block'),
+                          ('data_collection', 'content_binding_and_subtype', 'timestamp_label', 'content_block'))
+
+
+#: The prefix of CollectionMembership lookups made from ContentBlock
+MEMBERSHIP_LOOKUP = 'collectionmembership__'
+#: The ContentBlock fields that are copied to CollectionMembership
+MEMBERSHIP_FIELDS = ('timestamp_label', 'content_binding_and_subtype')
+#: (timestamp_label, id) order, using CollectionMembership's copy of timestamp_label
+MEMBERSHIP_ORDERING = (MEMBERSHIP_LOOKUP + 'timestamp_label', 'id')
+# Memberships created per INSERT query
+MEMBERSHIP_BATCH_SIZE = 500
+
+
+def add_collection_memberships(collection_ids, content_block_ids):
+    """
+    Creates the CollectionMembership of each of content_block_ids in each of collection_ids
+    """
+    content_block_ids = list(content_block_ids)
+    for i in range(0, len(content_block_ids), MEMBERSHIP_BATCH_SIZE):
+        content_blocks = ContentBlock.objects.filter(pk__in=content_block_ids[i: i + MEMBERSHIP_BATCH_SIZE])
+        rows = list(content_blocks.values_list('id', 'timestamp_label', 'content_binding_and_subtype_id'))
+        CollectionMembership.objects.bulk_create(
+            CollectionMembership(data_collection_id=collection_id, content_block_id=content_block_id,
+                                 timestamp_label=timestamp_label, content_binding_and_subtype_id=cbas_id)
+            for collection_id in collection_ids
+            for content_block_id, timestamp_label, cbas_id in rows)
+
+
+def update_memberships_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keeps CollectionMembership in step with DataCollection.content_blocks,
+    from either side of the relation.
+    """
+    if reverse:  # instance is a ContentBlock
+        memberships = CollectionMembership.objects.filter(content_block_id=instance.pk)
+        collection_lookup = 'data_collection_id__in'
+    else:
+        memberships = CollectionMembership.objects.filter(data_collection_id=instance.pk)
+        collection_lookup = 'content_block_id__in'
+
+    if action == 'post_add':
+        if reverse:
+            add_collection_memberships(pk_set, [instance.pk])
+        else:
+            add_collection_memberships([instance.pk], pk_set)
+    elif action == 'post_remove':
+        memberships.filter(**{collection_lookup: pk_set}).delete()
+    elif action == 'post_clear':
+        memberships.delete()
+
+
+def update_memberships_on_content_block_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Copies a changed Content Block's timestamp_label and
+    content_binding_and_subtype to its CollectionMemberships
+    """
+    if not created and not raw:
+        CollectionMembership.objects.filter(content_block_id=instance.pk).update(
+            timestamp_label=instance.timestamp_label,
+            content_binding_and_subtype_id=instance.content_binding_and_subtype_id)
+
+
+def backfill_collection_membership():
+    """
+    Makes CollectionMembership match DataCollection.content_blocks: creates
+    the missing memberships and deletes the ones with no match. Can be run
+    any number of times.
+
+    Returns:
+        A tuple of (memberships created, memberships deleted)
+    """
+    from taxii_services.util import poll_cache  # util imports this module
+
+    through = DataCollection.content_blocks.through
+    created = deleted = 0
+    changed_collection_ids = []
+    for collection_id in DataCollection.objects.values_list('id', flat=True):
+        member_ids = through.objects.filter(datacollection_id=collection_id).values('contentblock_id')
+        collection_deleted = CollectionMembership.objects.filter(data_collection_id=collection_id).exclude(
+            content_block_id__in=member_ids).delete()[0]
+
+        existing_ids = CollectionMembership.objects.filter(data_collection_id=collection_id).values('content_block_id')
+        missing = through.objects.filter(datacollection_id=collection_id).exclude(contentblock_id__in=existing_ids)
+        missing_ids = list(missing.values_list('contentblock_id', flat=True))
+        add_collection_memberships([collection_id], missing_ids)
+
+        if collection_deleted or missing_ids:
+            changed_collection_ids.append(collection_id)
+        created += len(missing_ids)
+        deleted += collection_deleted
+
+    # Neither bulk inserts nor queryset deletes send the signals the Poll Response cache listens to
+    poll_cache.invalidate(changed_collection_ids)
+    return created, deleted
+
+
+m2m_changed.connect(update_statistics_on_membership_change, sender=DataCollection.content_blocks.through)
+m2m_changed.connect(update_memberships_on_membership_change, sender=DataCollection.content_blocks.through)
+post_save.connect(update_memberships_on_content_block_save, sender=ContentBlock)
+pre_save.connect(remember_statistics_fields, sender=ContentBlock)
+post_save.connect(update_statistics_on_content_block_save, sender=ContentBlock)
+pre_delete.connect(update_statistics_on_content_block_delete, sender=ContentBlock)
+post_save.connect(create_collection_statistics, sender=DataCollection)
+
+
 class QueryScope(models.Model):
     """
     Model for Query Scope
@@ -1429,6 +2189,13 @@ class PollService(TaxiiService):
     supported_queries = models.ManyToManyField('SupportedQuery', blank=True)
     requires_subscription = models.BooleanField(default=False)
     max_result_size = models.IntegerField(blank=True, null=True)  # Blank means "no limit"
+    result_set_part_rendering = models.CharField(max_length=MAX_NAME_LENGTH, choices=RENDER_CHOICES,
+                                                 default=RENDER_NEVER[0])
+    result_set_lifetime = models.IntegerField(blank=True, null=True)  # Seconds; blank means RESULT_SET_LIFETIME
+    stream_poll_responses = models.BooleanField(default=False,
+                                                help_text='Send Poll Responses while their Content Blocks are read, '
+                                                          'so that large responses take little memory. TAXII 1.1 '
+                                                          'responses are streamed when Max Result Size is blank')
 
     def clean(self):
         """
@@ -1436,10 +2203,23 @@ class PollService(TaxiiService):
 
         :return: Nothing
         """
+        super(PollService, self).clean()
 
         if self.max_result_size is not None and self.max_result_size < 1:
             raise ValidationError("Max Result Size must be blank or greater than 1!")
 
+        if self.result_set_lifetime is not None and self.result_set_lifetime < 1:
+            raise ValidationError("Result Set Lifetime must be blank or greater than 1!")
+
+    def get_result_set_lifetime(self):
+        """
+        Returns:
+            A timedelta of how long this service's Result Sets are kept
+        """
+        if self.result_set_lifetime is None:
+            return RESULT_SET_LIFETIME
+        return timedelta(seconds=self.result_set_lifetime)
+
     def get_message_handler(self, taxii_message):
         if taxii_message.message_type == MSG_POLL_REQUEST:
             return self.poll_request_handler
@@ -1450,6 +2230,15 @@ class PollService(TaxiiService):
                                      ST_FAILURE,
                                      message="Message not supported by this service")
 
+    def get_result_set_part_response(self, result_set_part, in_response_to):
+        """
+        Returns the tm11.PollResponse for result_set_part, pre-rendered
+        unless result_set_part_rendering is RENDER_NEVER.
+        """
+        if self.result_set_part_rendering == RENDER_NEVER[0]:
+            return result_set_part.to_poll_response_11(in_response_to)
+        return result_set_part.to_rendered_poll_response_11(in_response_to, self.pretty_print)
+
     def validate_collection_name(self, name, in_response_to):
         """
         Arguments:
@@ -1523,7 +2312,7 @@ class PollService(TaxiiService):
                                              status_detail={SD_CAPABILITY_MODULE: ['TBD']})
 
         # Targets have to be checked in software (for now ... ?)
-        list_potential_matches = list(potential_matches)
+        list_potential_matches = list(potential_matches.select_related('query_handler'))
         # print 'looking at targets'
         for target in targets:
             for potential_match in list_potential_matches:
@@ -1641,17 +2430,86 @@ post_save.connect(update_query_handler, sender=QueryHandler)
 class ResultSet(models.Model):
     """
     Model for Result Sets
+
+    The filter parameters of the Poll Request that created the Result Set
+    are kept (frozen) on it, so that ResultSetParts can fetch their Content
+    Blocks when they are requested.
     """
     data_collection = models.ForeignKey('DataCollection')
     subscription = models.ForeignKey('Subscription', blank=True, null=True)
     total_content_blocks = models.IntegerField()
     # TODO: Figure out how to limit choices to only the ResultSetParts that belong to this ResultSet
     last_part_returned = models.ForeignKey('ResultSetPart', blank=True, null=True)
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
+    exclusive_begin_timestamp_label = models.DateTimeField(blank=True, null=True)
+    inclusive_end_timestamp_label = models.DateTimeField(blank=True, null=True)
+    # Empty means all Content Bindings
+    content_bindings = models.ManyToManyField('ContentBindingAndSubtype', blank=True)
     # TODO: There's nothing in here for pushing. It should be added
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
+    def get_content_queryset(self):
+        """
+        Returns:
+            A queryset of the Content Blocks that match this Result Set's
+            frozen filter parameters
+        """
+        return self.data_collection.filter_content_blocks(*self.get_content_conditions())
+
+    def get_content_conditions(self):
+        """
+        Returns:
+            A list of Q objects on CollectionMembership for this Result
+            Set's frozen filter parameters (see DataCollection.filter_content_blocks)
+        """
+        conditions = []
+        if self.exclusive_begin_timestamp_label:
+            conditions.append(Q(**{MEMBERSHIP_LOOKUP + 'timestamp_label__gt': self.exclusive_begin_timestamp_label}))
+        if self.inclusive_end_timestamp_label:
+            conditions.append(Q(**{MEMBERSHIP_LOOKUP + 'timestamp_label__lte': self.inclusive_end_timestamp_label}))
+        content_bindings = list(self.content_bindings.all())
+        if content_bindings:
+            conditions.append(Q(**{MEMBERSHIP_LOOKUP + 'content_binding_and_subtype__in': content_bindings}))
+        return conditions
+
+    @staticmethod
+    def delete_expired(batch_size=RESULT_SET_REAP_BATCH_SIZE, now=None):
+        """
+        Deletes the Result Sets that expired by now (default: the current
+        time), with their parts, Poll Jobs and Content Binding rows.
+
+        Rows are deleted at most batch_size at a time, each batch in its own
+        statement, so the reaper never holds locks for long and can be
+        interrupted at any point: whatever is left is still expired and is
+        deleted on the next run.
+
+        Returns:
+            A dict of {model label: number of rows deleted}
+        """
+        now = now or timezone.now()
+        deleted = {}
+
+        def count(result):
+            for label, rows in result[1].iteritems():
+                deleted[label] = deleted.get(label, 0) + rows
+
+        expired = ResultSet.objects.filter(expires__lte=now).order_by('pk')
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+
+            # Deleting a part would cascade to a Result Set that references it as its last part returned
+            ResultSet.objects.filter(pk__in=ids, last_part_returned__isnull=False).update(last_part_returned=None)
+            parts = ResultSetPart.objects.filter(result_set__in=ids).order_by('pk')
+            while True:
+                part_ids = list(parts.values_list('pk', flat=True)[:batch_size])
+                if not part_ids:
+                    break
+                count(ResultSetPart.objects.filter(pk__in=part_ids).delete())
+            count(ResultSet.objects.filter(pk__in=ids).delete())
+
     def __unicode__(self):
         return u'ResultSet ID: %s; Collection: %s; Parts: %s.' % \
                (self.id, self.data_collection, self.resultsetpart_set.count())
@@ -1660,17 +2518,80 @@ class ResultSet(models.Model):
         verbose_name = "Result Set"
 
 
+def pack_ids(ids):
+    """
+    Packs a list of integer ids into a str of little-endian 64-bit integers
+    """
+    return struct.pack('<%dq' % len(ids), *ids)
+
+
+def unpack_ids(data):
+    """
+    Unpacks a str (or buffer) created by pack_ids
+    """
+    data = bytes(data)
+    return list(struct.unpack('<%dq' % (len(data) // 8), data))
+
+
+# Stand-ins for the message_id and in_response_to of a pre-rendered Poll Response
+RENDERED_MESSAGE_ID = 'rendered-message-id'
+RENDERED_IN_RESPONSE_TO = 'rendered-in-response-to'
+
+
+class RenderedPollResponse(tm11.PollResponse):
+    """
+    A tm11.PollResponse whose XML was rendered ahead of time by
+    ResultSetPart.render_poll_response_11. to_xml() splices a new
+    message_id and in_response_to into the rendered XML instead of
+    serializing the Content Blocks again; the rendered XML's pretty
+    printing is kept.
+    """
+
+    def __init__(self, rendered_xml, in_response_to, content_block_count=0, **kwargs):
+        super(RenderedPollResponse, self).__init__(generate_message_id(), in_response_to, **kwargs)
+        self.rendered_xml = rendered_xml
+        self.content_block_count = content_block_count
+
+    def to_xml(self, pretty_print=False):
+        # The placeholders are attributes of the root element, so they come first.
+        # The rendered XML is UTF-8 encoded
+        xml = self.rendered_xml.replace('message_id="%s"' % RENDERED_MESSAGE_ID,
+                                        'message_id=%s' % quoteattr(unicode(self.message_id)).encode('utf-8'), 1)
+        return xml.replace('in_response_to="%s"' % RENDERED_IN_RESPONSE_TO,
+                           'in_response_to=%s' % quoteattr(unicode(self.in_response_to)).encode('utf-8'), 1)
+
+    def to_etree(self):
+        return tm11.get_message_from_xml(self.to_xml()).to_etree()
+
+
 class ResultSetPart(models.Model):
     """
     Model for Result Set Parts
+
+    A part does not store its Content Blocks. Either it stores the
+    (timestamp_label, id) keys of its first and last Content Block, and its
+    Content Blocks are the ones in that range of its Result Set's content
+    queryset (see ResultSet.get_content_queryset), or, when the Result Set
+    was filtered by a query, it stores the ids of its Content Blocks packed
+    into content_block_ids (see pack_ids).
+
+    When its Poll Service pre-renders Result Set Parts, the part's Poll
+    Response is also kept, zlib compressed, in rendered_poll_response (see
+    render_poll_response_11). Like the Result Set, the rendered response is
+    a snapshot: later changes to its Content Blocks are not reflected.
     """
     result_set = models.ForeignKey('ResultSet')
     part_number = models.IntegerField()
-    content_blocks = models.ManyToManyField('ContentBlock')
     content_block_count = models.IntegerField()
     more = models.BooleanField(default=False)
     exclusive_begin_timestamp_label = models.DateTimeField(blank=True, null=True)
     inclusive_end_timestamp_label = models.DateTimeField(blank=True, null=True)
+    first_timestamp_label = models.DateTimeField(blank=True, null=True)
+    first_content_block_id = models.IntegerField(blank=True, null=True)
+    last_timestamp_label = models.DateTimeField(blank=True, null=True)
+    last_content_block_id = models.IntegerField(blank=True, null=True)
+    content_block_ids = models.BinaryField(blank=True, null=True)
+    rendered_poll_response = models.BinaryField(blank=True, null=True)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -1678,14 +2599,42 @@ class ResultSetPart(models.Model):
         return u'ResultSet ID: %s; Collection: %s; Part#: %s.' % \
                (self.result_set.id, self.result_set.data_collection, self.part_number)
 
+    def get_content_blocks(self):
+        """
+        Returns:
+            A list of this part's ContentBlock objects, in
+            (timestamp_label, id) order, with their
+            CONTENT_BLOCK_SELECT_RELATED objects. Content Blocks deleted
+            since the Result Set was created are left out.
+        """
+        if self.content_block_ids is not None:
+            ids = unpack_ids(self.content_block_ids)
+            content_blocks = {}
+            # Keep the number of query parameters within every database's limits
+            content = ContentBlock.objects.select_related(*CONTENT_BLOCK_SELECT_RELATED)
+            for i in range(0, len(ids), 500):
+                content_blocks.update(content.in_bulk(ids[i: i + 500]))
+            return [content_blocks[id_] for id_ in ids if id_ in content_blocks]
+
+        # The range is on CollectionMembership's copy of the keys, so that it's an index range scan
+        timestamp_label, content_block = MEMBERSHIP_LOOKUP + 'timestamp_label', MEMBERSHIP_LOOKUP + 'content_block'
+        first_timestamp_label, last_timestamp_label = self.first_timestamp_label, self.last_timestamp_label
+        conditions = self.result_set.get_content_conditions() + [
+            Q(**{timestamp_label + '__gt': first_timestamp_label}) |
+            Q(**{timestamp_label: first_timestamp_label, content_block + '__gte': self.first_content_block_id}),
+            Q(**{timestamp_label + '__lt': last_timestamp_label}) |
+            Q(**{timestamp_label: last_timestamp_label, content_block + '__lte': self.last_content_block_id})]
+        content = self.result_set.data_collection.filter_content_blocks(*conditions)
+        return list(content.select_related(*CONTENT_BLOCK_SELECT_RELATED))
+
     def to_poll_response_11(self, in_response_to):
         """
         Returns a tm11.PollResponse based on this model
         """
 
-        poll_response = tm11.PollResponse(message_id=tm11.generate_message_id(),
-                                          in_response_to=in_response_to,
-                                          collection_name=self.result_set.data_collection.name)
+        poll_response = FragmentPollResponse11(message_id=tm11.generate_message_id(),
+                                               in_response_to=in_response_to,
+                                               collection_name=self.result_set.data_collection.name)
 
         if self.exclusive_begin_timestamp_label:
             poll_response.exclusive_begin_timestamp_label = self.exclusive_begin_timestamp_label
@@ -1701,17 +2650,167 @@ class ResultSetPart(models.Model):
         poll_response.result_id = str(self.result_set.pk)
         poll_response.result_part_number = int(self.part_number)
 
-        for content_block in self.content_blocks.all():
-            cb = content_block.to_content_block_11()
-            poll_response.content_blocks.append(cb)
+        poll_response.content_block_models.extend(self.get_content_blocks())
 
         return poll_response
 
+    def render_poll_response_11(self, pretty_print=True):
+        """
+        Renders this part's Poll Response, with placeholders for its
+        message_id and in_response_to, and stores it compressed in
+        rendered_poll_response. Does not save the model.
+        """
+        poll_response = self.to_poll_response_11(RENDERED_IN_RESPONSE_TO)
+        poll_response.message_id = RENDERED_MESSAGE_ID
+        self.rendered_poll_response = zlib.compress(poll_response.to_xml(pretty_print=pretty_print))
+
+    def to_rendered_poll_response_11(self, in_response_to, pretty_print=True):
+        """
+        Returns a RenderedPollResponse for this part, rendering (and saving)
+        it first if it has not been rendered yet.
+        """
+        rendered = self.rendered_poll_response is not None
+        metrics.cache_lookup('rendered_result_set_part', rendered)
+        if not rendered:
+            self.render_poll_response_11(pretty_print)
+            self.save(update_fields=['rendered_poll_response'])
+        return RenderedPollResponse(zlib.decompress(bytes(self.rendered_poll_response)),
+                                    in_response_to,
+                                    collection_name=self.result_set.data_collection.name,
+                                    more=self.more,
+                                    result_id=str(self.result_set_id),
+                                    result_part_number=int(self.part_number),
+                                    content_block_count=self.content_block_count)
+
     class Meta:
         verbose_name = "Result Set Part"
         unique_together = ('result_set', 'part_number',)
 
 
+#: The number of recently finished Poll Jobs that wait estimates are based on
+POLL_JOB_HISTORY = 20
+#: The wait estimate, in seconds, when no Poll Job has finished yet
+POLL_JOB_DEFAULT_WAIT = 300
+
+
+class PollJob(models.Model):
+    """
+    Model for a Poll Request that runs in the background.
+
+    The Poll Request is answered with a Pending Status Message (see
+    PollRequest11Handler.create_pending_response) and a worker (see the
+    run_poll_jobs management command) runs it later, putting its results
+    into result_set. Until then, Poll Fulfillment Requests for result_set
+    are answered with Pending Status Messages.
+    """
+    result_set = models.OneToOneField('ResultSet', related_name='poll_job')
+    poll_service = models.ForeignKey('PollService')
+    #: The dotted path of the PollRequest11Handler (sub)class that runs the job
+    handler = models.CharField(max_length=MAX_NAME_LENGTH)
+    #: The Poll Request, as XML
+    poll_request = models.TextField()
+    status = models.CharField(max_length=MAX_NAME_LENGTH, choices=POLL_JOB_STATUS_CHOICES,
+                              default=POLL_JOB_PENDING[0])
+    #: The estimated cost of the job, in Content Blocks to evaluate
+    cost = models.IntegerField(default=0)
+    #: Seconds the job took to run
+    duration = models.FloatField(blank=True, null=True)
+    #: Why the job failed
+    message = models.TextField(blank=True)
+
+    date_started = models.DateTimeField(blank=True, null=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def get_estimated_wait(self):
+        """
+        Estimates the seconds until this job is done from the time recent jobs
+        took per unit of cost and the cost of the unfinished jobs ahead of (and
+        including) this one.
+        """
+        history = PollJob.objects.filter(status=POLL_JOB_DONE[0]).order_by('-date_finished')
+        history = list(history.values_list('cost', 'duration')[:POLL_JOB_HISTORY])
+        total_cost = sum(cost for cost, duration in history)
+        if not total_cost:
+            return POLL_JOB_DEFAULT_WAIT
+
+        seconds_per_cost = sum(duration for cost, duration in history) / total_cost
+        unfinished = PollJob.objects.filter(status__in=(POLL_JOB_PENDING[0], POLL_JOB_RUNNING[0]), pk__lte=self.pk)
+        cost_ahead = unfinished.aggregate(cost=Sum('cost'))['cost'] or self.cost
+        return max(1, int(round(seconds_per_cost * cost_ahead)))
+
+    @staticmethod
+    def fail_stale():
+        """
+        Marks the jobs that have been running for longer than
+        TAXII_SERVICES_POLL_JOB_TIMEOUT seconds (default POLL_JOB_TIMEOUT) as
+        failed, so that a job whose worker was killed doesn't stay pending
+        forever. If such a worker is still running, its results are discarded.
+
+        Returns:
+            The number of jobs marked as failed
+        """
+        timeout = getattr(settings, 'TAXII_SERVICES_POLL_JOB_TIMEOUT', POLL_JOB_TIMEOUT)
+        now = timezone.now()
+        stale = PollJob.objects.filter(status=POLL_JOB_RUNNING[0], date_started__lt=now - timedelta(seconds=timeout))
+        return stale.update(status=POLL_JOB_FAILED[0], date_finished=now, date_updated=now,
+                            message='The Poll Job did not finish within %s seconds' % timeout)
+
+    @staticmethod
+    def claim_next():
+        """
+        Marks the oldest pending job as running and returns it, or returns None
+        if there are no pending jobs. Safe to call from several workers at once:
+        each job is claimed by one of them. Stale running jobs are failed
+        first (see fail_stale).
+        """
+        PollJob.fail_stale()
+        pending = PollJob.objects.filter(status=POLL_JOB_PENDING[0])
+        while True:
+            pk = pending.order_by('pk').values_list('pk', flat=True).first()
+            if pk is None:
+                return None
+            if pending.filter(pk=pk).update(status=POLL_JOB_RUNNING[0], date_started=timezone.now()):
+                return PollJob.objects.select_related('poll_service', 'result_set').get(pk=pk)
+
+    def run(self):
+        """
+        Runs the job with its handler's run_poll_job and records the outcome.
+        The Result Set's parts are committed along with the outcome, so a job
+        that fails (or was failed by fail_stale meanwhile) leaves none behind.
+        """
+        start = default_timer()
+        try:
+            with transaction.atomic():
+                resolve_handler(self.handler).run_poll_job(self)
+                if not self.finish(POLL_JOB_DONE[0], default_timer() - start):
+                    transaction.set_rollback(True)
+        except Exception as e:
+            logging.getLogger(__name__).exception('Poll Job %s failed', self.pk)
+            self.finish(POLL_JOB_FAILED[0], default_timer() - start, getattr(e, 'message', None) or unicode(e))
+
+    def finish(self, status, duration, message=''):
+        """
+        Records the outcome of a running job.
+
+        Returns:
+            False if the job was no longer running (see fail_stale)
+        """
+        now = timezone.now()
+        finished = PollJob.objects.filter(pk=self.pk, status=POLL_JOB_RUNNING[0]).update(
+            status=status, duration=duration, message=message, date_finished=now, date_updated=now)
+        if finished:
+            self.status, self.duration, self.message, self.date_finished = status, duration, message, now
+        return bool(finished)
+
+    def __unicode__(self):
+        return u'Poll Job %s (%s)' % (self.pk, self.status)
+
+    class Meta:
+        verbose_name = "Poll Job"
+
+
 class Subscription(models.Model):
     """
     Model for Subscriptions
@@ -1722,10 +2821,20 @@ class Subscription(models.Model):
     accept_all_content = models.BooleanField(default=False)
     supported_content = models.ManyToManyField('ContentBindingAndSubtype', blank=True)
     query = models.TextField(blank=True, null=True)
-    # push_parameters = models.ForeignKey(PushParameters)  # TODO: Create a push parameters object
-    delivery = models.CharField(max_length=MAX_NAME_LENGTH, choices=DELIVERY_CHOICES, default=SUBS_POLL)
+    delivery = models.CharField(max_length=MAX_NAME_LENGTH, choices=DELIVERY_CHOICES, default=SUBS_POLL[0])
     status = models.CharField(max_length=MAX_NAME_LENGTH, choices=SUBSCRIPTION_STATUS_CHOICES, default=SS_ACTIVE)
     date_paused = models.DateTimeField(blank=True, null=True)
+    # The Push Parameters of PUSH and BOTH subscriptions
+    push_protocol = models.CharField(max_length=MAX_NAME_LENGTH, blank=True)
+    push_address = models.CharField(max_length=MAX_NAME_LENGTH, blank=True)
+    push_message_binding = models.CharField(max_length=MAX_NAME_LENGTH, blank=True)
+    # The (timestamp_label, id) key of the last Content Block pushed (see taxii_services.push)
+    push_watermark_timestamp_label = models.DateTimeField(blank=True, null=True)
+    push_watermark_content_block_id = models.IntegerField(blank=True, null=True)
+    # Consecutive failed pushes, and when the next push may start
+    push_failures = models.IntegerField(default=0)
+    next_push_attempt = models.DateTimeField(blank=True, null=True)
+    last_push_error = models.TextField(blank=True)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -1739,6 +2848,37 @@ class Subscription(models.Model):
                                          ST_FAILURE,
                                          'The Subscription is not active!')
 
+    def get_push_parameters_11(self):
+        """
+        Returns:
+            A tm11.PushParameters object for this Subscription,
+            or None if it has no Push Parameters
+        """
+        if not self.push_address:
+            return None
+        return tm11.PushParameters(inbox_protocol=self.push_protocol,
+                                   inbox_address=self.push_address,
+                                   delivery_message_binding=self.push_message_binding)
+
+    def get_push_content(self, inclusive_end_timestamp_label, limit):
+        """
+        Returns:
+            A list of at most limit of the Data Collection's Content Blocks
+            that come after the push watermark and have a timestamp label no
+            later than inclusive_end_timestamp_label, in (timestamp_label, id) order
+        """
+        timestamp_label = MEMBERSHIP_LOOKUP + 'timestamp_label'
+        conditions = [Q(**{timestamp_label + '__lte': inclusive_end_timestamp_label})]
+        if self.push_watermark_timestamp_label is not None:
+            conditions.append(Q(**{timestamp_label + '__gt': self.push_watermark_timestamp_label}) |
+                              Q(**{timestamp_label: self.push_watermark_timestamp_label,
+                                   MEMBERSHIP_LOOKUP + 'content_block__gt': self.push_watermark_content_block_id}))
+        if not self.accept_all_content:
+            conditions.append(Q(**{MEMBERSHIP_LOOKUP + 'content_binding_and_subtype__in':
+                                   self.supported_content.all()}))
+        content = self.data_collection.filter_content_blocks(*conditions)
+        return list(content.select_related(*CONTENT_BLOCK_SELECT_RELATED)[:limit])
+
     def to_poll_params_11(self):
         """
         Creates a tm11.PollParameters object based on the
@@ -1776,7 +2916,7 @@ class Subscription(models.Model):
         if self.query:
             subscription_params.query = self.query.to_query_11()
 
-        push_params = None  # TODO: Implement this
+        push_params = self.get_push_parameters_11()
         poll_instances = None  # TODO: Implement this
         si = tm11.SubscriptionInstance(subscription_id=str(self.subscription_id),
                                        status=self.status,
@@ -1919,3 +3059,9 @@ class Validator(Handler):
     model will leverage that validator concept.
     """
     handler_functions = ['validate']
+
+
+# Keep the handler registry in sync with the Handler models
+for handler_model in (MessageHandler, QueryHandler, Validator):
+    post_save.connect(invalidate_handler_registry, sender=handler_model)
+    post_delete.connect(invalidate_handler_registry, sender=handler_model)
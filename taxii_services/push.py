@@ -0,0 +1,305 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Delivery of Content Blocks to the inboxes of PUSH and BOTH subscriptions.
+
+push_all() sends each due subscription the Content Blocks added to its Data
+Collection since its watermark (the (timestamp_label, id) key of the last
+Content Block it was sent), in TAXII 1.1 Inbox Messages of at most
+TAXII_SERVICES_PUSH_BATCH_SIZE (default 100) Content Blocks. The watermark
+moves forward after each accepted Inbox Message, so delivery is at least
+once: an Inbox Message whose response is lost is sent again.
+
+A subscription whose inbox fails (a connection error, an HTTP error or a
+Status Message other than Success) is retried after
+TAXII_SERVICES_PUSH_RETRY_DELAY seconds (default 60), doubling after each
+consecutive failure up to TAXII_SERVICES_PUSH_MAX_RETRY_DELAY (default 3600).
+
+Content Blocks are only pushed once their timestamp label is
+TAXII_SERVICES_PUSH_SETTLE_TIME seconds (default 5) old, so that a Content
+Block whose transaction commits after a later one was pushed isn't skipped.
+
+Deliveries are run by the push_content management command, or in process
+by a PushScheduler (see start_push_scheduler). Several of them can run at
+once: a subscription is leased to one of them while it is being pushed to.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import httplib
+import logging
+import socket
+import threading
+import urlparse
+
+from dateutil.tz import tzutc
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from libtaxii.common import generate_message_id
+from libtaxii.constants import *
+import libtaxii.messages_11 as tm11
+
+from taxii_services import models
+
+#: URL schemes of the push protocols
+PUSH_PROTOCOL_SCHEMES = {VID_TAXII_HTTP_10: 'http', VID_TAXII_HTTPS_10: 'https'}
+#: How long a subscription is leased to the delivery that is pushing to it
+PUSH_LEASE = datetime.timedelta(minutes=5)
+
+logger = logging.getLogger(__name__)
+
+
+class PushError(Exception):
+    """
+    An inbox did not accept an Inbox Message
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps one keep-alive HTTP(S) connection open per host, so that
+    consecutive Inbox Messages to a host don't each open a connection.
+    Not thread-safe: each delivery thread has its own pool.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or getattr(settings, 'TAXII_SERVICES_PUSH_TIMEOUT', 30)
+        self._connections = {}
+
+    def _get_connection(self, scheme, netloc):
+        connection = self._connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            connection = connection_class(netloc, timeout=self.timeout)
+            self._connections[(scheme, netloc)] = connection
+        return connection
+
+    def _discard(self, scheme, netloc):
+        connection = self._connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def post(self, url, body, headers):
+        """
+        POSTs body to url.
+
+        Returns:
+            A tuple of (HTTP status, response body)
+        """
+        parsed = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+        # A kept-alive connection may have been closed by the server since it was
+        # last used, so a failure on a reused connection is retried once on a new one
+        for attempt in range(2):
+            reused = (parsed.scheme, parsed.netloc) in self._connections
+            connection = self._get_connection(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._discard(parsed.scheme, parsed.netloc)
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.getheader('connection', '').lower() == 'close':
+                self._discard(parsed.scheme, parsed.netloc)
+            return response.status, content
+
+    def close(self):
+        for key in list(self._connections):
+            self._discard(*key)
+
+
+def get_retry_delay(failures):
+    """
+    Returns the timedelta to wait after failures consecutive failed pushes
+    """
+    delay = getattr(settings, 'TAXII_SERVICES_PUSH_RETRY_DELAY', 60) * 2 ** (failures - 1)
+    return datetime.timedelta(seconds=min(delay, getattr(settings, 'TAXII_SERVICES_PUSH_MAX_RETRY_DELAY', 3600)))
+
+
+def get_due_subscriptions():
+    """
+    Returns a queryset of the active PUSH and BOTH subscriptions whose
+    next push may start now
+    """
+    now = datetime.datetime.now(tzutc())
+    return models.Subscription.objects.filter(Q(next_push_attempt__isnull=True) | Q(next_push_attempt__lte=now),
+                                              delivery__in=(models.SUBS_PUSH[0], models.SUBS_BOTH[0]),
+                                              status=SS_ACTIVE).exclude(push_address='')
+
+
+def claim(subscription):
+    """
+    Leases subscription to the caller for PUSH_LEASE.
+
+    Returns:
+        True if no other delivery holds the lease
+    """
+    now = datetime.datetime.now(tzutc())
+    due = models.Subscription.objects.filter(Q(next_push_attempt__isnull=True) | Q(next_push_attempt__lte=now),
+                                             pk=subscription.pk)
+    subscription.next_push_attempt = now + PUSH_LEASE
+    return due.update(next_push_attempt=subscription.next_push_attempt) == 1
+
+
+def send_inbox_message(subscription, content_blocks, pool):
+    """
+    Sends content_blocks to subscription's inbox in a TAXII 1.1 Inbox Message.
+    Raises PushError if the inbox doesn't accept it.
+    """
+    subscription_information = tm11.SubscriptionInformation(
+        collection_name=subscription.data_collection.name,
+        subscription_id=str(subscription.subscription_id),
+        exclusive_begin_timestamp_label=subscription.push_watermark_timestamp_label,
+        inclusive_end_timestamp_label=content_blocks[-1].timestamp_label)
+    inbox_message = tm11.InboxMessage(message_id=generate_message_id(),
+                                      subscription_information=subscription_information,
+                                      content_blocks=[cb.to_content_block_11() for cb in content_blocks])
+
+    scheme = PUSH_PROTOCOL_SCHEMES.get(subscription.push_protocol)
+    if scheme is None or subscription.push_message_binding != VID_TAXII_XML_11:
+        raise PushError('Unsupported push protocol or message binding')
+    address = subscription.push_address
+    if not urlparse.urlsplit(address).scheme:
+        address = '%s://%s' % (scheme, address)
+
+    headers = {'Content-Type': 'application/xml',
+               'Accept': 'application/xml',
+               'X-TAXII-Content-Type': VID_TAXII_XML_11,
+               'X-TAXII-Accept': VID_TAXII_XML_11,
+               'X-TAXII-Protocol': subscription.push_protocol,
+               'X-TAXII-Services': VID_TAXII_SERVICES_11}
+    try:
+        status, body = pool.post(address, inbox_message.to_xml(), headers)
+    except (httplib.HTTPException, socket.error) as e:
+        raise PushError('Could not send the Inbox Message: %s' % e)
+    if status != 200:
+        raise PushError('The inbox responded with HTTP %s' % status)
+    try:
+        response_message = tm11.get_message_from_xml(body)
+    except Exception as e:
+        raise PushError('The inbox response could not be parsed: %s' % e)
+    if response_message.message_type != MSG_STATUS_MESSAGE or response_message.status_type != ST_SUCCESS:
+        raise PushError('The inbox did not accept the Inbox Message: %s %s' %
+                        (getattr(response_message, 'status_type', response_message.message_type),
+                         getattr(response_message, 'message', None) or ''))
+
+
+def push_subscription(subscription, pool):
+    """
+    Sends subscription's new Content Blocks to its inbox, batch by batch,
+    moving its watermark forward after each batch. subscription must be
+    claimed (see claim).
+
+    Returns:
+        The number of Content Blocks pushed
+    """
+    batch_size = getattr(settings, 'TAXII_SERVICES_PUSH_BATCH_SIZE', 100)
+    settle_time = datetime.timedelta(seconds=getattr(settings, 'TAXII_SERVICES_PUSH_SETTLE_TIME', 5))
+    end = datetime.datetime.now(tzutc()) - settle_time
+
+    pushed = 0
+    try:
+        while True:
+            content_blocks = subscription.get_push_content(end, batch_size)
+            if not content_blocks:
+                break
+            send_inbox_message(subscription, content_blocks, pool)
+            pushed += len(content_blocks)
+            subscription.push_watermark_timestamp_label = content_blocks[-1].timestamp_label
+            subscription.push_watermark_content_block_id = content_blocks[-1].pk
+            subscription.push_failures = 0
+            subscription.last_push_error = ''
+            # Renew the lease along with the watermark
+            subscription.next_push_attempt = datetime.datetime.now(tzutc()) + PUSH_LEASE
+            subscription.save(update_fields=['push_watermark_timestamp_label', 'push_watermark_content_block_id',
+                                             'push_failures', 'last_push_error', 'next_push_attempt'])
+            if len(content_blocks) < batch_size:
+                break
+    except PushError as e:
+        subscription.push_failures += 1
+        subscription.last_push_error = unicode(e)
+        subscription.next_push_attempt = datetime.datetime.now(tzutc()) + get_retry_delay(subscription.push_failures)
+        subscription.save(update_fields=['push_failures', 'last_push_error', 'next_push_attempt'])
+        logger.warning('Push to subscription %s failed (%s in a row): %s',
+                       subscription.subscription_id, subscription.push_failures, e)
+        return pushed
+
+    subscription.next_push_attempt = None
+    subscription.save(update_fields=['next_push_attempt'])
+    return pushed
+
+
+def push_all(pool=None):
+    """
+    Pushes new Content Blocks to every due subscription.
+
+    Returns:
+        A tuple of (subscriptions pushed to, Content Blocks pushed)
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
+    subscriptions = content_blocks = 0
+    try:
+        for subscription in get_due_subscriptions().select_related('data_collection'):
+            if not claim(subscription):
+                continue
+            pushed = push_subscription(subscription, pool)
+            if pushed:
+                subscriptions += 1
+                content_blocks += pushed
+    finally:
+        if own_pool:
+            pool.close()
+    return subscriptions, content_blocks
+
+
+class PushScheduler(threading.Thread):
+    """
+    A daemon thread that calls push_all every interval seconds
+    until stop() is called.
+    """
+
+    def __init__(self, interval=None):
+        super(PushScheduler, self).__init__(name='taxii-push-scheduler')
+        self.daemon = True
+        self.interval = interval or getattr(settings, 'TAXII_SERVICES_PUSH_INTERVAL', 10)
+        self._stopped = threading.Event()
+
+    def run(self):
+        pool = ConnectionPool()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    push_all(pool)
+                except Exception:
+                    # The next round starts over; the scheduler must not die
+                    logger.exception('Pushing content failed')
+                finally:
+                    close_old_connections()
+                self._stopped.wait(self.interval)
+        finally:
+            pool.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_push_scheduler(interval=None):
+    """
+    Starts a PushScheduler in this process (e.g., from a WSGI file), for
+    deployments without a separate push_content worker.
+
+    Returns:
+        The PushScheduler
+    """
+    scheduler = PushScheduler(interval)
+    scheduler.start()
+    return scheduler
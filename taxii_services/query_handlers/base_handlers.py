@@ -3,16 +3,25 @@
 
 from __future__ import absolute_import
 
+from collections import deque, namedtuple, OrderedDict
+from itertools import islice
+import multiprocessing
+import threading
 import traceback
 
+from django.conf import settings
+from django.db.models import QuerySet
 from libtaxii.common import parse
 from libtaxii.constants import *
 import libtaxii.taxii_default_query as tdq
 from lxml import etree
 
+from taxii_services import metrics
 from taxii_services.exceptions import StatusMessageException
 from taxii_services.models import SupportInfo
 
+from . import pool
+
 # Define stub predicates for each relationship. Stub predicates have a placeholder for the operand and value
 EQ_CS = '[%s = \'%s\']'
 EQ_CI ='[translate(%s, \'ABCDEFGHIJKLMNOPQRSTUVWXYZ\', \'abcdefghijklmnopqrstuvwxyz\') = \'%s\']'
@@ -34,6 +43,40 @@ ENDS_CS = '[substring(%s, string-length(%s) - string-length(\'%s\') + 1) = \'%s\
 ENDS_CI = '[substring(translate(%s, \'ABCDEFGHIJKLMNOPQRSTUVWXYZ\', \'abcdefghijklmnopqrstuvwxyz\'), string-length(%s) - string-length(\'%s\') + 1) = \'%s\']'
 
 
+#: The number of compiled queries kept by BaseXmlQueryHandler.compile_query
+COMPILED_QUERY_CACHE_SIZE = 128
+
+# {get_compiled_query_key(prp): CompiledCriteria}, least recently used first
+_compiled_queries = OrderedDict()
+_compiled_queries_lock = threading.Lock()
+
+
+class CompiledCriteria(namedtuple('CompiledCriteria', ('source', 'criteria', 'criterion'))):
+    """
+    A tdq.Criteria (source) compiled by BaseXmlQueryHandler.compile_query.
+    criteria and criterion are lists of CompiledCriteria and
+    CompiledCriterion. Other attributes (e.g., operator) are source's, so
+    code written for a tdq.Criteria can be given a CompiledCriteria.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+class CompiledCriterion(namedtuple('CompiledCriterion', ('source', 'xpath'))):
+    """
+    A tdq.Criterion (source) compiled by BaseXmlQueryHandler.compile_query.
+    xpath is an etree.XPath. Other attributes (target, test, negate) are
+    source's, so code written for a tdq.Criterion can be given a
+    CompiledCriterion.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
 class XPathBuilder(object):
     """
     The XPathBuilder object is a helper object that stores an intermediate form of
@@ -230,6 +273,22 @@ class BaseQueryHandler(object):
         """
         return content_blocks
 
+    @classmethod
+    def count_content(cls, poll_request_properties, content_blocks):
+        """
+        This is a hook used by PollRequest11Handler for "Count Only" Poll Requests. It returns
+        the number of items filter_content would return. Query handlers that filter content
+        should override it to count without keeping the matching content in memory.
+
+        :param poll_request_properties: A util.PollRequestProperties object
+        :param content_blocks: A list or queryset of ContentBlock objects
+        :return: The number of matching ContentBlock objects
+        """
+        content_blocks = cls.filter_content(poll_request_properties, content_blocks)
+        if isinstance(content_blocks, QuerySet):
+            return content_blocks.count()
+        return len(content_blocks)
+
 
 class BaseXmlQueryHandler(BaseQueryHandler):
     """
@@ -304,13 +363,16 @@ class BaseXmlQueryHandler(BaseQueryHandler):
 
         Arguments:
             content_etree - an lxml etree to evaluate
-            criteria - the criteria to evaluate against the etree
+            criteria - the CompiledCriteria (see compile_query) or tdq.Criteria \
+                    to evaluate against the etree
 
         Returns:
             True or False, indicating whether the content_etree
             matches the criteria
 
         """
+        if not isinstance(criteria, CompiledCriteria):
+            criteria = cls.compile_criteria(prp, criteria)
 
         for child_criteria in criteria.criteria:
             value = cls.evaluate_criteria(prp, content_etree, child_criteria)
@@ -336,21 +398,22 @@ class BaseXmlQueryHandler(BaseQueryHandler):
     @classmethod
     def evaluate_criterion(cls, prp, content_etree, criterion):
         """
-        Evaluates the criterion in a query by turning the Criterion into an XPath and
-        evaluating it against the content_etree
+        Evaluates the criterion in a query by evaluating its compiled
+        XPath against the content_etree
 
         Arguments:
             content_etree - an lxml etree to evaluate
-            criterion - the criterion to evaluate against the etree
+            criterion - the CompiledCriterion (see compile_query) or tdq.Criterion \
+                    to evaluate against the etree
 
         Returns:
             True or False, indicating whether the content_etree
             matches the criterion
         """
+        if not isinstance(criterion, CompiledCriterion):
+            criterion = cls.compile_criterion(prp, criterion)
 
-        xpath, nsmap = cls.get_xpath(prp, criterion)
-        # print xpath
-        matches = content_etree.xpath(xpath, namespaces=nsmap)
+        matches = criterion.xpath(content_etree)
         # XPath results can be a boolean (True, False) or
         # a NodeSet
         if matches in (True, False):  # The result is boolean, take it literally
@@ -364,11 +427,69 @@ class BaseXmlQueryHandler(BaseQueryHandler):
         return result
 
 
+    @classmethod
+    def compile_query(cls, prp):
+        """
+        Compiles prp.query into etree.XPath objects, so that each of its
+        XPaths is built and compiled once however many Content Blocks it is
+        evaluated against. Compiled queries are shared by requests: the
+        COMPILED_QUERY_CACHE_SIZE most recently used ones are kept, keyed by
+        get_compiled_query_key.
+
+        Returns:
+            A CompiledCriteria of prp.query's criteria
+        """
+        key = cls.get_compiled_query_key(prp)
+        with _compiled_queries_lock:
+            compiled = _compiled_queries.pop(key, None)
+            if compiled is not None:
+                _compiled_queries[key] = compiled  # Now the most recently used
+        metrics.cache_lookup('compiled_query', compiled is not None)
+        if compiled is not None:
+            return compiled
+
+        compiled = cls.compile_criteria(prp, prp.query.criteria)
+        with _compiled_queries_lock:
+            _compiled_queries[key] = compiled
+            while len(_compiled_queries) > COMPILED_QUERY_CACHE_SIZE:
+                _compiled_queries.popitem(last=False)
+        return compiled
+
+    @classmethod
+    def get_compiled_query_key(cls, prp):
+        """
+        Returns the key of prp's compiled query: this class and the canonical
+        XML of prp.query. The XPaths of get_xpath may only depend on what the
+        key does, so classes whose XPaths depend on other properties of prp
+        (e.g., prp.collection) must add those to the key.
+        """
+        return cls, etree.tostring(prp.query.to_etree(), method='c14n')
+
+    @classmethod
+    def compile_criteria(cls, prp, criteria):
+        """
+        Returns a CompiledCriteria of a tdq.Criteria
+        """
+        return CompiledCriteria(criteria,
+                                [cls.compile_criteria(prp, child_criteria) for child_criteria in criteria.criteria],
+                                [cls.compile_criterion(prp, criterion) for criterion in criteria.criterion])
+
+    @classmethod
+    def compile_criterion(cls, prp, criterion):
+        """
+        Returns a CompiledCriterion of a tdq.Criterion, whose XPath comes from get_xpath
+        """
+        xpath, nsmap = cls.get_xpath(prp, criterion)
+        return CompiledCriterion(criterion, etree.XPath(xpath, namespaces=nsmap))
+
     @classmethod
     def get_xpath(cls, prp, criterion):
         """
         Given a tdq.Criterion, return an XPath that is equivalen
 
+        The XPath is compiled once and reused by every request whose query has
+        the same get_compiled_query_key, so it must depend on nothing else.
+
         :param prp: PollRequestProperties
         :param criterion: tdq.Criterion
         :return: The full XPath to evaluate that maps to the tdq.Criterion
@@ -595,6 +716,101 @@ class BaseXmlQueryHandler(BaseQueryHandler):
         xpath_builders = [XPathBuilder(xpath_parts, nsmap)]
         return xpath_builders, nsmap
 
+    @classmethod
+    def check_targeting_expression_id(cls, prp):
+        """
+        Raises a StatusMessageException if prp.query's Targeting Expression ID
+        is not supported by this query handler
+        """
+        if prp.query.targeting_expression_id not in cls.get_supported_tevs():
+            raise StatusMessageException(prp.message_id,
+                                         ST_UNSUPPORTED_TARGETING_EXPRESSION_ID,
+                                         status_detail={SD_TARGETING_EXPRESSION_ID: cls.get_supported_tevs()})
+
+    @classmethod
+    def content_matches(cls, prp, content, compiled_query=None):
+        """
+        Returns True if content (a string of XML) matches prp.query.
+        compiled_query is the result of compile_query(prp), for callers
+        that evaluate many Content Blocks.
+        """
+        if compiled_query is None:
+            compiled_query = cls.compile_query(prp)
+        return cls.evaluate_criteria(prp, parse(content), compiled_query)
+
+    @classmethod
+    def count_parallel_candidates(cls, content_blocks):
+        """
+        Decides whether content_blocks (a list or queryset) are evaluated in
+        parallel by the worker processes of query_handlers.pool: they are when
+        TAXII_SERVICES_QUERY_PROCESSES is set and there are at least
+        TAXII_SERVICES_QUERY_PARALLEL_THRESHOLD (default 1000) of them. Below
+        that, sending the Content Blocks to the workers costs more than it saves.
+
+        Returns:
+            The number of content_blocks if they are evaluated in parallel, otherwise None
+        """
+        if not getattr(settings, 'TAXII_SERVICES_QUERY_PROCESSES', None):
+            return None
+        if isinstance(content_blocks, QuerySet):
+            count = content_blocks.count()
+        elif hasattr(content_blocks, '__len__'):
+            count = len(content_blocks)
+        else:  # An iterator can only be read once
+            return None
+        if count < getattr(settings, 'TAXII_SERVICES_QUERY_PARALLEL_THRESHOLD', 1000):
+            return None
+        return count
+
+    @classmethod
+    def iter_matching_keys(cls, prp, items, parallel=False):
+        """
+        Yields the keys of the (key, content) pairs in items whose content
+        matches prp.query, in the order of items.
+
+        If parallel is True, the pairs are evaluated by the worker processes
+        of query_handlers.pool, in chunks of TAXII_SERVICES_QUERY_CHUNK_SIZE
+        (default 200). Only a few chunks per worker are in flight at once, so
+        items can be a queryset iterator. The workers use this class'
+        content_matches, with a PollRequestProperties that has nothing but
+        the query. A chunk that takes longer than
+        TAXII_SERVICES_QUERY_CHUNK_TIMEOUT seconds (default 60) is assumed to
+        have lost its worker (e.g., to the OOM killer): the pool is stopped, to
+        be started again by the next request, and the poll fails.
+        """
+        query_pool = pool.get_pool() if parallel else None
+        if query_pool is None:
+            compiled_query = cls.compile_query(prp)
+            for key, content in items:
+                if cls.content_matches(prp, content, compiled_query):
+                    yield key
+            return
+
+        handler = '%s.%s' % (cls.__module__, cls.__name__)
+        query_xml = prp.query.to_xml()
+        chunk_size = getattr(settings, 'TAXII_SERVICES_QUERY_CHUNK_SIZE', 200)
+        max_pending = 2 * getattr(settings, 'TAXII_SERVICES_QUERY_PROCESSES')
+        timeout = getattr(settings, 'TAXII_SERVICES_QUERY_CHUNK_TIMEOUT', 60)
+        items = iter(items)
+        pending = deque()
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if chunk:
+                pending.append(query_pool.apply_async(pool.evaluate_chunk, (handler, query_xml, chunk)))
+            if pending and (len(pending) >= max_pending or not chunk):
+                try:
+                    keys = pending.popleft().get(timeout)
+                except multiprocessing.TimeoutError:
+                    # A worker that dies takes its task with it, and the pool never completes it
+                    pool.close_pool()
+                    raise StatusMessageException(prp.message_id,
+                                                 ST_FAILURE,
+                                                 message='The query could not be evaluated in time')
+                for key in keys:
+                    yield key
+            elif not chunk:
+                return
+
     @classmethod
     def filter_content(cls, prp, content_blocks):
         """
@@ -602,19 +818,70 @@ class BaseXmlQueryHandler(BaseQueryHandler):
         item in `content_blocks`, and returns the items in `content_blocks`
         that match the XPath.
 
+        Large inputs are evaluated in parallel (see count_parallel_candidates). A
+        queryset's content is then read without its Content Blocks, and only
+        the matching Content Blocks are fetched.
+
         :param prp: A PollRequestParameters object representing the Poll Request
         :param content_blocks: A list of models.ContentBlock objects to filter
         :return: A list of models.ContentBlock objects matching the query
         """
-        if prp.query.targeting_expression_id not in cls.get_supported_tevs():
-            raise StatusMessageException(prp.message_id,
-                                         ST_UNSUPPORTED_TARGETING_EXPRESSION_ID,
-                                         status_detail={SD_TARGETING_EXPRESSION_ID: cls.get_supported_tevs()})
+        cls.check_targeting_expression_id(prp)
+
+        evaluated = cls.count_parallel_candidates(content_blocks)
+        if evaluated is not None:
+            if isinstance(content_blocks, QuerySet):
+                ids = list(cls.iter_matching_keys(prp, content_blocks.values_list('pk', 'content').iterator(), True))
+                matches = {}
+                # Keep the number of query parameters within every database's limits
+                for i in range(0, len(ids), 500):
+                    matches.update(content_blocks.in_bulk(ids[i: i + 500]))
+                result_list = [matches[id_] for id_ in ids if id_ in matches]
+            else:
+                contents = ((i, content_block.content) for i, content_block in enumerate(content_blocks))
+                result_list = [content_blocks[i] for i in cls.iter_matching_keys(prp, contents, True)]
+        else:
+            compiled_query = cls.compile_query(prp)
+            result_list = []
+            evaluated = 0
+            for content_block in content_blocks:
+                if cls.content_matches(prp, content_block.content, compiled_query):
+                    result_list.append(content_block)
+                evaluated += 1
+
+        metrics.inc(metrics.QUERY_EVALUATIONS, evaluated, query_handler=cls.__name__)
+        return result_list
 
-        result_list = []
-        for content_block in content_blocks:
-            etree_content = parse(content_block.content)
-            if cls.evaluate_criteria(prp, etree_content, prp.query.criteria):
-                result_list.append(content_block)
+    @classmethod
+    def count_content(cls, prp, content_blocks):
+        """
+        Counts the items in `content_blocks` that match prp.query. A queryset
+        is streamed from the database one content string at a time, so neither
+        the Content Blocks nor their content are kept in memory. Large inputs
+        are evaluated in parallel (see count_parallel_candidates).
 
-        return result_list
+        :param prp: A PollRequestParameters object representing the Poll Request
+        :param content_blocks: A list or queryset of models.ContentBlock objects
+        :return: The number of items in `content_blocks` matching the query
+        """
+        cls.check_targeting_expression_id(prp)
+
+        if isinstance(content_blocks, QuerySet):
+            contents = content_blocks.values_list('content', flat=True).iterator()
+        else:
+            contents = (content_block.content for content_block in content_blocks)
+
+        evaluated = cls.count_parallel_candidates(content_blocks)
+        if evaluated is not None:
+            count = sum(1 for i in cls.iter_matching_keys(prp, enumerate(contents), True))
+        else:
+            compiled_query = cls.compile_query(prp)
+            count = 0
+            evaluated = 0
+            for content in contents:
+                if cls.content_matches(prp, content, compiled_query):
+                    count += 1
+                evaluated += 1
+
+        metrics.inc(metrics.QUERY_EVALUATIONS, evaluated, query_handler=cls.__name__)
+        return count
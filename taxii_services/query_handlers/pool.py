@@ -0,0 +1,105 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+The worker processes that BaseXmlQueryHandler evaluates queries in.
+
+When the TAXII_SERVICES_QUERY_PROCESSES setting is a number of processes,
+BaseXmlQueryHandler.filter_content and count_content send large inputs
+(see BaseXmlQueryHandler.count_parallel_candidates) to a multiprocessing
+pool of that many processes, in chunks of (key, content) pairs. The pool
+is started the first time it's needed and reused by later requests. A
+process forked from the one that started it (e.g., a pre-forking server's
+worker) starts its own pool.
+
+Workers are forked from the Django process, so they have its settings and
+handler classes. They only evaluate queries; they don't use the database.
+
+Forking a multi-threaded process is only safe for the thread that forks,
+so the pool must be started before the process starts other threads. Under
+a pre-forking server, run single-threaded workers (each starts its own pool
+on its first large query). Under a multi-threaded server, call get_pool()
+at startup (e.g., from the WSGI file) before any request is served.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import multiprocessing
+import os
+import threading
+
+from django.conf import settings
+import libtaxii.taxii_default_query as tdq
+
+from taxii_services import models
+from taxii_services.util import PollRequestProperties
+
+#: The number of queries each worker keeps parsed
+WORKER_QUERY_CACHE_SIZE = 16
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns this process' worker pool, starting it if needed, or None if
+    TAXII_SERVICES_QUERY_PROCESSES is not set
+    """
+    global _pool, _pool_pid
+    processes = getattr(settings, 'TAXII_SERVICES_QUERY_PROCESSES', None)
+    if not processes:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(processes)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def close_pool():
+    """
+    Stops this process' worker pool, if it started one
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+        _pool_pid = None
+
+atexit.register(close_pool)
+
+
+# In each worker, {(handler, query XML): (query handler class, PollRequestProperties, compiled query)}
+_worker_queries = {}
+
+
+def evaluate_chunk(handler, query_xml, chunk):
+    """
+    Runs in a worker process.
+
+    Arguments:
+        handler (str) - The dotted path of the BaseXmlQueryHandler (sub)class
+        query_xml (str) - The tdq.DefaultQuery, as XML
+        chunk (list) - (key, content) pairs
+
+    Returns:
+        The keys of the pairs whose content matches the query, in order
+    """
+    entry = _worker_queries.get((handler, query_xml))
+    if entry is None:
+        if len(_worker_queries) >= WORKER_QUERY_CACHE_SIZE:
+            _worker_queries.clear()
+        prp = PollRequestProperties()
+        prp.query = tdq.DefaultQuery.from_xml(query_xml)
+        handler_class = models.resolve_handler(handler)
+        entry = handler_class, prp, handler_class.compile_query(prp)
+        _worker_queries[(handler, query_xml)] = entry
+
+    handler_class, prp, compiled_query = entry
+    return [key for key, content in chunk if handler_class.content_matches(prp, content, compiled_query)]
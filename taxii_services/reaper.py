@@ -0,0 +1,99 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Deletion of expired Result Sets.
+
+Result Sets expire their Poll Service's result_set_lifetime (default
+models.RESULT_SET_LIFETIME) after they are created. reap() deletes the
+expired ones, with their parts, in batches of
+TAXII_SERVICES_RESULT_SET_REAP_BATCH_SIZE rows (default 500; see
+models.ResultSet.delete_expired).
+
+Reaping is run by the reap_result_sets management command (e.g., from
+cron), or in process by a ResultSetReaper (see start_result_set_reaper)
+every TAXII_SERVICES_RESULT_SET_REAP_INTERVAL seconds (default 3600).
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+from taxii_services import models
+
+logger = logging.getLogger(__name__)
+
+
+def reap(batch_size=None):
+    """
+    Deletes the expired Result Sets.
+
+    Returns:
+        A dict of {model label: number of rows deleted}
+    """
+    batch_size = batch_size or getattr(settings, 'TAXII_SERVICES_RESULT_SET_REAP_BATCH_SIZE',
+                                       models.RESULT_SET_REAP_BATCH_SIZE)
+    deleted = models.ResultSet.delete_expired(batch_size)
+    if deleted:
+        logger.info('Reaped expired Result Sets: %s', describe(deleted))
+    return deleted
+
+
+def describe(deleted):
+    """
+    Returns a readable summary of a dict returned by reap,
+    e.g. "2 Result Sets, 7 Result Set Parts"
+    """
+    descriptions = []
+    for label, rows in sorted(deleted.iteritems()):
+        try:
+            name = apps.get_model(label)._meta.verbose_name_plural
+        except LookupError:  # An auto-created many-to-many through model
+            name = label.split('.')[-1]
+        descriptions.append('%s %s' % (rows, name))
+    return ', '.join(descriptions) or 'nothing'
+
+
+class ResultSetReaper(threading.Thread):
+    """
+    A daemon thread that calls reap every interval seconds
+    until stop() is called.
+    """
+
+    def __init__(self, interval=None):
+        super(ResultSetReaper, self).__init__(name='taxii-result-set-reaper')
+        self.daemon = True
+        self.interval = interval or getattr(settings, 'TAXII_SERVICES_RESULT_SET_REAP_INTERVAL', 3600)
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                reap()
+            except Exception:
+                # The next round picks up where this one stopped; the reaper must not die
+                logger.exception('Reaping expired Result Sets failed')
+            finally:
+                close_old_connections()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_result_set_reaper(interval=None):
+    """
+    Starts a ResultSetReaper in this process (e.g., from a WSGI file), for
+    deployments that don't run the reap_result_sets command.
+
+    Returns:
+        The ResultSetReaper
+    """
+    reaper = ResultSetReaper(interval)
+    reaper.start()
+    return reaper
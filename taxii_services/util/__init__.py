@@ -45,9 +45,22 @@ class PollRequestProperties(object):
             if self.inclusive_end_timestamp_label:
                 kwargs['timestamp_label__lte'] = self.inclusive_end_timestamp_label
         if self.content_bindings:
-            kwargs['content_binding__in'] = self.content_bindings
+            kwargs['content_binding_and_subtype__in'] = self.content_bindings
         return kwargs
 
+    def is_past_high_water_mark(self):
+        """
+        Returns:
+            True if the Poll Request is for a Data Feed and its Exclusive Begin
+            Timestamp Label is at or past the newest Content Block in the Data
+            Collection, so there is no content to return. The newest timestamp
+            label comes from the Data Collection's statistics, not its Content Blocks.
+        """
+        if self.collection.type != CT_DATA_FEED or self.exclusive_begin_timestamp_label is None:
+            return False
+        high_water_mark = self.collection.get_statistics().max_timestamp_label
+        return high_water_mark is None or high_water_mark <= self.exclusive_begin_timestamp_label
+
     @staticmethod
     def from_poll_request_10(poll_service, poll_request):
         prp = PollRequestProperties()
@@ -168,3 +181,8 @@ class PollRequestProperties(object):
                                                      "than Begin TS Label")
 
         return prp
+
+
+#: The ordering that keyset pagination of Content Blocks relies on. The
+#: primary key makes it a unique ordering even when timestamp labels are equal
+CONTENT_BLOCK_ORDERING = ('timestamp_label', 'id')
@@ -0,0 +1,202 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+An optional cache of single-part TAXII 1.1 Poll Responses.
+
+When the TAXII_SERVICES_POLL_CACHE setting names one of Django's CACHES,
+PollRequest11Handler keeps the rendered XML of each single-part Poll
+Response (Full or Count Only) in that cache, keyed by get_key(), and
+answers identical Poll Requests from it without touching the database or
+the query handler. Entries live for TAXII_SERVICES_POLL_CACHE_TIMEOUT
+seconds (default 300).
+
+Each Data Collection has a generation token that is part of the keys of
+its entries. The signal receivers at the bottom of this module replace the
+token whenever the collection's Content Blocks change, which orphans every
+entry for the collection at once. They are connected when the app is loaded
+(see apps.TaxiiServicesConfig). Code that changes what polls see without
+sending those signals (e.g., models.backfill_collection_membership) calls
+invalidate() itself.
+
+A Poll Request without an Inclusive End Timestamp Label is answered with
+the time of the request as its end label. A cached response keeps the end
+label of the request that filled the cache, which is still correct: no
+Content Block was added to the collection since then, or the entry would
+have been invalidated.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from lxml import etree
+
+from taxii_services import metrics, models
+
+#: Prefix of the cache keys of Data Collection generation tokens
+GENERATION_KEY_PREFIX = 'taxii-poll-generation-'
+#: Prefix of the cache keys of Poll Responses
+RESPONSE_KEY_PREFIX = 'taxii-poll-response-'
+
+
+def get_cache():
+    """
+    Returns the cache named by TAXII_SERVICES_POLL_CACHE, or None if
+    the Poll Response cache is disabled
+    """
+    alias = getattr(settings, 'TAXII_SERVICES_POLL_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_generation(cache, collection_id):
+    """
+    Returns the generation token of a Data Collection, creating it if needed
+    """
+    key = GENERATION_KEY_PREFIX + str(collection_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def invalidate(collection_ids):
+    """
+    Discards the cached Poll Responses of the Data Collections with
+    the given ids once the current transaction commits (right away outside
+    of a transaction), so a Poll Request that read the collection before
+    the commit can't leave a stale entry behind.
+    """
+    cache = get_cache()
+    collection_ids = list(collection_ids or ())
+    if cache is None or not collection_ids:
+        return
+
+    transaction.on_commit(lambda: cache.set_many(dict((GENERATION_KEY_PREFIX + str(collection_id), uuid.uuid4().hex)
+                                                      for collection_id in collection_ids), None))
+
+
+def get_key(cache, handler_class, poll_service, prp):
+    """
+    Builds the cache key of a Poll Request from its normalized properties.
+
+    Returns:
+        The key, or None if the Poll Request's response must not be cached
+        (it asks for Delivery Parameters)
+    """
+    if prp.delivery_parameters is not None:
+        return None
+
+    query = None
+    if prp.query is not None:
+        query = etree.tostring(prp.query.to_etree(), method='c14n')
+
+    poll_request = prp.poll_request
+    parts = ['%s.%s' % (handler_class.__module__, handler_class.__name__),
+             poll_service.pk,
+             poll_service.max_result_size,
+             prp.subscription.subscription_id if prp.subscription else None,
+             prp.response_type,
+             sorted(cbas.pk for cbas in prp.content_bindings or ()),
+             query,
+             # The labels the request asked for, before the end label defaults to now
+             prp.exclusive_begin_timestamp_label,
+             poll_request.inclusive_end_timestamp_label]
+    digest = hashlib.sha1(repr(parts)).hexdigest()
+    return '%s%s-%s-%s' % (RESPONSE_KEY_PREFIX, prp.collection.pk,
+                           get_generation(cache, prp.collection.pk), digest)
+
+
+def get_response(cache, key, prp):
+    """
+    Returns a models.RenderedPollResponse for the cached Poll Response
+    under key, or None if there isn't one
+    """
+    cached = cache.get(key)
+    metrics.cache_lookup('poll_response', cached is not None)
+    if cached is None:
+        return None
+    rendered_xml, content_block_count = cached
+    return models.RenderedPollResponse(rendered_xml, prp.message_id,
+                                       collection_name=prp.collection.name,
+                                       content_block_count=content_block_count)
+
+
+def set_response(cache, key, poll_response, prp, pretty_print=False):
+    """
+    Caches a single-part Poll Response under key.
+
+    Returns:
+        A models.RenderedPollResponse of poll_response, so the response
+        isn't serialized twice
+    """
+    message_id, in_response_to = poll_response.message_id, poll_response.in_response_to
+    poll_response.message_id = models.RENDERED_MESSAGE_ID
+    poll_response.in_response_to = models.RENDERED_IN_RESPONSE_TO
+    try:
+        rendered_xml = poll_response.to_xml(pretty_print=pretty_print)
+    finally:
+        poll_response.message_id, poll_response.in_response_to = message_id, in_response_to
+
+    content_block_count = getattr(poll_response, 'content_block_count', len(poll_response.content_blocks))
+    cache.set(key, (rendered_xml, content_block_count),
+              getattr(settings, 'TAXII_SERVICES_POLL_CACHE_TIMEOUT', 300))
+    rendered = models.RenderedPollResponse(rendered_xml, in_response_to,
+                                           collection_name=prp.collection.name,
+                                           content_block_count=content_block_count)
+    rendered.message_id = message_id
+    return rendered
+
+
+def _content_block_collection_ids(content_block_id):
+    through = models.DataCollection.content_blocks.through
+    return through.objects.filter(contentblock_id=content_block_id).values_list('datacollection_id', flat=True)
+
+
+def invalidate_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Content Blocks were added to or removed from Data Collections
+    """
+    if get_cache() is None:
+        return
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate([instance.pk])
+    elif reverse and action in ('post_add', 'post_remove'):
+        invalidate(pk_set)
+    elif reverse and action == 'pre_clear':
+        invalidate(_content_block_collection_ids(instance.pk))
+
+
+def invalidate_on_content_block_change(sender, instance, raw=False, **kwargs):
+    """
+    A Content Block was changed or is about to be deleted. New Content
+    Blocks are not in any Data Collection yet
+    """
+    if get_cache() is None or raw or kwargs.get('created'):
+        return
+    invalidate(_content_block_collection_ids(instance.pk))
+
+
+def invalidate_on_data_collection_change(sender, instance, raw=False, **kwargs):
+    """
+    A Data Collection was changed or deleted
+    """
+    if get_cache() is None or raw:
+        return
+    invalidate([instance.pk])
+
+
+m2m_changed.connect(invalidate_on_membership_change, sender=models.DataCollection.content_blocks.through)
+post_save.connect(invalidate_on_content_block_change, sender=models.ContentBlock)
+pre_delete.connect(invalidate_on_content_block_change, sender=models.ContentBlock)
+post_save.connect(invalidate_on_data_collection_change, sender=models.DataCollection)
+post_delete.connect(invalidate_on_data_collection_change, sender=models.DataCollection)
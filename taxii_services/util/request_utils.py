@@ -3,17 +3,24 @@
 
 from __future__ import absolute_import
 
+import collections
 from functools import wraps
+import sys
+import threading
+import zlib
 
+from django.conf import settings
 import libtaxii as t
 from libtaxii.common import generate_message_id
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
 import libtaxii.messages_11 as tm11
 import libtaxii.taxii_default_query as tdq
+from libtaxii.validation import TAXII10Validator, TAXII11Validator
+from lxml import etree
 
 from taxii_services.exceptions import StatusMessageException
-from taxii_services.handlers import HttpResponseTaxii
+from taxii_services.handlers import DEFLATE_ENCODING, GZIP_ENCODING, HttpResponseTaxii
 
 # 1. Validate request (headers, POST) [common]
 # 2. Deserialize message [pretty common]
@@ -133,6 +140,196 @@ def validate_taxii(header_rules=None, message_types=None, do_validate=True):
     return decorator
 
 
+XmlBinding = collections.namedtuple('XmlBinding', ['validator', 'namespace', 'message_classes'])
+
+#: The TAXII XML Message Bindings that can be parsed from a single lxml tree.
+#: Keyed by X-TAXII-Content-Type. Each binding holds a schema validator (whose
+#: compiled schema is reused across requests), the namespace of the binding's
+#: root elements and a dict of {root element local name: libtaxii message class}
+xml_bindings = {
+    VID_TAXII_XML_11: XmlBinding(TAXII11Validator(),
+                                 tm11.ns_map['taxii_11'],
+                                 dict((m.message_type, m) for m in
+                                      (tm11.DiscoveryRequest, tm11.DiscoveryResponse,
+                                       tm11.CollectionInformationRequest, tm11.CollectionInformationResponse,
+                                       tm11.PollRequest, tm11.PollResponse, tm11.StatusMessage,
+                                       tm11.InboxMessage, tm11.ManageCollectionSubscriptionRequest,
+                                       tm11.ManageCollectionSubscriptionResponse, tm11.PollFulfillmentRequest))),
+    VID_TAXII_XML_10: XmlBinding(TAXII10Validator(),
+                                 tm10.ns_map['taxii'],
+                                 dict((m.message_type, m) for m in
+                                      (tm10.DiscoveryRequest, tm10.DiscoveryResponse,
+                                       tm10.FeedInformationRequest, tm10.FeedInformationResponse,
+                                       tm10.PollRequest, tm10.PollResponse, tm10.StatusMessage,
+                                       tm10.InboxMessage, tm10.ManageFeedSubscriptionRequest,
+                                       tm10.ManageFeedSubscriptionResponse))),
+}
+
+# lxml parsers must not be shared between threads, so each thread gets its own
+_local = threading.local()
+
+
+def get_xml_parser():
+    """
+    Returns this thread's XML parser, creating it on first use. The parser
+    is configured the same way as libtaxii's: no network access, no DTD
+    loading and no entity resolution.
+    """
+    parser = getattr(_local, 'xml_parser', None)
+    if parser is None:
+        parser = etree.XMLParser(attribute_defaults=False,
+                                 dtd_validation=False,
+                                 load_dtd=False,
+                                 no_network=True,
+                                 ns_clean=True,
+                                 recover=False,
+                                 remove_blank_text=False,
+                                 remove_comments=False,
+                                 remove_pis=False,
+                                 strip_cdata=True,
+                                 compact=True,
+                                 resolve_entities=False,
+                                 huge_tree=False)
+        _local.xml_parser = parser
+    return parser
+
+
+def parse_xml(xml_string):
+    """
+    Parses xml_string with get_xml_parser().
+
+    Returns:
+        The root element of the parsed document
+
+    Raises:
+        lxml.etree.XMLSyntaxError if xml_string is not well-formed XML
+    """
+    return etree.fromstring(xml_string, get_xml_parser())
+
+
+def parse_xml_chunks(chunks):
+    """
+    Feeds each str in chunks to get_xml_parser(), so the document never
+    has to be held in memory as a single string.
+
+    Returns:
+        The root element of the parsed document
+
+    Raises:
+        lxml.etree.XMLSyntaxError if the chunks are not well-formed XML,
+        or whatever iterating over chunks raised
+    """
+    parser = get_xml_parser()
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+    except Exception:
+        exc_info = sys.exc_info()
+        # Reset the parser so this thread can use it again
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return parser.close()
+
+
+#: Request Content-Encodings that are decompressed before parsing
+REQUEST_CONTENT_ENCODINGS = (GZIP_ENCODING, DEFLATE_ENCODING)
+#: Status Message text used when a compressed request is too large
+DECOMPRESSED_SIZE_ERR = 'The decompressed request body is larger than the maximum allowed size of %s bytes.'
+# Compressed bytes read from the request, and decompressed bytes produced, per step
+_DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+def iter_decompressed_body(django_request):
+    """
+    Reads the gzip or deflate (zlib) compressed body of django_request,
+    yielding decompressed chunks.
+
+    The decompressed size is capped by the TAXII_SERVICES_MAX_DECOMPRESSED_SIZE
+    setting (in bytes, default 100 MiB, None means no limit), which is
+    checked as the body is decompressed.
+
+    Raises:
+        StatusMessageException (ST_BAD_MESSAGE) if the body exceeds the cap
+        or is not valid compressed data
+    """
+    max_size = getattr(settings, 'TAXII_SERVICES_MAX_DECOMPRESSED_SIZE', 100 * 1024 * 1024)
+    # 32 + MAX_WBITS accepts both the gzip and zlib containers
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    size = 0
+    try:
+        while True:
+            compressed = django_request.read(_DECOMPRESS_CHUNK_SIZE)
+            if not compressed:
+                break
+            while compressed:
+                data = decompressor.decompress(compressed, _DECOMPRESS_CHUNK_SIZE)
+                compressed = decompressor.unconsumed_tail
+                size += len(data)
+                if max_size is not None and size > max_size:
+                    raise StatusMessageException('0', ST_BAD_MESSAGE, DECOMPRESSED_SIZE_ERR % max_size)
+                yield data
+        data = decompressor.flush()
+    except zlib.error as e:
+        raise StatusMessageException('0', ST_BAD_MESSAGE,
+                                     'The request body could not be decompressed: %s' % e)
+
+    if max_size is not None and size + len(data) > max_size:
+        raise StatusMessageException('0', ST_BAD_MESSAGE, DECOMPRESSED_SIZE_ERR % max_size)
+    yield data
+
+
+def get_request_etree(django_request):
+    """
+    Parses the body of django_request into an lxml tree. The tree is kept on
+    the request, so validating and deserializing a request only parse its
+    body once.
+
+    Bodies sent with a Content-Encoding of gzip or deflate are decompressed
+    as they are parsed (see iter_decompressed_body).
+    """
+    request_etree = getattr(django_request, '_taxii_etree', None)
+    if request_etree is None:
+        content_encoding = (django_request.META.get('HTTP_CONTENT_ENCODING') or 'identity').strip().lower()
+        if content_encoding == 'identity':
+            request_etree = parse_xml(django_request.body)
+        elif content_encoding in REQUEST_CONTENT_ENCODINGS:
+            request_etree = parse_xml_chunks(iter_decompressed_body(django_request))
+        else:
+            raise StatusMessageException('0', ST_BAD_MESSAGE,
+                                         'The request Content-Encoding is not supported: %s' % content_encoding)
+        django_request._taxii_etree = request_etree
+    return request_etree
+
+
+def get_message_from_etree(etree_xml, x_taxii_content_type):
+    """
+    Creates a libtaxii TAXII Message from an already-parsed lxml tree.
+
+    Arguments:
+        etree_xml - The root element of a TAXII XML Message
+        x_taxii_content_type - The X-TAXII-Content-Type of the message (e.g., VID_TAXII_XML_11)
+
+    Returns:
+        A tm11 or tm10 TAXII Message
+
+    Raises:
+        ValueError if the root element is not a known TAXII Message
+    """
+    binding = xml_bindings[x_taxii_content_type]
+    qn = etree.QName(etree_xml)
+    if qn.namespace != binding.namespace:
+        raise ValueError('Unsupported namespace: %s' % qn.namespace)
+
+    message_class = binding.message_classes.get(qn.localname)
+    if message_class is None:
+        raise ValueError('Unknown message_type: %s' % qn.localname)
+
+    return message_class.from_etree(etree_xml)
+
+
 def deserialize(django_request):
     """
     django_request - A django request that contains a TAXII Message to deserialize
@@ -150,6 +347,9 @@ def deserialize(django_request):
     if deserializer is None:
         raise Exception('Deserializer not found!')
 
+    if deserializer_key in etree_deserializer_keys:
+        return deserializer(get_request_etree(django_request))
+
     return deserializer(django_request.body)
 
 
@@ -170,6 +370,9 @@ def validate(django_request):
     if validator is None:
         raise Exception('Validator not found!')
 
+    if deserializer_key in etree_deserializer_keys:
+        return validator(get_request_etree(django_request))
+
     return validator(django_request.body)
 
 
@@ -181,9 +384,11 @@ def _get_deserializer_key(content_type, x_taxii_content_type):
 
 deserializers = {}
 validators = {}
+etree_deserializer_keys = set()
 
 
-def register_deserializer(content_type, x_taxii_content_type, deserialize_function, validate_function=None):
+def register_deserializer(content_type, x_taxii_content_type, deserialize_function, validate_function=None,
+                          accepts_etree=False):
     """
     Registers a deserializer for use.
     content_type - The Content-Type HTTP header value that this deserializer is used for
@@ -191,14 +396,47 @@ def register_deserializer(content_type, x_taxii_content_type, deserialize_functi
     deserialize_function - The deserializer function to be used for the specific content_type and x_taxii_content_type
     validate_function - The validation function to be used for the specific content_type and x_taxii_content_type. Can be None.
                         The validate_function must take a single string argument (representing the request.body) only.
+    accepts_etree - If True, deserialize_function and validate_function are passed the lxml tree of the
+                    request body (see get_request_etree) instead of the request body string.
     """
     deserializer_key = _get_deserializer_key(content_type, x_taxii_content_type)
     deserializers[deserializer_key] = deserialize_function
     validators[deserializer_key] = validate_function
+    if accepts_etree:
+        etree_deserializer_keys.add(deserializer_key)
+    else:
+        etree_deserializer_keys.discard(deserializer_key)
+
+
+def _etree_deserializer(x_taxii_content_type):
+    """
+    Internal use only.
+    """
+    def deserialize_function(etree_xml):
+        return get_message_from_etree(etree_xml, x_taxii_content_type)
+    return deserialize_function
+
+
+def _etree_validator(x_taxii_content_type):
+    """
+    Internal use only.
+    """
+    validator = xml_bindings[x_taxii_content_type].validator
+
+    def validate_function(etree_xml):
+        result = validator.validate_etree(etree_xml)
+        if not result.valid:
+            return result.error_log.last_error
+        return result.valid
+    return validate_function
 
 # A TAXII XML 1.1 and XML 1.0 Deserializer (libtaxii) is registered by default
-register_deserializer('application/xml', VID_TAXII_XML_11, tm11.get_message_from_xml, tm11.validate_xml)
-register_deserializer('application/xml', VID_TAXII_XML_10, tm10.get_message_from_xml, tm10.validate_xml)
+register_deserializer('application/xml', VID_TAXII_XML_11,
+                      _etree_deserializer(VID_TAXII_XML_11), _etree_validator(VID_TAXII_XML_11),
+                      accepts_etree=True)
+register_deserializer('application/xml', VID_TAXII_XML_10,
+                      _etree_deserializer(VID_TAXII_XML_10), _etree_validator(VID_TAXII_XML_10),
+                      accepts_etree=True)
 
 
 def deregister_deserializer(content_type, x_taxii_content_type):
@@ -206,3 +444,4 @@ def deregister_deserializer(content_type, x_taxii_content_type):
     """
     deserializer_key = _get_deserializer_key(content_type, x_taxii_content_type)
     del deserializers[deserializer_key]
+    etree_deserializer_keys.discard(deserializer_key)
@@ -0,0 +1,167 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Per-phase request timing.
+
+service_router and the message handlers wrap each phase of handling a
+request in ``with timed(django_request, PHASE):``. The time spent in each
+phase is kept on the request, sent back to the client in a Server-Timing
+header, and added to an in-process rolling window of samples for each
+(service path, message type) pair. get_stats() summarizes those windows.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+
+#: Schema validation of the request
+PHASE_VALIDATE = 'validate'
+#: Parsing the request into an lxml tree and a libtaxii message
+PHASE_PARSE = 'parse'
+#: Finding the TAXII Service and Message Handler
+PHASE_ROUTE = 'route'
+#: MessageHandler.handle_message
+PHASE_HANDLER = 'handler'
+#: QueryHandler.filter_content (part of PHASE_HANDLER)
+PHASE_FILTER = 'filter'
+#: Turning the response message into XML
+PHASE_SERIALIZE = 'serialize'
+#: The whole request
+PHASE_TOTAL = 'total'
+
+#: Upper bounds, in milliseconds, of the histogram buckets reported by get_stats()
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# {(service path, message type): deque of {phase: seconds}}
+_samples = {}
+_samples_lock = threading.Lock()
+
+
+def get_timings(django_request):
+    """
+    Returns the OrderedDict of {phase: seconds} kept on django_request,
+    creating it if needed.
+    """
+    metrics = getattr(django_request, 'taxii_metrics', None)
+    if metrics is None:
+        metrics = django_request.taxii_metrics = {}
+    return metrics.setdefault('timings', OrderedDict())
+
+
+@contextmanager
+def timed(django_request, phase):
+    """
+    Adds the time spent in the with block to phase's total for django_request.
+    A phase that is timed more than once accumulates. Nothing is recorded
+    if django_request is None.
+    """
+    if django_request is None:
+        yield
+        return
+
+    start = default_timer()
+    try:
+        yield
+    finally:
+        timings = get_timings(django_request)
+        timings[phase] = timings.get(phase, 0.0) + (default_timer() - start)
+
+
+def get_server_timing(timings):
+    """
+    Formats a dict of {phase: seconds} as a Server-Timing header value
+    """
+    return ', '.join('%s;dur=%.3f' % (phase, seconds * 1000) for phase, seconds in timings.iteritems())
+
+
+def set_server_timing_header(response, django_request):
+    """
+    Sets the Server-Timing header of response from django_request's timings,
+    if it has any.
+    """
+    metrics = getattr(django_request, 'taxii_metrics', None)
+    if metrics and metrics.get('timings'):
+        response['Server-Timing'] = get_server_timing(metrics['timings'])
+
+
+def record(service_path, message_type, timings):
+    """
+    Adds timings (a dict of {phase: seconds}) to the rolling window for
+    service_path and message_type. The window holds the most recent
+    TAXII_SERVICES_TIMING_WINDOW (default 1000) requests.
+    """
+    key = (service_path, message_type)
+    with _samples_lock:
+        window = _samples.get(key)
+        if window is None:
+            window = deque(maxlen=getattr(settings, 'TAXII_SERVICES_TIMING_WINDOW', 1000))
+            _samples[key] = window
+        window.append(dict(timings))
+
+
+def reset():
+    """
+    Throws away all recorded timings
+    """
+    with _samples_lock:
+        _samples.clear()
+
+
+def _percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(values_ms):
+    """
+    Summarizes a list of durations in milliseconds: count, mean,
+    percentiles, max and a histogram of HISTOGRAM_BUCKETS_MS.
+    """
+    values_ms = sorted(values_ms)
+    histogram = OrderedDict()
+    i = 0
+    for bound in HISTOGRAM_BUCKETS_MS:
+        while i < len(values_ms) and values_ms[i] <= bound:
+            i += 1
+        histogram['le_%s' % bound] = i
+    histogram['le_inf'] = len(values_ms)
+
+    return {'count': len(values_ms),
+            'mean_ms': sum(values_ms) / len(values_ms),
+            'p50_ms': _percentile(values_ms, 0.5),
+            'p90_ms': _percentile(values_ms, 0.9),
+            'p99_ms': _percentile(values_ms, 0.99),
+            'max_ms': values_ms[-1],
+            'histogram': histogram}
+
+
+def get_stats():
+    """
+    Summarizes the recorded timings.
+
+    Returns:
+        A dict of {service path: {message type: {'count': n, 'phases': {phase: summary}}}},
+        where each summary is the result of summarize().
+    """
+    with _samples_lock:
+        windows = [(key, list(window)) for key, window in _samples.iteritems()]
+
+    stats = {}
+    for (service_path, message_type), samples in windows:
+        if not samples:
+            continue
+        phases = {}
+        for sample in samples:
+            for phase, seconds in sample.iteritems():
+                phases.setdefault(phase, []).append(seconds * 1000)
+        stats.setdefault(service_path, {})[message_type] = {
+            'count': len(samples),
+            'phases': dict((phase, summarize(values)) for phase, values in phases.iteritems())
+        }
+    return stats
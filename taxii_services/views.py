@@ -5,31 +5,21 @@
 
 from __future__ import absolute_import
 
-from StringIO import StringIO
-import collections
-from importlib import import_module
-import sys
 import traceback
 
 from django.conf import settings
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from libtaxii.constants import *
 import libtaxii.messages_10 as tm10
 import libtaxii.messages_11 as tm11
-from libtaxii.validation import TAXII10Validator, TAXII11Validator
 from lxml.etree import XMLSyntaxError
 
-from taxii_services import handlers
+from taxii_services import handlers, metrics, models
 from taxii_services.exceptions import StatusMessageException
-from taxii_services.util import request_utils
-
-ParseTuple = collections.namedtuple('ParseTuple', ['validator', 'parser'])
-
-TAXII_10_ParseTuple = ParseTuple(TAXII10Validator(), tm10.get_message_from_xml)
-TAXII_11_ParseTuple = ParseTuple(TAXII11Validator(), tm11.get_message_from_xml)
-
-xtct_map = {VID_TAXII_XML_10: TAXII_10_ParseTuple,
-            VID_TAXII_XML_11: TAXII_11_ParseTuple}
+from taxii_services.util import request_utils, timing
+from taxii_services.util.timing import timed
 
 PV_ERR = "There was an error parsing and validating the request message."
 
@@ -38,7 +28,12 @@ def service_router(request, path, do_validate=True):
     """
     Takes in a request, path, and TAXII Message,
     and routes the taxii_message to the Service Handler.
+
+    The time spent in each phase is recorded (see util.timing) and
+    returned to the client in a Server-Timing header.
     """
+    start = timing.default_timer()
+    timings = timing.get_timings(request)
 
     if request.method != 'POST':
         raise StatusMessageException('0', ST_BAD_MESSAGE, 'Request method was not POST!')
@@ -47,53 +42,76 @@ def service_router(request, path, do_validate=True):
     if not xtct:
         raise StatusMessageException('0', ST_BAD_MESSAGE, 'The X-TAXII-Content-Type Header was not present.')
 
-    parse_tuple = xtct_map.get(xtct)
-    if not parse_tuple:
+    xml_binding = request_utils.xml_bindings.get(xtct)
+    if not xml_binding:
         raise StatusMessageException('0', ST_BAD_MESSAGE, 'The X-TAXII-Content-Type Header is not supported.')
 
+    with timed(request, timing.PHASE_ROUTE):
+        service = handlers.get_service_from_path(request.path)
+
+    # The service's validation policy decides how much checking the
+    # request gets. do_validate=False turns validation off entirely
     if do_validate:
-        msg = None  # None means no error, a non-None value means an error happened
-        try:
-            result = parse_tuple.validator.validate_string(request.body)
+        validation_mode = service.get_validation_mode(request)
+    else:
+        validation_mode = models.VALIDATION_SKIPPED
+    request.taxii_metrics['service_path'] = service.path
+    request.taxii_metrics['validation_mode'] = validation_mode
+
+    # The request body is parsed exactly once. The same tree is
+    # validated and then turned into a libtaxii message. Parsing alone
+    # checks that the request is well-formed
+    msg = None  # None means no error, a non-None value means an error happened
+    try:
+        with timed(request, timing.PHASE_PARSE):
+            request_etree = request_utils.get_request_etree(request)
+        if validation_mode == models.VALIDATE_FULL[0]:
+            with timed(request, timing.PHASE_VALIDATE):
+                result = xml_binding.validator.validate_etree(request_etree)
             if not result.valid:
                 if settings.DEBUG is True:
                     msg = 'Request was not schema valid: %s' % [err for err in result.error_log]
                 else:
                     msg = PV_ERR
-        except XMLSyntaxError as e:
-            if settings.DEBUG is True:
-                msg = 'Request was not well-formed XML: %s' % str(e)
-            else:
-                msg = PV_ERR
+    except XMLSyntaxError as e:
+        if settings.DEBUG is True:
+            msg = 'Request was not well-formed XML: %s' % str(e)
+        else:
+            msg = PV_ERR
 
-        if msg is not None:
-            raise StatusMessageException('0', ST_BAD_MESSAGE, msg)
+    if msg is not None:
+        raise StatusMessageException('0', ST_BAD_MESSAGE, msg)
 
     try:
-        taxii_message = parse_tuple.parser(request.body)
+        with timed(request, timing.PHASE_PARSE):
+            taxii_message = request_utils.get_message_from_etree(request_etree, xtct)
     except tm11.UnsupportedQueryException as e:
         # TODO: Is it possible to give the real message id?
         # TODO: Is it possible to indicate which query aspects are supported?
         # This might require a change in how libtaxii works
         raise StatusMessageException('0',
                                      ST_UNSUPPORTED_QUERY)
+    except Exception as e:
+        # Without schema validation, a well-formed document that is not
+        # a valid TAXII Message only surfaces here
+        if settings.DEBUG is True:
+            msg = 'Request could not be read as a TAXII Message: %s' % str(e)
+        else:
+            msg = PV_ERR
+        raise StatusMessageException('0', ST_BAD_MESSAGE, msg)
 
-    service = handlers.get_service_from_path(request.path)
-    handler = service.get_message_handler(taxii_message)
-    module_name, class_name = handler.handler.rsplit('.', 1)
+    request.taxii_metrics['message_type'] = taxii_message.message_type
 
-    try:
-        module = import_module(module_name)
-        handler_class = getattr(module, class_name)
-    except Exception as e:
-        type, value, tb = sys.exc_info()
-        raise type, ("Error importing handler: %s" % handler.handler, type, value), tb
+    with timed(request, timing.PHASE_ROUTE):
+        handler = service.get_message_handler(taxii_message)
+        handler_class = handler.get_handler_class()
 
     handler_class.validate_headers(request, taxii_message.message_id)
     handler_class.validate_message_is_supported(taxii_message)
 
     try:
-        response_message = handler_class.handle_message(service, taxii_message, request)
+        with timed(request, timing.PHASE_HANDLER):
+            response_message = handler_class.handle_message(service, taxii_message, request)
     except StatusMessageException:
         raise  # The handler_class has intentionally raised this
     except Exception as e:  # Something else happened
@@ -117,13 +135,79 @@ def service_router(request, path, do_validate=True):
                                      ST_FAILURE,
                                      msg)
 
-    if response_message.__module__ == 'libtaxii.messages_11':
+    if isinstance(response_message, tm11.TAXIIMessage):
         vid = VID_TAXII_SERVICES_11
-    elif response_message.__module__ == 'libtaxii.messages_10':
+    elif isinstance(response_message, tm10.TAXIIMessage):
         vid = VID_TAXII_SERVICES_10
     else:
         raise ValueError("Unknown response message module")
 
     response_headers = handlers.get_headers(vid, request.is_secure())
 
-    return handlers.HttpResponseTaxii(response_message.to_xml(pretty_print=True), response_headers)
+    # Poll Responses with a queryset of Content Blocks are written while it is read
+    streaming = getattr(response_message, 'content_block_queryset', None) is not None
+    with timed(request, timing.PHASE_SERIALIZE):
+        if streaming:
+            response = handlers.StreamingHttpResponseTaxii(stream_poll_response(response_message,
+                                                                                 service.pretty_print,
+                                                                                 service.path),
+                                                           response_headers,
+                                                           content_encoding=handlers.get_content_encoding(request))
+        else:
+            response = handlers.HttpResponseTaxii(response_message.to_xml(pretty_print=service.pretty_print),
+                                                  response_headers,
+                                                  content_encoding=handlers.get_content_encoding(request))
+
+    timings[timing.PHASE_TOTAL] = timing.default_timer() - start
+    timing.record(service.path, taxii_message.message_type, timings)
+
+    metrics.inc(metrics.REQUESTS, service=service.path, message_type=taxii_message.message_type,
+                status_type=getattr(response_message, 'status_type', ''))
+    metrics.observe(metrics.REQUEST_DURATION, timings[timing.PHASE_TOTAL],
+                    service=service.path, message_type=taxii_message.message_type)
+    if response_message.message_type == MSG_POLL_RESPONSE and not streaming:
+        # Pre-rendered Poll Responses don't hold their Content Blocks
+        served = getattr(response_message, 'content_block_count', None)
+        if served is None:
+            served = len(response_message.content_blocks)
+        metrics.inc(metrics.CONTENT_BLOCKS_SERVED, served, service=service.path)
+    timing.set_server_timing_header(response, request)
+    return response
+
+
+def stream_poll_response(poll_response, pretty_print, service_path):
+    """
+    Yields the XML of a Poll Response with a content_block_queryset (see
+    models.FragmentPollResponseMixin.iter_xml), then counts its Content
+    Blocks as served. The serialize phase of a streamed response's timings
+    doesn't include writing the Content Blocks.
+    """
+    for chunk in poll_response.iter_xml(pretty_print):
+        yield chunk
+    metrics.inc(metrics.CONTENT_BLOCKS_SERVED, poll_response.content_block_count, service=service_path)
+
+
+@require_GET
+def timing_stats(request):
+    """
+    Read-only JSON view of the per-phase timings recorded by service_router
+    in this process (see util.timing.get_stats).
+
+    taxii_services.urls does not route to this view, since its path could
+    collide with a TAXII Service's. To expose it, add something like
+    url(r'^taxii-stats/$', timing_stats) ahead of the service_router
+    pattern, protected however the deployment sees fit.
+    """
+    return JsonResponse(timing.get_stats())
+
+
+@require_GET
+def prometheus_metrics(request):
+    """
+    Exports the counters and histograms in taxii_services.metrics in the
+    Prometheus text exposition format. When TAXII_SERVICES_METRICS_DIR is
+    set, the values of every worker process are included.
+
+    Like timing_stats, this view is not routed by taxii_services.urls.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,11 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+End-to-end benchmarks for django-taxii-services.
+
+The benchmarks build a Data Collection of configurable size from the STIX
+samples in tests/test_content and time requests sent through the Django
+test client. Run them with runbenchmarks.py in the repository root; see
+``python runbenchmarks.py --help``.
+"""
@@ -0,0 +1,84 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from itertools import cycle
+import os
+
+from libtaxii.constants import CB_STIX_XML_111
+
+from taxii_services import handlers
+from taxii_services.models import (ContentBindingAndSubtype, ContentBlock, DataCollection, PollService,
+                                   backfill_collection_membership, rebuild_collection_statistics)
+
+from ..helpers import add_basics, add_collection_service, add_discovery_service, add_inbox_service, add_poll_service
+
+#: Paths of the services added by setup_services
+POLL_PATH = '/test_poll_1/'
+INBOX_PATH = '/test_inbox_2/'
+
+#: The directory holding the STIX 1.1.1 samples
+STIX_111_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test_content', 'stix_111')
+
+#: Samples larger than this many bytes are left out. The largest samples are
+#: several megabytes, which would make large collections impractical to build
+MAX_SAMPLE_SIZE = 100 * 1024
+# Rows inserted per query when building a collection
+BATCH_SIZE = 1000
+
+
+def load_samples():
+    """
+    Returns the contents of every STIX 1.1.1 sample of at most
+    MAX_SAMPLE_SIZE bytes, sorted by filename
+    """
+    samples = []
+    for filename in sorted(os.listdir(STIX_111_DIR)):
+        path = os.path.join(STIX_111_DIR, filename)
+        if os.path.getsize(path) > MAX_SAMPLE_SIZE:
+            continue
+        with open(path) as f:
+            samples.append(f.read())
+    return samples
+
+
+def build_collection(size, collection='default'):
+    """
+    Adds size Content Blocks, cycling through the STIX samples, to collection.
+    Rows are inserted in batches, so collections of a million blocks can be
+    built in reasonable time. Bulk inserts skip the signals that maintain the
+    collection's statistics and membership table, so they are rebuilt at the end.
+    """
+    collection = DataCollection.objects.get(name=collection)
+    cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+    through = DataCollection.content_blocks.through
+    samples = cycle(load_samples())
+
+    added = 0
+    while added < size:
+        count = min(BATCH_SIZE, size - added)
+        blocks = [ContentBlock(content_binding_and_subtype=cbas, content=next(samples)) for i in range(count)]
+        ContentBlock.objects.bulk_create(blocks)
+        # Not every database returns primary keys from bulk_create
+        ids = ContentBlock.objects.order_by('-id').values_list('id', flat=True)[:count]
+        through.objects.bulk_create([through(datacollection_id=collection.pk, contentblock_id=id_)
+                                     for id_ in ids])
+        added += count
+
+    rebuild_collection_statistics(collection.pk)
+    backfill_collection_membership()
+
+
+def setup_services(page_size):
+    """
+    Adds the bindings, handlers and services used by the benchmarks. The
+    Poll Service returns page_size Content Blocks per Result Set Part.
+    """
+    add_basics()
+    add_discovery_service()
+    add_collection_service()
+    add_inbox_service()
+    add_poll_service()
+    PollService.objects.filter(path=POLL_PATH).update(max_result_size=page_size)
+    handlers.invalidate_service_index()
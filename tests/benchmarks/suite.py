@@ -0,0 +1,167 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.test import Client
+from libtaxii.common import generate_message_id
+from libtaxii.constants import *
+import libtaxii.messages_11 as tm11
+import libtaxii.taxii_default_query as tdq
+
+from ..constants import COLLECTION_PATH, DISCOVERY_PATH, TAXII_11_HTTP_Headers
+from .fixtures import INBOX_PATH, POLL_PATH, load_samples
+
+#: Matches only the APT1 report in the STIX samples
+QUERY_TARGET = 'STIX_Package/Threat_Actors/Threat_Actor/Identity/Specification/PartyName/OrganisationName/SubDivisionName'
+QUERY_VALUE = 'Unit 61398'
+
+
+class Benchmark(object):
+    """
+    Sends TAXII 1.1 messages through the Django test client and times them.
+    """
+
+    def __init__(self, repeat, inbox_batch_size):
+        self.client = Client()
+        self.repeat = repeat
+        self.inbox_batch_size = inbox_batch_size
+
+    def post(self, path, message):
+        response = self.client.post(path, message.to_xml(), content_type='application/xml',
+                                    **TAXII_11_HTTP_Headers)
+        if response.status_code != 200:
+            raise ValueError('Request to %s failed with HTTP %s' % (path, response.status_code))
+        response_message = tm11.get_message_from_xml(response.content)
+        if response_message.message_type == MSG_STATUS_MESSAGE and response_message.status_type != ST_SUCCESS:
+            raise ValueError('Request to %s failed: %s %s' % (path, response_message.status_type,
+                                                             response_message.message))
+        return response_message
+
+    def time(self, func):
+        """
+        Calls func self.repeat times.
+
+        Returns:
+            A list of durations in seconds
+        """
+        durations = []
+        for i in range(self.repeat):
+            start = default_timer()
+            func()
+            durations.append(default_timer() - start)
+        return durations
+
+    def discovery(self):
+        return self.time(lambda: self.post(DISCOVERY_PATH, tm11.DiscoveryRequest(generate_message_id())))
+
+    def collection_information(self):
+        return self.time(lambda: self.post(COLLECTION_PATH,
+                                           tm11.CollectionInformationRequest(generate_message_id())))
+
+    def _poll_request(self, query=None):
+        return tm11.PollRequest(message_id=generate_message_id(),
+                                collection_name='default',
+                                poll_parameters=tm11.PollParameters(query=query))
+
+    def poll(self):
+        return self.time(lambda: self.post(POLL_PATH, self._poll_request()))
+
+    def poll_query(self):
+        test = tdq.Test(capability_id=CM_CORE,
+                        relationship=R_EQUALS,
+                        parameters={P_VALUE: QUERY_VALUE, P_MATCH_TYPE: 'case_sensitive_string'})
+        criteria = tdq.Criteria(OP_AND, criterion=[tdq.Criterion(target=QUERY_TARGET, test=test)])
+        query = tdq.DefaultQuery(CB_STIX_XML_111, criteria)
+        return self.time(lambda: self.post(POLL_PATH, self._poll_request(query)))
+
+    def poll_fulfillment(self):
+        poll_response = self.post(POLL_PATH, self._poll_request())
+        if not poll_response.more:
+            return []  # The collection fits in one part; nothing to fulfill
+
+        def fulfill():
+            pfr = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                              collection_name='default',
+                                              result_id=poll_response.result_id,
+                                              result_part_number=2)
+            self.post(POLL_PATH, pfr)
+        return self.time(fulfill)
+
+    def inbox(self):
+        samples = load_samples()
+        content_blocks = [tm11.ContentBlock(CB_STIX_XML_111, samples[i % len(samples)])
+                          for i in range(self.inbox_batch_size)]
+        return self.time(lambda: self.post(INBOX_PATH, tm11.InboxMessage(generate_message_id(),
+                                                                         destination_collection_names=['default'],
+                                                                         content_blocks=content_blocks)))
+
+
+#: Benchmark names, in the order they run. Inbox runs last because it adds
+#: Content Blocks to the collection the polls read.
+BENCHMARKS = ('discovery', 'collection_information', 'poll', 'poll_query', 'poll_fulfillment', 'inbox')
+
+
+def summarize(durations):
+    """
+    Returns a dict of statistics, in milliseconds, for a list of durations in seconds
+    """
+    values = sorted(d * 1000 for d in durations)
+    middle = len(values) // 2
+    if len(values) % 2:
+        median = values[middle]
+    else:
+        median = (values[middle - 1] + values[middle]) / 2
+    return OrderedDict([('count', len(values)),
+                        ('min_ms', values[0]),
+                        ('median_ms', median),
+                        ('mean_ms', sum(values) / len(values)),
+                        ('max_ms', values[-1])])
+
+
+def run_benchmarks(names=BENCHMARKS, repeat=10, inbox_batch_size=100):
+    """
+    Runs the named benchmarks against the services added by
+    fixtures.setup_services.
+
+    Returns:
+        An OrderedDict of {benchmark name: summarize() result}. The inbox
+        result also has a blocks_per_second throughput.
+    """
+    benchmark = Benchmark(repeat, inbox_batch_size)
+    results = OrderedDict()
+    for name in BENCHMARKS:
+        if name not in names:
+            continue
+        durations = getattr(benchmark, name)()
+        if not durations:
+            continue
+        results[name] = summarize(durations)
+        if name == 'inbox':
+            results[name]['blocks_per_second'] = inbox_batch_size * len(durations) / sum(durations)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the median of each result with the baseline's.
+
+    Arguments:
+        results - The results of run_benchmarks
+        baseline - Results previously returned by run_benchmarks
+        tolerance - The fraction by which a median may exceed the baseline's (e.g., 0.2)
+
+    Returns:
+        A list of (name, baseline median, median) tuples, one for each regression
+    """
+    regressions = []
+    for name, result in results.iteritems():
+        if name not in baseline:
+            continue
+        baseline_median = baseline[name]['median_ms']
+        if result['median_ms'] > baseline_median * (1 + tolerance):
+            regressions.append((name, baseline_median, result['median_ms']))
+    return regressions
@@ -20,7 +20,7 @@ def get_message_from_client_response(resp, in_response_to):
     """ helper func"""
 
     taxii_content_type = resp.get('X-TAXII-Content-Type', None)
-    response_message = resp.content
+    response_message = ''.join(resp.streaming_content) if resp.streaming else resp.content
 
     if taxii_content_type is None:
         m = str(resp) + '\r\n' + response_message
@@ -0,0 +1,34 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from django.test import TestCase
+
+from taxii_services.models import DataCollection
+
+from .benchmarks import fixtures, suite
+
+
+class BenchmarkSuiteTests(TestCase):
+    """
+    Keeps the benchmark suite runnable. The numbers themselves are not checked.
+    """
+
+    def setUp(self):
+        fixtures.setup_services(page_size=2)
+
+    def test_build_collection(self):
+        fixtures.build_collection(7)
+        self.assertEqual(7, DataCollection.objects.get(name='default').content_blocks.count())
+
+    def test_run_benchmarks(self):
+        fixtures.build_collection(5)
+        results = suite.run_benchmarks(repeat=1, inbox_batch_size=2)
+        self.assertEqual(list(suite.BENCHMARKS), list(results))
+        self.assertGreater(results['inbox']['blocks_per_second'], 0)
+
+    def test_compare(self):
+        baseline = {'poll': {'median_ms': 10.0}, 'discovery': {'median_ms': 10.0}}
+        results = {'poll': {'median_ms': 13.0}, 'discovery': {'median_ms': 11.0}, 'inbox': {'median_ms': 1.0}}
+        self.assertEqual([('poll', 10.0, 13.0)], suite.compare(results, baseline, 0.2))
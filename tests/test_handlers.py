@@ -0,0 +1,156 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+import json
+import zlib
+
+from django.http import Http404
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from taxii_services import handlers, views
+from taxii_services.util import timing
+
+from .base import DJTTestCase
+from .helpers import *
+
+
+class ServiceRoutingTests(DJTTestCase):
+
+    def setUp(self):
+        super(ServiceRoutingTests, self).setUp()
+        add_discovery_service()
+        add_collection_service()
+
+    def test_lookup_uses_index(self):
+        """
+        After the routing index is built, lookups do not touch the database.
+        """
+        handlers.invalidate_service_index()
+        service = handlers.get_service_from_path(COLLECTION_PATH)
+        self.assertIsInstance(service, CollectionManagementService)
+
+        with self.assertNumQueries(0):
+            service = handlers.get_service_from_path(COLLECTION_PATH)
+            self.assertIsNotNone(service.collection_information_handler)
+            service = handlers.get_service_from_path(DISCOVERY_PATH)
+            self.assertIsInstance(service, DiscoveryService)
+
+    def test_save_invalidates_index(self):
+        """
+        Disabling a service removes it from the routing index.
+        """
+        handlers.get_service_from_path(DISCOVERY_PATH)
+
+        ds = DiscoveryService.objects.get(path=DISCOVERY_PATH)
+        ds.enabled = False
+        ds.save()
+        self.assertRaises(Http404, handlers.get_service_from_path, DISCOVERY_PATH)
+
+        ds.enabled = True
+        ds.save()
+        self.assertEqual(ds.pk, handlers.get_service_from_path(DISCOVERY_PATH).pk)
+
+    def test_delete_invalidates_index(self):
+        handlers.get_service_from_path(DISCOVERY_PATH)
+        DiscoveryService.objects.filter(path=DISCOVERY_PATH).delete()
+        self.assertRaises(Http404, handlers.get_service_from_path, DISCOVERY_PATH)
+
+
+class ResponseCompressionTests(DJTTestCase):
+
+    def setUp(self):
+        super(ResponseCompressionTests, self).setUp()
+        add_discovery_service()
+
+    def get_content_encoding(self, accept_encoding):
+        request = RequestFactory().post(DISCOVERY_PATH, HTTP_ACCEPT_ENCODING=accept_encoding)
+        return handlers.get_content_encoding(request)
+
+    def test_negotiation(self):
+        self.assertEqual('gzip', self.get_content_encoding('gzip, deflate'))
+        self.assertEqual('deflate', self.get_content_encoding('gzip;q=0.5, deflate'))
+        self.assertEqual('gzip', self.get_content_encoding('*'))
+        self.assertEqual('deflate', self.get_content_encoding('*, gzip;q=0'))
+        self.assertIsNone(self.get_content_encoding('identity'))
+        self.assertIsNone(self.get_content_encoding('gzip;q=0'))
+        self.assertIsNone(handlers.get_content_encoding(RequestFactory().post(DISCOVERY_PATH)))
+
+    @override_settings(TAXII_SERVICES_COMPRESSION_THRESHOLD=0)
+    def test_compressed_response(self):
+        headers = self._get_headers(None, False)
+        uncompressed = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml(), headers)
+        self.assertNotIn('Content-Encoding', uncompressed)
+        self.assertEqual('Accept-Encoding', uncompressed['Vary'])
+
+        headers['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        response = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml(), headers)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        content = zlib.decompress(response.content, 16 + zlib.MAX_WBITS)
+        self.assertIsInstance(tm11.get_message_from_xml(content), tm11.DiscoveryResponse)
+
+    def test_threshold(self):
+        headers = self._get_headers(None, False)
+        headers['HTTP_ACCEPT_ENCODING'] = 'deflate'
+        with self.settings(TAXII_SERVICES_COMPRESSION_THRESHOLD=None):
+            response = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml(), headers)
+            self.assertNotIn('Content-Encoding', response)
+
+        with self.settings(TAXII_SERVICES_COMPRESSION_THRESHOLD=10 ** 6):
+            response = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml(), headers)
+            self.assertNotIn('Content-Encoding', response)
+
+    def test_positional_arguments(self):
+        """
+        Positional arguments after the headers go to HttpResponse, not content_encoding.
+        """
+        headers = handlers.get_headers(VID_TAXII_SERVICES_11, False)
+        response = handlers.HttpResponseTaxii('<xml/>', headers, '', 'text/xml', 202)
+        self.assertEqual(202, response.status_code)
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_pretty_print(self):
+        DiscoveryService.objects.filter(path=DISCOVERY_PATH).update(pretty_print=False)
+        handlers.invalidate_service_index()
+        response = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml())
+        self.assertNotIn('\n', response.content.strip())
+
+
+class TimingTests(DJTTestCase):
+
+    def setUp(self):
+        super(TimingTests, self).setUp()
+        add_discovery_service()
+        timing.reset()
+
+    def test_server_timing(self):
+        response = self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml())
+        phases = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        for phase in (timing.PHASE_ROUTE, timing.PHASE_PARSE, timing.PHASE_VALIDATE,
+                      timing.PHASE_HANDLER, timing.PHASE_SERIALIZE, timing.PHASE_TOTAL):
+            self.assertIn(phase, phases)
+
+    def test_error_response(self):
+        response = self.post(DISCOVERY_PATH, '<malformed_xml>')
+        self.assertStatusMessage(response, ST_BAD_MESSAGE)
+        self.assertIn(timing.PHASE_PARSE, response['Server-Timing'])
+
+    def test_stats(self):
+        for i in range(3):
+            self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml())
+
+        response = views.timing_stats(RequestFactory().get('/stats/'))
+        stats = json.loads(response.content)
+        handler_stats = stats[DISCOVERY_PATH][MSG_DISCOVERY_REQUEST]
+        self.assertEqual(3, handler_stats['count'])
+        self.assertEqual(3, handler_stats['phases'][timing.PHASE_TOTAL]['histogram']['le_inf'])
+
+    def test_summarize(self):
+        summary = timing.summarize([1, 3, 3, 20000])
+        self.assertEqual(4, summary['count'])
+        self.assertEqual(1, summary['histogram']['le_1'])
+        self.assertEqual(3, summary['histogram']['le_5'])
+        self.assertEqual(3, summary['histogram']['le_10000'])
+        self.assertEqual(20000, summary['max_ms'])
@@ -0,0 +1,58 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import RequestFactory
+
+from taxii_services import metrics, views
+
+from .base import DJTTestCase
+from .helpers import *
+
+
+class MetricsTests(DJTTestCase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        add_discovery_service()
+        metrics.reset()
+
+    def get_metrics(self):
+        response = views.prometheus_metrics(RequestFactory().get('/metrics/'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content
+
+    def test_requests(self):
+        self.post(DISCOVERY_PATH, tm11.DiscoveryRequest('1').to_xml())
+        self.post(DISCOVERY_PATH, '<malformed_xml>')
+
+        text = self.get_metrics()
+        self.assertIn('taxii_requests_total{message_type="Discovery_Request",service="%s",status_type=""} 1' %
+                      DISCOVERY_PATH, text)
+        self.assertIn('taxii_requests_total{message_type="",service="%s",status_type="BAD_MESSAGE"} 1' %
+                      DISCOVERY_PATH, text)
+        self.assertIn('taxii_request_duration_seconds_count{message_type="Discovery_Request",service="%s"} 1' %
+                      DISCOVERY_PATH, text)
+        self.assertIn('# TYPE taxii_request_duration_seconds histogram', text)
+        self.assertIn('taxii_cache_hit_ratio{cache="service_index"}', text)
+
+    def test_shared_directory(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+
+        # A snapshot written by another worker
+        other = {'counters': [[metrics.RESULT_SETS_CREATED, [], 2]], 'histograms': []}
+        with open(os.path.join(metrics_dir, 'taxii-metrics-1-other.json'), 'w') as f:
+            json.dump(other, f)
+
+        with self.settings(TAXII_SERVICES_METRICS_DIR=metrics_dir):
+            metrics.inc(metrics.RESULT_SETS_CREATED)
+            metrics.flush()
+            self.assertEqual(2, len([n for n in os.listdir(metrics_dir) if n.startswith('taxii-metrics-')]))
+            self.assertIn('taxii_result_sets_created_total 3\n', self.get_metrics())
@@ -1,4 +1,281 @@
 # Copyright (c) 2014, The MITRE Corporation. All rights reserved.
 # For license information, see the LICENSE.txt file
 
-# TODO: Implement this module
+from __future__ import absolute_import
+
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+from libtaxii.validation import SchemaValidator
+
+from taxii_services.message_handlers import PollRequestHandler
+from taxii_services.models import (CollectionMembership, FragmentPollResponse10, FragmentPollResponse11,
+                                   _handler_registry, backfill_collection_membership, rebuild_collection_statistics,
+                                   resolve_handler)
+
+from .helpers import *
+
+
+class HandlerRegistryTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+
+    def test_handler_class(self):
+        """
+        The registry resolves the handler class.
+        """
+        mh = MessageHandler.objects.get(handler='taxii_services.message_handlers.PollRequestHandler')
+        self.assertIs(PollRequestHandler, mh.get_handler_class())
+        # Subsequent lookups are served from the registry
+        self.assertIs(PollRequestHandler, _handler_registry[mh.handler])
+        self.assertIs(PollRequestHandler, resolve_handler(mh.handler))
+
+    def test_query_handler_class(self):
+        qh = QueryHandler.objects.get(handler='taxii_services.query_handlers.StixXml111QueryHandler')
+        self.assertEqual('StixXml111QueryHandler', qh.get_handler_class().__name__)
+
+    def test_save_invalidates_registry(self):
+        mh = MessageHandler.objects.get(handler='taxii_services.message_handlers.PollRequestHandler')
+        mh.get_handler_class()
+        old_handler = mh.handler
+        mh.handler = 'taxii_services.message_handlers.poll_request_handlers.PollRequestHandler'
+        mh.save()
+        self.assertNotIn(old_handler, _handler_registry)
+
+    def test_unknown_handler(self):
+        self.assertRaises(ImportError, resolve_handler, 'taxii_services.does_not_exist.Handler')
+
+
+class DataCollectionStatisticsTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        self.collection = DataCollection.objects.get(name='default')
+        self.stix = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        self.other = ContentBindingAndSubtype.objects.exclude(pk=self.stix.pk).first()
+
+    def add_content_block(self, content, cbas=None):
+        cb = ContentBlock(content_binding_and_subtype=cbas or self.stix, content=content)
+        cb.save()
+        self.collection.content_blocks.add(cb)
+        return cb
+
+    def assertStatisticsCurrent(self):
+        """
+        The incrementally maintained statistics match a rebuild
+        """
+        statistics = self.collection.get_statistics()
+        counts = dict(statistics.content_binding_counts.values_list('content_binding_and_subtype', 'count'))
+        rebuilt = rebuild_collection_statistics(self.collection.pk)
+        self.assertEqual((rebuilt.total_content_blocks, rebuilt.bytes_stored,
+                          rebuilt.min_timestamp_label, rebuilt.max_timestamp_label),
+                         (statistics.total_content_blocks, statistics.bytes_stored,
+                          statistics.min_timestamp_label, statistics.max_timestamp_label))
+        self.assertEqual(dict(rebuilt.content_binding_counts.values_list('content_binding_and_subtype', 'count')),
+                         counts)
+        return rebuilt
+
+    def test_add_and_remove(self):
+        first = self.add_content_block('<a/>')
+        self.add_content_block('<bb/>')
+        last = self.add_content_block('<ccc/>', self.other)
+        statistics = self.assertStatisticsCurrent()
+        self.assertEqual(3, statistics.total_content_blocks)
+        self.assertEqual(15, statistics.bytes_stored)
+        self.assertEqual(first.timestamp_label, statistics.min_timestamp_label)
+        self.assertEqual(last.timestamp_label, statistics.max_timestamp_label)
+        self.assertEqual(2, statistics.count_content_blocks([self.stix]))
+
+        self.collection.content_blocks.remove(first)
+        self.collection.content_blocks.remove(first)  # Not a member any more
+        statistics = self.assertStatisticsCurrent()
+        self.assertEqual(2, statistics.total_content_blocks)
+
+        last.delete()
+        statistics = self.assertStatisticsCurrent()
+        self.assertEqual(1, statistics.total_content_blocks)
+        self.assertEqual(0, statistics.count_content_blocks([self.other]))
+
+        self.collection.content_blocks.clear()
+        statistics = self.assertStatisticsCurrent()
+        self.assertEqual(0, statistics.total_content_blocks)
+        self.assertIsNone(statistics.min_timestamp_label)
+
+    def test_reverse_relation(self):
+        cb = self.add_content_block('<a/>')
+        cb.datacollection_set.clear()
+        self.assertEqual(0, self.assertStatisticsCurrent().total_content_blocks)
+        cb.datacollection_set.add(self.collection)
+        self.assertEqual(1, self.assertStatisticsCurrent().total_content_blocks)
+
+    def test_content_block_changed(self):
+        first = self.add_content_block('<a/>')
+        middle = self.add_content_block('<bb/>')
+        last = self.add_content_block('<ccc/>')
+
+        # Past the newest Content Block
+        middle.timestamp_label = last.timestamp_label + timedelta(seconds=1)
+        middle.save()
+        self.assertEqual(middle.timestamp_label, self.assertStatisticsCurrent().max_timestamp_label)
+
+        # The newest Content Block moves back
+        middle.timestamp_label = first.timestamp_label
+        middle.save()
+        self.assertEqual(last.timestamp_label, self.assertStatisticsCurrent().max_timestamp_label)
+
+        middle.content_binding_and_subtype = self.other
+        middle.content = '<bbbb/>'
+        middle.save(update_fields=['content_binding_and_subtype', 'content'])
+        statistics = self.assertStatisticsCurrent()
+        self.assertEqual(1, statistics.count_content_blocks([self.other]))
+        self.assertEqual(17, statistics.bytes_stored)
+
+    def test_collection_volume(self):
+        self.add_content_block('<a/>')
+        self.assertEqual(1, self.collection.to_collection_information_11().collection_volume)
+
+
+class CollectionMembershipTests(TestCase):
+
+    def setUp(self):
+        add_basics()
+        self.collection = DataCollection.objects.get(name='default')
+        self.stix = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        self.other = ContentBindingAndSubtype.objects.exclude(pk=self.stix.pk).first()
+
+    def add_content_block(self, content, cbas=None):
+        cb = ContentBlock(content_binding_and_subtype=cbas or self.stix, content=content)
+        cb.save()
+        self.collection.content_blocks.add(cb)
+        return cb
+
+    def assertMembershipCurrent(self):
+        """
+        CollectionMembership matches DataCollection.content_blocks
+        """
+        through = DataCollection.content_blocks.through
+        self.assertEqual(sorted(through.objects.values_list('datacollection_id', 'contentblock_id')),
+                         sorted(CollectionMembership.objects.values_list('data_collection_id', 'content_block_id')))
+        for membership in CollectionMembership.objects.select_related('content_block'):
+            self.assertEqual(membership.content_block.timestamp_label, membership.timestamp_label)
+            self.assertEqual(membership.content_block.content_binding_and_subtype_id,
+                             membership.content_binding_and_subtype_id)
+
+    def test_add_and_remove(self):
+        first = self.add_content_block('<a/>')
+        last = self.add_content_block('<b/>', self.other)
+        self.assertMembershipCurrent()
+        self.assertEqual([first, last], list(self.collection.filter_content_blocks()))
+        content = self.collection.filter_content_blocks(content_binding_and_subtype__in=[self.other])
+        self.assertEqual([last], list(content))
+        content = self.collection.filter_content_blocks(timestamp_label__lte=first.timestamp_label)
+        self.assertEqual([first], list(content))
+
+        self.collection.content_blocks.remove(first)
+        self.assertMembershipCurrent()
+        last.datacollection_set.clear()
+        self.assertMembershipCurrent()
+        last.datacollection_set.add(self.collection)
+        self.assertMembershipCurrent()
+        self.collection.content_blocks.clear()
+        self.assertMembershipCurrent()
+
+    def test_content_block_changed(self):
+        cb = self.add_content_block('<a/>')
+        cb.content_binding_and_subtype = self.other
+        cb.save()
+        self.assertMembershipCurrent()
+        cb.delete()
+        self.assertMembershipCurrent()
+
+    def test_backfill(self):
+        cb = ContentBlock(content_binding_and_subtype=self.stix, content='<a/>')
+        cb.save()
+        # Bulk inserts don't send m2m_changed
+        through = DataCollection.content_blocks.through
+        through.objects.bulk_create([through(datacollection_id=self.collection.pk, contentblock_id=cb.pk)])
+        self.assertEqual([], list(self.collection.filter_content_blocks()))
+
+        self.assertEqual((1, 0), backfill_collection_membership())
+        self.assertMembershipCurrent()
+        self.assertEqual([cb], list(self.collection.filter_content_blocks()))
+        self.assertEqual((0, 0), backfill_collection_membership())
+
+        through.objects.all().delete()
+        call_command('backfill_collection_membership', stdout=StringIO())
+        self.assertMembershipCurrent()
+
+
+class XmlFragmentTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        self.content_block = ContentBlock(content_binding_and_subtype=cbas, content='<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"/>')
+        self.content_block.save()
+
+    def test_fragment_cached(self):
+        fragment = self.content_block.get_xml_fragment_11()
+        self.assertEqual(fragment, ContentBlock.objects.get(pk=self.content_block.pk).xml_fragment_11)
+
+        self.content_block.save()
+        self.assertIsNone(ContentBlock.objects.get(pk=self.content_block.pk).xml_fragment_11)
+
+    def test_update_fields(self):
+        self.content_block.get_xml_fragment_11()
+        self.content_block.save(update_fields=['message'])
+        self.assertIsNotNone(ContentBlock.objects.get(pk=self.content_block.pk).xml_fragment_11)
+
+        self.content_block.content = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="changed"/>'
+        self.content_block.save(update_fields=['content'])
+        content_block = ContentBlock.objects.get(pk=self.content_block.pk)
+        self.assertIsNone(content_block.xml_fragment_11)
+        self.assertIn('changed', content_block.get_xml_fragment_11())
+
+    def test_concurrent_change(self):
+        """
+        A fragment built from content that changed since it was read isn't saved
+        """
+        stale = ContentBlock.objects.get(pk=self.content_block.pk)
+        self.content_block.content = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="changed"/>'
+        self.content_block.save()
+        ContentBlock.get_xml_fragments([stale], 'xml_fragment_11')
+        self.assertIsNone(ContentBlock.objects.get(pk=stale.pk).xml_fragment_11)
+
+        # Nor does it replace a fragment saved meanwhile
+        current = self.content_block.get_xml_fragment_11()
+        stale = ContentBlock.objects.get(pk=self.content_block.pk)
+        stale.xml_fragment_11 = None
+        stale.content = '<old/>'
+        ContentBlock.get_xml_fragments([stale], 'xml_fragment_11')
+        self.assertEqual(current, ContentBlock.objects.get(pk=stale.pk).xml_fragment_11)
+
+    def test_poll_response(self):
+        """
+        Poll Responses written from fragments are valid and equal to libtaxii's
+        """
+        for poll_response_class, tm, validator in ((FragmentPollResponse11, tm11, SchemaValidator.TAXII_11_SCHEMA),
+                                                   (FragmentPollResponse10, tm10, SchemaValidator.TAXII_10_SCHEMA)):
+            if tm is tm11:
+                kwargs = {'collection_name': 'default', 'record_count': tm11.RecordCount(1, False)}
+                libtaxii_block = self.content_block.to_content_block_11()
+            else:
+                kwargs = {'feed_name': 'default', 'inclusive_end_timestamp_label': self.content_block.timestamp_label}
+                libtaxii_block = self.content_block.to_content_block_10()
+            poll_response = poll_response_class(generate_message_id(), generate_message_id(), **kwargs)
+            poll_response.content_block_models.append(self.content_block)
+            self.assertEqual(1, poll_response.content_block_count)
+
+            xml = poll_response.to_xml(pretty_print=True)
+            self.assertTrue(SchemaValidator(validator).validate_string(xml).valid)
+            expected = tm.PollResponse(poll_response.message_id, poll_response.in_response_to, **kwargs)
+            expected.content_blocks.append(libtaxii_block)
+            self.assertEqual(tm.get_message_from_xml(expected.to_xml()).to_dict(),
+                             tm.get_message_from_xml(xml).to_dict())
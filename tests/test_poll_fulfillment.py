@@ -3,11 +3,349 @@
 
 from __future__ import absolute_import
 
+import datetime
+import re
+from StringIO import StringIO
+
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+import libtaxii.taxii_default_query as tdq
+
+from taxii_services import handlers
+from taxii_services.message_handlers.poll_request_handlers import PollRequest10Handler, PollRequest11Handler
+from taxii_services.util import PollRequestProperties
 
 from .helpers import *
 
 
 class PollFulfillmentTests11(TestCase):
     pass
+
+
+class ResultSetTestCase(TestCase):
+    """
+    Adds a Poll Service (with a max_result_size of 5) and 12 Content Blocks
+    """
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        collection = DataCollection.objects.get(name='default')
+        cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        for i in range(12):
+            cb = ContentBlock(content_binding_and_subtype=cbas, content='<block>%s</block>' % i)
+            cb.save()
+            collection.content_blocks.add(cb)
+
+    def poll(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        return make_request('/test_poll_1/', pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                            MSG_POLL_RESPONSE)
+
+    def fulfill(self, result_id, part_number):
+        pfr = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                          collection_name='default',
+                                          result_id=result_id,
+                                          result_part_number=part_number)
+        return make_request('/test_poll_1/', pfr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                            MSG_POLL_RESPONSE)
+
+
+class CompactResultSetTests(ResultSetTestCase):
+
+    def test_boundaries(self):
+        """
+        Parts store key boundaries and fetch their Content Blocks on demand
+        """
+        msg = self.poll()
+        rsp = ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=2)
+        self.assertIsNone(rsp.content_block_ids)
+        self.assertIsNotNone(rsp.first_content_block_id)
+
+        contents = [cb.content for cb in msg.content_blocks]
+        for part_number in (2, 3):
+            part = self.fulfill(msg.result_id, part_number)
+            self.assertEqual(part_number == 2, part.more)
+            contents.extend(cb.content for cb in part.content_blocks)
+        self.assertEqual(range(12), [int(re.search(r'>(\d+)</block>', c).group(1)) for c in contents])
+
+    def test_packed_ids(self):
+        """
+        Results that are not a queryset are stored as packed ids
+        """
+        poll_service = PollService.objects.get(path='/test_poll_1/')
+        prp = PollRequestProperties()
+        prp.collection = DataCollection.objects.get(name='default')
+        content_blocks = list(ContentBlock.objects.order_by('-id'))[:7]
+
+        result_set = handlers.create_result_set(poll_service, prp, content_blocks)
+        self.assertEqual(7, result_set.total_content_blocks)
+        parts = result_set.resultsetpart_set.order_by('part_number')
+        self.assertEqual([5, 2], [rsp.content_block_count for rsp in parts])
+        self.assertEqual([cb.pk for cb in content_blocks[5:]],
+                         [cb.pk for cb in parts[1].get_content_blocks()])
+
+    def test_overridden_get_content(self):
+        """
+        A queryset narrowed by an overridden get_content is stored as packed ids
+        """
+        poll_service = PollService.objects.get(path='/test_poll_1/')
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        prp = PollRequestProperties.from_poll_request_11(poll_service, pr)
+        content = EvenBlocksPollRequestHandler.get_content(prp, prp.get_db_kwargs())
+        msg = EvenBlocksPollRequestHandler.create_poll_response(poll_service, prp, content)
+
+        rsp = ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=2)
+        self.assertIsNotNone(rsp.content_block_ids)
+        self.assertEqual(['<block>10</block>'], [cb.content for cb in rsp.get_content_blocks()])
+
+
+class EvenBlocksPollRequestHandler(PollRequest11Handler):
+    """
+    Polls only the even numbered test Content Blocks
+    """
+
+    @classmethod
+    def get_content(cls, prp, query_kwargs):
+        content = super(EvenBlocksPollRequestHandler, cls).get_content(prp, query_kwargs)
+        return content.exclude(content__in=['<block>%s</block>' % i for i in range(1, 12, 2)])
+
+
+class RenderedResultSetPartTests(ResultSetTestCase):
+
+    def set_rendering(self, rendering):
+        PollService.objects.filter(path='/test_poll_1/').update(result_set_part_rendering=rendering[0])
+
+    def test_lazy(self):
+        """
+        Parts are rendered on first fetch, then served from the rendered XML
+        """
+        self.set_rendering(RENDER_LAZY)
+        msg = self.poll()
+        self.assertIsNotNone(ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=1).rendered_poll_response)
+        self.assertIsNone(ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=2).rendered_poll_response)
+
+        first = self.fulfill(msg.result_id, 2)
+        self.assertIsNotNone(ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=2).rendered_poll_response)
+
+        # Deleting a Content Block doesn't change an already rendered part
+        ContentBlock.objects.filter(content='<block>6</block>').delete()
+        again = self.fulfill(msg.result_id, 2)
+        self.assertNotEqual(first.message_id, again.message_id)
+        self.assertEqual([cb.content for cb in first.content_blocks], [cb.content for cb in again.content_blocks])
+        self.assertEqual(5, len(again.content_blocks))
+        self.assertEqual(msg.result_id, again.result_id)
+        self.assertEqual(2, again.result_part_number)
+        self.assertTrue(again.more)
+
+    def test_eager(self):
+        self.set_rendering(RENDER_EAGER)
+        msg = self.poll()
+        for rsp in ResultSetPart.objects.filter(result_set__pk=msg.result_id):
+            self.assertIsNotNone(rsp.rendered_poll_response)
+        self.assertEqual(2, len(self.fulfill(msg.result_id, 3).content_blocks))
+
+    def test_splice(self):
+        """
+        The message_id and in_response_to are escaped when spliced in
+        """
+        self.set_rendering(RENDER_LAZY)
+        msg = self.poll()
+        rsp = ResultSetPart.objects.get(result_set__pk=msg.result_id, part_number=2)
+        poll_response = rsp.to_rendered_poll_response_11(u'a"<&\xe9')
+        parsed = tm11.get_message_from_xml(poll_response.to_xml())
+        self.assertEqual(u'a"<&\xe9', parsed.in_response_to)
+        self.assertEqual(poll_response.message_id, parsed.message_id)
+        self.assertEqual(5, len(parsed.content_blocks))
+
+
+class QueryCountTests(ResultSetTestCase):
+    """
+    Building Poll Responses takes a fixed number of queries, however many
+    Content Blocks they hold
+    """
+
+    def test_result_set_part(self):
+        msg = self.poll()
+        rsp = ResultSetPart.objects.select_related('result_set__data_collection').get(result_set__pk=msg.result_id,
+                                                                                      part_number=2)
+        # Reading the Result Set's Content Bindings and the Content Blocks, then saving their fragments
+        with self.assertNumQueries(3):
+            rsp.to_poll_response_11(generate_message_id()).to_xml()
+        with self.assertNumQueries(2):
+            rsp.to_poll_response_11(generate_message_id()).to_xml()
+
+    def test_get_content(self):
+        prp = PollRequestProperties()
+        prp.collection = DataCollection.objects.get(name='default')
+        for handler, to_content_block in ((PollRequest11Handler, 'to_content_block_11'),
+                                          (PollRequest10Handler, 'to_content_block_10')):
+            with self.assertNumQueries(1):
+                for content_block in handler.get_content(prp, {}):
+                    getattr(content_block, to_content_block)()
+
+    def test_fulfillment(self):
+        msg = self.poll()
+        counts = []
+        for part_number in (2, 3):  # 5 and 2 Content Blocks
+            with CaptureQueriesContext(connection) as queries:
+                self.fulfill(msg.result_id, part_number)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class ResultSetReaperTests(ResultSetTestCase):
+
+    def test_lifetime(self):
+        PollService.objects.filter(path='/test_poll_1/').update(result_set_lifetime=60)
+        msg = self.poll()
+        expires = ResultSet.objects.get(pk=msg.result_id).expires
+        self.assertLess(expires, timezone.now() + datetime.timedelta(seconds=61))
+        self.assertGreater(expires, timezone.now() + datetime.timedelta(seconds=59))
+
+    def test_reap(self):
+        expired, kept = self.poll(), self.poll()
+        self.fulfill(expired.result_id, 2)  # Sets the Result Set's last part returned
+        ResultSet.objects.filter(pk=expired.result_id).update(expires=timezone.now() - datetime.timedelta(seconds=1))
+
+        # An expired Result Set is gone before it is reaped
+        pfr = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                          collection_name='default',
+                                          result_id=expired.result_id,
+                                          result_part_number=1)
+        make_request('/test_poll_1/', pfr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                     MSG_STATUS_MESSAGE, st=ST_NOT_FOUND)
+
+        out = StringIO()
+        call_command('reap_result_sets', batch_size=2, stdout=out)
+        self.assertIn('1 Result Sets, 3 Result Set Parts', out.getvalue())
+        self.assertEqual([int(kept.result_id)], list(ResultSet.objects.values_list('pk', flat=True)))
+        self.assertEqual(3, ResultSetPart.objects.count())
+        self.assertEqual({}, ResultSet.delete_expired())
+        self.fulfill(kept.result_id, 3)
+
+
+@override_settings(TAXII_SERVICES_BACKGROUND_POLL_THRESHOLD=0)
+class BackgroundPollTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        add_test_content(collection='default')
+
+    def poll(self, allow_asynch=True, response_msg_type=MSG_STATUS_MESSAGE, **kwargs):
+        tgt = 'STIX_Package/Threat_Actors/Threat_Actor/Identity/' \
+              'Specification/PartyName/OrganisationName/SubDivisionName'
+        test = tdq.Test(capability_id=CM_CORE,
+                        relationship=R_EQUALS,
+                        parameters={P_VALUE: 'Unit 61398', P_MATCH_TYPE: 'case_sensitive_string'})
+        criteria = tdq.Criteria(OP_AND, criterion=[tdq.Criterion(target=tgt, test=test)])
+        pp = tm11.PollParameters(query=tdq.DefaultQuery(CB_STIX_XML_111, criteria), allow_asynch=allow_asynch)
+        pr = tm11.PollRequest(message_id=generate_message_id(), collection_name='default', poll_parameters=pp)
+        return make_request('/test_poll_1/', pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                            response_msg_type, **kwargs)
+
+    def fulfill(self, result_id, response_msg_type=MSG_POLL_RESPONSE, **kwargs):
+        pfr = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                          collection_name='default',
+                                          result_id=result_id,
+                                          result_part_number=1)
+        return make_request('/test_poll_1/', pfr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                            response_msg_type, **kwargs)
+
+    def test_pending(self):
+        sm = self.poll(st=ST_PENDING, sd_keys=[SD_ESTIMATED_WAIT, SD_RESULT_ID, SD_WILL_PUSH])
+        result_id = sm.status_detail[SD_RESULT_ID]
+        self.assertEqual(POLL_JOB_DEFAULT_WAIT, sm.status_detail[SD_ESTIMATED_WAIT])
+        self.fulfill(result_id, MSG_STATUS_MESSAGE, st=ST_PENDING, sd_keys=[SD_RESULT_ID])
+
+        call_command('run_poll_jobs', once=True)
+        poll_job = PollJob.objects.get(result_set__pk=result_id)
+        self.assertEqual(POLL_JOB_DONE[0], poll_job.status)
+        self.assertEqual(5, poll_job.cost)
+        self.assertIsNotNone(poll_job.duration)
+
+        msg = self.fulfill(result_id)
+        self.assertEqual(1, len(msg.content_blocks))
+        self.assertFalse(msg.more)
+
+        # The next estimate comes from the job that ran
+        sm = self.poll(st=ST_PENDING)
+        poll_job = PollJob.objects.get(result_set__pk=sm.status_detail[SD_RESULT_ID])
+        duration = PollJob.objects.get(result_set__pk=result_id).duration
+        self.assertEqual(max(1, int(round(duration / 5 * poll_job.cost))), sm.status_detail[SD_ESTIMATED_WAIT])
+
+    def test_no_results(self):
+        collection = DataCollection.objects.get(name='default')
+        collection.content_blocks.filter(content__contains='Unit 61398').delete()
+        result_id = self.poll(st=ST_PENDING).status_detail[SD_RESULT_ID]
+        call_command('run_poll_jobs', once=True)
+        msg = self.fulfill(result_id)
+        self.assertEqual(0, len(msg.content_blocks))
+
+    def test_synchronous(self):
+        """
+        Requesters that don't allow asynchronous responses wait for the results
+        """
+        msg = self.poll(allow_asynch=False, response_msg_type=MSG_POLL_RESPONSE)
+        self.assertEqual(1, len(msg.content_blocks))
+        self.assertEqual(0, PollJob.objects.count())
+
+    def test_failure(self):
+        result_id = self.poll(st=ST_PENDING).status_detail[SD_RESULT_ID]
+        PollJob.objects.filter(result_set__pk=result_id).update(poll_request='<not_a_poll_request/>')
+        call_command('run_poll_jobs', once=True)
+        self.assertEqual(POLL_JOB_FAILED[0], PollJob.objects.get(result_set__pk=result_id).status)
+        self.fulfill(result_id, MSG_STATUS_MESSAGE, st=ST_FAILURE)
+
+    def test_failure_after_result_set(self):
+        """
+        A job that fails after its Result Set's parts were created leaves none behind
+        """
+        result_id = self.poll(st=ST_PENDING).status_detail[SD_RESULT_ID]
+        PollJob.objects.filter(result_set__pk=result_id).update(
+            handler='tests.test_poll_fulfillment.FailingPollRequestHandler')
+        call_command('run_poll_jobs', once=True)
+        self.assertEqual(POLL_JOB_FAILED[0], PollJob.objects.get(result_set__pk=result_id).status)
+        self.assertEqual(0, ResultSetPart.objects.filter(result_set__pk=result_id).count())
+        self.fulfill(result_id, MSG_STATUS_MESSAGE, st=ST_FAILURE)
+
+    def test_stale(self):
+        """
+        A job whose worker stopped without recording an outcome fails after the timeout
+        """
+        result_id = self.poll(st=ST_PENDING).status_detail[SD_RESULT_ID]
+        poll_job = PollJob.claim_next()
+        self.assertEqual(0, PollJob.fail_stale())
+
+        started = timezone.now() - datetime.timedelta(seconds=POLL_JOB_TIMEOUT + 1)
+        PollJob.objects.filter(pk=poll_job.pk).update(date_started=started)
+        self.assertIsNone(PollJob.claim_next())
+        self.assertEqual(POLL_JOB_FAILED[0], PollJob.objects.get(pk=poll_job.pk).status)
+        self.fulfill(result_id, MSG_STATUS_MESSAGE, st=ST_FAILURE)
+
+        # A worker that finishes after the timeout doesn't replace the failure
+        poll_job.run()
+        self.assertEqual(POLL_JOB_FAILED[0], PollJob.objects.get(pk=poll_job.pk).status)
+        self.assertEqual(0, ResultSetPart.objects.filter(result_set__pk=result_id).count())
+
+
+class FailingPollRequestHandler(PollRequest11Handler):
+    """
+    Fails Poll Jobs after creating their Result Sets
+    """
+
+    @classmethod
+    def run_poll_job(cls, poll_job):
+        super(FailingPollRequestHandler, cls).run_poll_job(poll_job)
+        raise ValueError('Rendering failed')
@@ -4,10 +4,14 @@
 from __future__ import absolute_import
 
 from datetime import datetime, timedelta
+import zlib
 
 from dateutil.tz import tzutc
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.core.cache import caches
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from .helpers import *
 
@@ -488,3 +492,336 @@ class PollRequestTests10(TestCase):
 
         if len(msg.content_blocks) != 5:
             raise ValueError("Expected 5 content blocks, got %s" % len(msg.content_blocks))
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        self.collection = DataCollection.objects.get(name='default')
+        cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        for i in range(12):
+            cb = ContentBlock(content_binding_and_subtype=cbas, content='<block>%s</block>' % i)
+            cb.save()
+            self.collection.content_blocks.add(cb)
+
+    def test_equal_timestamp_labels(self):
+        """
+        Parts are complete and in order even when timestamp labels are equal
+        """
+        now = datetime.now(tzutc())
+        ContentBlock.objects.update(timestamp_label=now)
+        CollectionMembership.objects.update(timestamp_label=now)
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        make_request('/test_poll_1/',
+                     pr.to_xml(),
+                     get_headers(VID_TAXII_SERVICES_11, False),
+                     MSG_POLL_RESPONSE)
+        parts = [part.get_content_blocks() for part in ResultSetPart.objects.order_by('part_number')]
+        self.assertEqual([5, 5, 2], [len(part) for part in parts])
+
+        ids = [cb.pk for part in parts for cb in part]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(12, len(set(ids)))
+
+    def test_multi_part_poll(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        msg = make_request('/test_poll_1/',
+                           pr.to_xml(),
+                           get_headers(VID_TAXII_SERVICES_11, False),
+                           MSG_POLL_RESPONSE)
+        self.assertTrue(msg.more)
+        self.assertEqual(12, msg.record_count.record_count)
+        self.assertEqual(5, len(msg.content_blocks))
+        self.assertEqual([5, 5, 2], list(ResultSetPart.objects.order_by('part_number')
+                                         .values_list('content_block_count', flat=True)))
+
+    def test_single_part_poll(self):
+        """
+        Reading max_result_size + 1 blocks is enough to return a single part
+        """
+        self.collection.content_blocks.remove(*ContentBlock.objects.all()[5:])
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        msg = make_request('/test_poll_1/',
+                           pr.to_xml(),
+                           get_headers(VID_TAXII_SERVICES_11, False),
+                           MSG_POLL_RESPONSE)
+        self.assertFalse(msg.more)
+        self.assertEqual(5, msg.record_count.record_count)
+        self.assertEqual(0, ResultSet.objects.count())
+
+
+class CountOnlyTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        add_test_content(collection='default')
+
+    def poll(self, pr):
+        with CaptureQueriesContext(connection) as queries:
+            msg = make_request('/test_poll_1/',
+                               pr.to_xml(),
+                               get_headers(VID_TAXII_SERVICES_11, False),
+                               MSG_POLL_RESPONSE)
+        content_queries = [q['sql'] for q in queries.captured_queries if 'contentblock' in q['sql']]
+        return msg, content_queries
+
+    def test_count(self):
+        """
+        Without time bounds, the collection's statistics answer the count
+        """
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters(response_type=RT_COUNT_ONLY))
+        msg, content_queries = self.poll(pr)
+        self.assertEqual(DataCollection.objects.get(name='default').content_blocks.count(),
+                         msg.record_count.record_count)
+        self.assertEqual(0, len(msg.content_blocks))
+        self.assertFalse(msg.more)
+        self.assertEqual(0, ResultSet.objects.count())
+        self.assertEqual([], content_queries)
+
+    def test_count_time_bounds(self):
+        """
+        Content Blocks are counted by the database, not read
+        """
+        newest = ContentBlock.objects.order_by('-timestamp_label')[0]
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              exclusive_begin_timestamp_label=newest.timestamp_label - timedelta(microseconds=1),
+                              poll_parameters=tm11.PollParameters(response_type=RT_COUNT_ONLY))
+        msg, content_queries = self.poll(pr)
+        self.assertEqual(1, msg.record_count.record_count)
+        self.assertEqual(1, len(content_queries))
+        self.assertIn('COUNT(', content_queries[0])
+
+    def test_query_count(self):
+        """
+        Query handlers count matches reading only the content
+        """
+        tgt = 'STIX_Package/Threat_Actors/Threat_Actor/Identity/' \
+              'Specification/PartyName/OrganisationName/SubDivisionName'
+        params = {P_VALUE: 'Unit 61398', P_MATCH_TYPE: 'case_sensitive_string'}
+        pr = create_poll_w_query(R_EQUALS, params, tgt)
+        pr.poll_parameters.response_type = RT_COUNT_ONLY
+        msg, content_queries = self.poll(pr)
+        self.assertEqual(1, msg.record_count.record_count)
+        self.assertEqual(0, len(msg.content_blocks))
+        self.assertEqual(1, len(content_queries))
+        self.assertNotIn('"message"', content_queries[0])
+
+
+class HighWaterMarkTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        add_test_content(collection='default')
+        self.newest = ContentBlock.objects.order_by('-timestamp_label')[0]
+
+    def poll(self, exclusive_begin_timestamp_label):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              exclusive_begin_timestamp_label=exclusive_begin_timestamp_label,
+                              poll_parameters=tm11.PollParameters())
+        with CaptureQueriesContext(connection) as queries:
+            msg = make_request('/test_poll_1/',
+                               pr.to_xml(),
+                               get_headers(VID_TAXII_SERVICES_11, False),
+                               MSG_POLL_RESPONSE)
+        content_queries = [q['sql'] for q in queries.captured_queries if 'contentblock' in q['sql']]
+        return msg, content_queries
+
+    def test_nothing_new(self):
+        msg, content_queries = self.poll(self.newest.timestamp_label)
+        self.assertEqual([], content_queries)
+        self.assertEqual(0, len(msg.content_blocks))
+        self.assertEqual(0, msg.record_count.record_count)
+        self.assertFalse(msg.more)
+        self.assertEqual(self.newest.timestamp_label, msg.exclusive_begin_timestamp_label)
+        self.assertIsNotNone(msg.inclusive_end_timestamp_label)
+
+    def test_new_content(self):
+        msg, content_queries = self.poll(self.newest.timestamp_label - timedelta(microseconds=1))
+        self.assertNotEqual([], content_queries)
+        self.assertEqual(1, len(msg.content_blocks))
+
+    def test_edited_timestamp_label(self):
+        """
+        Moving a Content Block past the newest one raises the high water mark.
+        """
+        oldest = ContentBlock.objects.order_by('timestamp_label')[0]
+        oldest.timestamp_label = self.newest.timestamp_label + timedelta(microseconds=1)
+        oldest.save()
+
+        msg, content_queries = self.poll(self.newest.timestamp_label)
+        self.assertNotEqual([], content_queries)
+        self.assertEqual(1, len(msg.content_blocks))
+        self.assertEqual(1, msg.record_count.record_count)
+
+    def test_taxii_10(self):
+        pr = tm10.PollRequest(message_id=generate_message_id(),
+                              feed_name='default',
+                              exclusive_begin_timestamp_label=self.newest.timestamp_label)
+        msg = make_request('/test_poll_1/',
+                           pr.to_xml(),
+                           get_headers(VID_TAXII_SERVICES_10, False),
+                           MSG_POLL_RESPONSE)
+        self.assertEqual(0, len(msg.content_blocks))
+
+
+@override_settings(CACHES={'poll': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   TAXII_SERVICES_POLL_CACHE='poll')
+class PollResponseCacheTests(TransactionTestCase):
+    # The cache is invalidated when transactions commit, so each test can't be one
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        add_test_content(collection='default')
+        caches['poll'].clear()
+
+    def poll(self, pr):
+        pr.message_id = generate_message_id()
+        with CaptureQueriesContext(connection) as queries:
+            msg = make_request('/test_poll_1/',
+                               pr.to_xml(),
+                               get_headers(VID_TAXII_SERVICES_11, False),
+                               MSG_POLL_RESPONSE)
+        self.assertEqual(pr.message_id, msg.in_response_to)
+        content_queries = [q['sql'] for q in queries.captured_queries if 'contentblock' in q['sql']]
+        return msg, content_queries
+
+    def test_hit(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        first, content_queries = self.poll(pr)
+        self.assertNotEqual([], content_queries)
+        self.assertEqual(5, len(first.content_blocks))
+
+        second, content_queries = self.poll(pr)
+        self.assertEqual([], content_queries)
+        self.assertNotEqual(first.message_id, second.message_id)
+        self.assertEqual([cb.content for cb in first.content_blocks], [cb.content for cb in second.content_blocks])
+        self.assertEqual(first.inclusive_end_timestamp_label, second.inclusive_end_timestamp_label)
+
+    def test_invalidation(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters(response_type=RT_COUNT_ONLY))
+        self.assertEqual(5, self.poll(pr)[0].record_count.record_count)
+
+        collection = DataCollection.objects.get(name='default')
+        cb = collection.content_blocks.all()[0]
+        collection.content_blocks.remove(cb)
+        self.assertEqual(4, self.poll(pr)[0].record_count.record_count)
+        self.assertEqual(4, self.poll(pr)[0].record_count.record_count)
+
+        cb.datacollection_set.add(collection)
+        self.assertEqual(5, self.poll(pr)[0].record_count.record_count)
+
+    def test_backfill_invalidation(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        self.assertEqual(5, len(self.poll(pr)[0].content_blocks))
+
+        # Queryset deletes don't send m2m_changed, so the membership is only dropped by the backfill
+        through = DataCollection.content_blocks.through
+        through.objects.filter(pk=through.objects.all()[0].pk).delete()
+        self.assertEqual(5, len(self.poll(pr)[0].content_blocks))
+        self.assertEqual((0, 1), backfill_collection_membership())
+        self.assertEqual(4, len(self.poll(pr)[0].content_blocks))
+
+    def test_query(self):
+        """
+        Queries are part of the key
+        """
+        tgt = 'STIX_Package/Threat_Actors/Threat_Actor/Identity/' \
+              'Specification/PartyName/OrganisationName/SubDivisionName'
+        params = {P_VALUE: 'Unit 61398', P_MATCH_TYPE: 'case_sensitive_string'}
+        self.assertEqual(1, len(self.poll(create_poll_w_query(R_EQUALS, params, tgt))[0].content_blocks))
+        msg, content_queries = self.poll(create_poll_w_query(R_EQUALS, params, tgt))
+        self.assertEqual(1, len(msg.content_blocks))
+        self.assertEqual([], content_queries)
+
+        params[P_VALUE] = 'Unit 61399'
+        self.assertEqual(0, len(self.poll(create_poll_w_query(R_EQUALS, params, tgt))[0].content_blocks))
+
+
+class StreamingPollResponseTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_poll_service()
+        PollService.objects.filter(path='/test_poll_1/').update(max_result_size=None, stream_poll_responses=True)
+        collection = DataCollection.objects.get(name='default')
+        cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+        content_blocks = [ContentBlock(content_binding_and_subtype=cbas, content='<block>%s</block>' % i)
+                          for i in range(STREAM_CHUNK_SIZE * 2 + 1)]
+        for cb in content_blocks:
+            cb.save()
+        collection.content_blocks.add(*content_blocks)
+
+    def post(self, pr, **headers):
+        headers.update(get_headers(VID_TAXII_SERVICES_11 if isinstance(pr, tm11.PollRequest)
+                                   else VID_TAXII_SERVICES_10, False))
+        response = Client().post('/test_poll_1/', pr.to_xml(), content_type='application/xml', **headers)
+        self.assertTrue(response.streaming)
+        return response
+
+    def test_taxii_11(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        chunks = list(self.post(pr).streaming_content)
+        # The envelope's head, three chunks of Content Blocks, and its tail
+        self.assertEqual(5, len(chunks))
+        msg = tm11.get_message_from_xml(''.join(chunks))
+        self.assertEqual(201, len(msg.content_blocks))
+        self.assertEqual(201, msg.record_count.record_count)
+        self.assertFalse(msg.more)
+        # In (timestamp_label, id) order
+        self.assertIn('>0</block>', msg.content_blocks[0].content)
+        self.assertIn('>200</block>', msg.content_blocks[-1].content)
+
+    def test_taxii_10(self):
+        pr = tm10.PollRequest(message_id=generate_message_id(), feed_name='default')
+        msg = tm10.get_message_from_xml(''.join(self.post(pr).streaming_content))
+        self.assertEqual(201, len(msg.content_blocks))
+
+    def test_compressed(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        response = self.post(pr, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        content = zlib.decompress(''.join(response.streaming_content), 16 + zlib.MAX_WBITS)
+        self.assertEqual(201, len(tm11.get_message_from_xml(content).content_blocks))
+
+    def test_paged(self):
+        """
+        Poll Services with a Max Result Size page instead
+        """
+        PollService.objects.filter(path='/test_poll_1/').update(max_result_size=50)
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        msg = make_request('/test_poll_1/', pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                           MSG_POLL_RESPONSE)
+        self.assertTrue(msg.more)
+        self.assertEqual(50, len(msg.content_blocks))
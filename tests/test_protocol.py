@@ -3,9 +3,13 @@
 
 from __future__ import absolute_import
 
+from django.test import RequestFactory
 from libtaxii import messages_10 as tm10
 from libtaxii import messages_11 as tm11
 
+from taxii_services.models import (DiscoveryService, VALIDATE_FULL, VALIDATE_SAMPLED,
+                                   VALIDATE_WELL_FORMED, VALIDATION_SKIPPED)
+
 from .base import DJTTestCase
 from .constants import *
 from .helpers import DISCOVERY_PATH, add_discovery_service, get_headers
@@ -171,3 +175,62 @@ class ProtocolTests(DJTTestCase):
         """
         # TODO: Write this
         pass
+
+
+class ValidationPolicyTests(DJTTestCase):
+    """
+    Tests the per-service validation policy.
+    """
+
+    def setUp(self):
+        super(ValidationPolicyTests, self).setUp()
+        add_discovery_service()
+        self.service = DiscoveryService.objects.get(path=DISCOVERY_PATH)
+
+        # Well-formed and readable by libtaxii, but schema-invalid
+        dr = tm11.DiscoveryRequest(tm11.generate_message_id())
+        self.body = dr.to_xml().replace('<taxii_11:Discovery_Request ',
+                                        '<taxii_11:Discovery_Request unexpected="attribute" ', 1)
+
+    def set_policy(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self.service, k, v)
+        self.service.save()
+
+    def test_full(self):
+        response = self.post(DISCOVERY_PATH, self.body)
+        self.assertStatusMessage(response, ST_BAD_MESSAGE)
+        self.assertEqual(VALIDATE_FULL[0], response.wsgi_request.taxii_metrics['validation_mode'])
+
+    def test_well_formed(self):
+        self.set_policy(validation_mode=VALIDATE_WELL_FORMED[0])
+        response = self.post(DISCOVERY_PATH, self.body)
+        self.assertDiscoveryResponse(response)
+        self.assertEqual(VALIDATE_WELL_FORMED[0], response.wsgi_request.taxii_metrics['validation_mode'])
+
+        # Malformed XML is still rejected
+        response = self.post(DISCOVERY_PATH, '<malformed_xml>')
+        self.assertStatusMessage(response, ST_BAD_MESSAGE)
+
+    def test_sampled(self):
+        self.set_policy(validation_mode=VALIDATE_SAMPLED[0], validation_sample_rate=2)
+        modes = [self.service.get_validation_mode(self.make_django_request()) for i in range(4)]
+        self.assertEqual(2, modes.count(VALIDATE_FULL[0]))
+        self.assertEqual(2, modes.count(VALIDATE_WELL_FORMED[0]))
+
+    def test_trusted_client(self):
+        self.set_policy(trusted_clients='10.0.0.1\n127.0.0.1\n')
+        response = self.post(DISCOVERY_PATH, self.body)
+        self.assertDiscoveryResponse(response)
+        self.assertEqual(VALIDATION_SKIPPED, response.wsgi_request.taxii_metrics['validation_mode'])
+
+    def test_trusted_certificate(self):
+        self.set_policy(trusted_clients='CN=producer,O=Example')
+        request = self.make_django_request(SSL_CLIENT_S_DN='CN=producer,O=Example')
+        self.assertEqual(VALIDATION_SKIPPED, self.service.get_validation_mode(request))
+
+        request = self.make_django_request(SSL_CLIENT_S_DN='CN=someone-else,O=Example')
+        self.assertEqual(VALIDATE_FULL[0], self.service.get_validation_mode(request))
+
+    def make_django_request(self, **extra):
+        return RequestFactory().post(DISCOVERY_PATH, self.body, content_type='application/xml', **extra)
@@ -0,0 +1,161 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import datetime
+import threading
+
+from dateutil.tz import tzutc
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from taxii_services import push
+
+from .helpers import *
+
+
+class InboxRequestHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in TAXII inbox that records the Inbox Messages it receives and
+    answers with the server's status_type
+    """
+    protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = tm11.get_message_from_xml(body)
+        self.server.received.append((self.client_address, message))
+        response = tm11.StatusMessage(generate_message_id(), message.message_id,
+                                      status_type=self.server.status_type).to_xml()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('X-TAXII-Content-Type', VID_TAXII_XML_11)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(TAXII_SERVICES_PUSH_SETTLE_TIME=0, TAXII_SERVICES_PUSH_BATCH_SIZE=2)
+class PushTests(TestCase):
+
+    def setUp(self):
+        settings.DEBUG = True
+        add_basics()
+        add_collection_service()
+        self.server = HTTPServer(('127.0.0.1', 0), InboxRequestHandler)
+        self.server.received = []
+        self.server.status_type = ST_SUCCESS
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.inbox_address = 'http://127.0.0.1:%s/inbox/' % self.server.server_address[1]
+        self.collection = DataCollection.objects.get(name='default')
+        self.cbas = ContentBindingAndSubtype.objects.get(content_binding__binding_id=CB_STIX_XML_111)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subscribe(self):
+        push_parameters = tm11.PushParameters(VID_TAXII_HTTP_10, self.inbox_address, VID_TAXII_XML_11)
+        sr = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(),
+                                                      collection_name='default',
+                                                      action=ACT_SUBSCRIBE,
+                                                      subscription_parameters=tm11.SubscriptionParameters(),
+                                                      push_parameters=push_parameters)
+        msg = make_request('/collection-management/',
+                           sr.to_xml(),
+                           get_headers(VID_TAXII_SERVICES_11, False),
+                           MSG_MANAGE_COLLECTION_SUBSCRIPTION_RESPONSE,
+                           num_subscription_instances=1)
+        self.assertEqual(self.inbox_address, msg.subscription_instances[0].push_parameters.inbox_address)
+        return Subscription.objects.get(subscription_id=msg.subscription_instances[0].subscription_id)
+
+    def add_content_blocks(self, count):
+        for i in range(count):
+            cb = ContentBlock(content_binding_and_subtype=self.cbas, content='<block>%s</block>' % i)
+            cb.save()
+            self.collection.content_blocks.add(cb)
+        return cb
+
+    def test_push(self):
+        subscription = self.subscribe()
+        self.assertEqual(SUBS_PUSH[0], subscription.delivery)
+        self.assertEqual((0, 0), push.push_all())
+
+        last = self.add_content_blocks(3)
+        self.assertEqual((1, 3), push.push_all())
+        messages = [message for client_address, message in self.server.received]
+        self.assertEqual([2, 1], [len(message.content_blocks) for message in messages])
+        self.assertEqual(str(subscription.subscription_id), messages[0].subscription_information.subscription_id)
+        # Both Inbox Messages went over one connection
+        self.assertEqual(1, len(set(client_address for client_address, message in self.server.received)))
+
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual((last.timestamp_label, last.pk),
+                         (subscription.push_watermark_timestamp_label, subscription.push_watermark_content_block_id))
+        self.assertIsNone(subscription.next_push_attempt)
+        self.assertEqual((0, 0), push.push_all())
+
+    def test_retry(self):
+        subscription = self.subscribe()
+        self.add_content_blocks(1)
+        self.server.status_type = ST_FAILURE
+        self.assertEqual((0, 0), push.push_all())
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual(1, subscription.push_failures)
+        self.assertIn(ST_FAILURE, subscription.last_push_error)
+        self.assertGreater(subscription.next_push_attempt, datetime.datetime.now(tzutc()))
+
+        # Not due until the back off has passed
+        self.server.status_type = ST_SUCCESS
+        self.assertEqual((0, 0), push.push_all())
+        Subscription.objects.filter(pk=subscription.pk).update(next_push_attempt=None)
+        self.assertEqual((1, 1), push.push_all())
+        self.assertEqual(0, Subscription.objects.get(pk=subscription.pk).push_failures)
+
+    def test_unreachable(self):
+        subscription = self.subscribe()
+        self.add_content_blocks(1)
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual((0, 0), push.push_all())
+        self.assertEqual(1, Subscription.objects.get(pk=subscription.pk).push_failures)
+
+    def test_retry_delay(self):
+        with self.settings(TAXII_SERVICES_PUSH_RETRY_DELAY=10, TAXII_SERVICES_PUSH_MAX_RETRY_DELAY=30):
+            self.assertEqual([10, 20, 30], [push.get_retry_delay(i).seconds for i in (1, 2, 3)])
+
+    def test_unsupported_protocol(self):
+        push_parameters = tm11.PushParameters('urn:example:protocol:smtp', self.inbox_address, VID_TAXII_XML_11)
+        sr = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(),
+                                                      collection_name='default',
+                                                      action=ACT_SUBSCRIBE,
+                                                      subscription_parameters=tm11.SubscriptionParameters(),
+                                                      push_parameters=push_parameters)
+        make_request('/collection-management/',
+                     sr.to_xml(),
+                     get_headers(VID_TAXII_SERVICES_11, False),
+                     MSG_STATUS_MESSAGE,
+                     st=ST_UNSUPPORTED_PROTOCOL)
+        self.assertEqual(0, Subscription.objects.count())
+
+    def test_count_only(self):
+        push_parameters = tm11.PushParameters(VID_TAXII_HTTP_10, self.inbox_address, VID_TAXII_XML_11)
+        sr = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(),
+                                                      collection_name='default',
+                                                      action=ACT_SUBSCRIBE,
+                                                      subscription_parameters=tm11.SubscriptionParameters(response_type=RT_COUNT_ONLY),
+                                                      push_parameters=push_parameters)
+        make_request('/collection-management/',
+                     sr.to_xml(),
+                     get_headers(VID_TAXII_SERVICES_11, False),
+                     MSG_STATUS_MESSAGE,
+                     st=ST_FAILURE)
+        self.assertEqual(0, Subscription.objects.count())
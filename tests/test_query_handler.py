@@ -3,8 +3,23 @@
 
 from __future__ import absolute_import
 
+import multiprocessing
+import os
+
 from django.conf import settings
 from django.test import Client, TestCase
+from django.test.utils import override_settings
+from libtaxii.constants import *
+import libtaxii.taxii_default_query as tdq
+from lxml import etree
+
+from taxii_services import models
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.query_handlers import pool
+from taxii_services.query_handlers.stix_xml_111_handler import StixXml111QueryHandler
+from taxii_services.util import PollRequestProperties
+
+from .helpers import add_basics, add_test_content
 
 
 class TETestObj(object):
@@ -83,3 +98,155 @@ class BaseXmlQueryHandlerTests(TestCase):
         for test_te in test_tes:
             xpath_builders, nsmap = StixXml111QueryHandler.target_to_xpath_builders(None, test_te.target)
             test_te.check_result(xpath_builders, nsmap)
+
+
+@override_settings(TAXII_SERVICES_QUERY_PROCESSES=2,
+                   TAXII_SERVICES_QUERY_PARALLEL_THRESHOLD=2,
+                   TAXII_SERVICES_QUERY_CHUNK_SIZE=1)
+class ParallelQueryTests(TestCase):
+
+    def setUp(self):
+        add_basics()
+        add_test_content(collection='default')
+        self.content_blocks = models.DataCollection.objects.get(name='default').filter_content_blocks()
+        self.prp = PollRequestProperties()
+        # The two watchlists
+        criterion = [tdq.Criterion(target='STIX_Package/STIX_Header/Title',
+                                   test=tdq.Test(capability_id=CM_CORE,
+                                                 relationship=R_EQUALS,
+                                                 parameters={P_VALUE: value, P_MATCH_TYPE: 'case_sensitive_string'}))
+                     for value in ('Example file watchlist', 'Example watchlist that contains IP information.')]
+        self.prp.query = tdq.DefaultQuery(CB_STIX_XML_111, tdq.Criteria(OP_OR, criterion=criterion))
+
+    def tearDown(self):
+        pool.close_pool()
+
+    def filter_serial(self, content_blocks):
+        with self.settings(TAXII_SERVICES_QUERY_PROCESSES=None):
+            return StixXml111QueryHandler.filter_content(self.prp, content_blocks)
+
+    def test_queryset(self):
+        expected = self.filter_serial(self.content_blocks)
+        self.assertEqual(2, len(expected))
+        self.assertIsNotNone(StixXml111QueryHandler.count_parallel_candidates(self.content_blocks))
+        self.assertEqual(expected, StixXml111QueryHandler.filter_content(self.prp, self.content_blocks))
+        self.assertEqual(len(expected), StixXml111QueryHandler.count_content(self.prp, self.content_blocks))
+
+    def test_list(self):
+        content_blocks = list(self.content_blocks)
+        expected = self.filter_serial(content_blocks)
+        self.assertEqual(expected, StixXml111QueryHandler.filter_content(self.prp, content_blocks))
+        self.assertEqual(len(expected), StixXml111QueryHandler.count_content(self.prp, content_blocks))
+
+    def test_pool_reused(self):
+        StixXml111QueryHandler.filter_content(self.prp, self.content_blocks)
+        query_pool = pool.get_pool()
+        StixXml111QueryHandler.filter_content(self.prp, self.content_blocks)
+        self.assertIs(query_pool, pool.get_pool())
+
+    def test_threshold(self):
+        with self.settings(TAXII_SERVICES_QUERY_PARALLEL_THRESHOLD=1000):
+            self.assertIsNone(StixXml111QueryHandler.count_parallel_candidates(self.content_blocks))
+
+    def test_worker_died(self):
+        """
+        A chunk whose worker died fails the poll instead of hanging it, and the pool is replaced
+        """
+        query_pool = pool.get_pool()
+        with self.settings(TAXII_SERVICES_QUERY_CHUNK_TIMEOUT=1):
+            try:
+                DyingQueryHandler.filter_content(self.prp, self.content_blocks)
+            except StatusMessageException as e:
+                self.assertEqual(ST_FAILURE, e.status_type)
+            else:
+                self.fail('No StatusMessageException was raised')
+        self.assertIsNot(query_pool, pool.get_pool())
+
+
+class DyingQueryHandler(StixXml111QueryHandler):
+    """
+    Kills the worker processes that evaluate it
+    """
+
+    @classmethod
+    def content_matches(cls, prp, content, compiled_query=None):
+        if multiprocessing.current_process().name != 'MainProcess':
+            os._exit(1)
+        return super(DyingQueryHandler, cls).content_matches(prp, content, compiled_query)
+
+
+class CountingQueryHandler(StixXml111QueryHandler):
+    """
+    Counts the XPaths it builds
+    """
+    xpaths_built = 0
+
+    @classmethod
+    def get_xpath(cls, prp, criterion):
+        CountingQueryHandler.xpaths_built += 1
+        return super(CountingQueryHandler, cls).get_xpath(prp, criterion)
+
+
+class CompiledQueryTests(TestCase):
+
+    def setUp(self):
+        add_basics()
+        add_test_content(collection='default')
+        self.content_blocks = models.DataCollection.objects.get(name='default').filter_content_blocks()
+        CountingQueryHandler.xpaths_built = 0
+
+    def get_prp(self, *values):
+        criterion = [tdq.Criterion(target='STIX_Package/STIX_Header/Title',
+                                   test=tdq.Test(capability_id=CM_CORE,
+                                                 relationship=R_EQUALS,
+                                                 parameters={P_VALUE: value, P_MATCH_TYPE: 'case_sensitive_string'}))
+                     for value in values]
+        prp = PollRequestProperties()
+        prp.query = tdq.DefaultQuery(CB_STIX_XML_111, tdq.Criteria(OP_OR, criterion=criterion))
+        return prp
+
+    def test_compiled_once(self):
+        prp = self.get_prp('Example file watchlist', 'Email with attachments.')
+        self.assertEqual(2, len(CountingQueryHandler.filter_content(prp, self.content_blocks)))
+        self.assertEqual(2, CountingQueryHandler.count_content(prp, self.content_blocks))
+        # Two criteria, compiled for the first request only
+        self.assertEqual(2, CountingQueryHandler.xpaths_built)
+
+        # An equal query in a later request reuses the compiled query
+        prp = self.get_prp('Example file watchlist', 'Email with attachments.')
+        self.assertIs(CountingQueryHandler.compile_query(prp), CountingQueryHandler.compile_query(prp))
+        self.assertEqual(2, CountingQueryHandler.xpaths_built)
+
+        # A different one is compiled
+        CountingQueryHandler.filter_content(self.get_prp('Example file watchlist'), self.content_blocks)
+        self.assertEqual(3, CountingQueryHandler.xpaths_built)
+
+    def test_negate(self):
+        prp = self.get_prp('Example file watchlist')
+        prp.query.criteria.criterion[0].negate = True
+        self.assertEqual(4, len(StixXml111QueryHandler.filter_content(prp, self.content_blocks)))
+
+    def test_criterion_hook(self):
+        """
+        Overrides of evaluate_criterion can read the tdq.Criterion's attributes
+        """
+        prp = self.get_prp('Example file watchlist', 'Email with attachments.')
+        self.assertEqual(2, len(TitleQueryHandler.filter_content(prp, self.content_blocks)))
+        self.assertEqual(set(['STIX_Package/STIX_Header/Title']), set(TitleQueryHandler.targets))
+
+        # Uncompiled criteria are compiled on the spot
+        content_etree = etree.fromstring(self.content_blocks[0].content)
+        self.assertIn(StixXml111QueryHandler.evaluate_criteria(prp, content_etree, prp.query.criteria),
+                      (True, False))
+
+
+class TitleQueryHandler(StixXml111QueryHandler):
+    """
+    Records the targets of the criterion it evaluates
+    """
+    targets = []
+
+    @classmethod
+    def evaluate_criterion(cls, prp, content_etree, criterion):
+        cls.targets.append(criterion.target)
+        return super(TitleQueryHandler, cls).evaluate_criterion(prp, content_etree, criterion)
@@ -0,0 +1,108 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from __future__ import absolute_import
+
+import gzip
+from StringIO import StringIO
+import zlib
+
+from django.test import RequestFactory, TestCase
+from libtaxii.constants import *
+import libtaxii.messages_10 as tm10
+import libtaxii.messages_11 as tm11
+from lxml.etree import XMLSyntaxError
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.util import request_utils
+
+
+class RequestParsingTests(TestCase):
+
+    def _make_request(self, body, xtct=VID_TAXII_XML_11, **extra):
+        return RequestFactory().post('/discovery/', body, content_type='application/xml',
+                                     HTTP_X_TAXII_CONTENT_TYPE=xtct, **extra)
+
+    def test_parse_once(self):
+        """
+        Validation and deserialization share a single parsed tree.
+        """
+        dr = tm11.DiscoveryRequest(tm11.generate_message_id())
+        request = self._make_request(dr.to_xml())
+
+        request_etree = request_utils.get_request_etree(request)
+        self.assertIs(request_etree, request_utils.get_request_etree(request))
+
+        self.assertTrue(request_utils.validate(request))
+        message = request_utils.deserialize(request)
+        self.assertIsInstance(message, tm11.DiscoveryRequest)
+        self.assertEqual(dr.message_id, message.message_id)
+
+    def test_taxii_10(self):
+        dr = tm10.DiscoveryRequest(tm10.generate_message_id())
+        request = self._make_request(dr.to_xml(), VID_TAXII_XML_10)
+        self.assertIsInstance(request_utils.deserialize(request), tm10.DiscoveryRequest)
+
+    def test_wrong_namespace(self):
+        dr = tm10.DiscoveryRequest(tm10.generate_message_id())
+        request_etree = request_utils.parse_xml(dr.to_xml())
+        self.assertRaises(ValueError, request_utils.get_message_from_etree, request_etree, VID_TAXII_XML_11)
+
+    def test_malformed_xml(self):
+        self.assertRaises(XMLSyntaxError, request_utils.parse_xml, '<malformed_xml>')
+
+    def test_entities_not_resolved(self):
+        body = ('<?xml version="1.0"?><!DOCTYPE x [<!ENTITY e SYSTEM "file:///etc/passwd">]>'
+                '<x>&e;</x>')
+        request_etree = request_utils.parse_xml(body)
+        self.assertIsNone(request_etree.text)
+
+
+class CompressedRequestTests(TestCase):
+
+    def setUp(self):
+        self.message = tm11.InboxMessage(tm11.generate_message_id(),
+                                         content_blocks=[tm11.ContentBlock(CB_STIX_XML_111, '<x>%s</x>' % ('a' * 10000))])
+
+    def _make_request(self, body, content_encoding):
+        return RequestFactory().post('/inbox/', body, content_type='application/xml',
+                                     HTTP_X_TAXII_CONTENT_TYPE=VID_TAXII_XML_11,
+                                     HTTP_CONTENT_ENCODING=content_encoding)
+
+    def _gzip(self, data):
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzip_file.write(data)
+        gzip_file.close()
+        return buf.getvalue()
+
+    def test_gzip(self):
+        request = self._make_request(self._gzip(self.message.to_xml()), 'gzip')
+        message = request_utils.get_message_from_etree(request_utils.get_request_etree(request), VID_TAXII_XML_11)
+        self.assertEqual(self.message.message_id, message.message_id)
+        self.assertEqual(self.message.content_blocks[0].content, message.content_blocks[0].content)
+
+    def test_deflate(self):
+        request = self._make_request(zlib.compress(self.message.to_xml()), 'deflate')
+        message = request_utils.get_message_from_etree(request_utils.get_request_etree(request), VID_TAXII_XML_11)
+        self.assertEqual(self.message.message_id, message.message_id)
+
+    def test_size_cap(self):
+        request = self._make_request(self._gzip(self.message.to_xml()), 'gzip')
+        with self.settings(TAXII_SERVICES_MAX_DECOMPRESSED_SIZE=1000):
+            with self.assertRaises(StatusMessageException) as cm:
+                request_utils.get_request_etree(request)
+        self.assertEqual(ST_BAD_MESSAGE, cm.exception.status_type)
+        self.assertEqual(request_utils.DECOMPRESSED_SIZE_ERR % 1000, cm.exception.message)
+
+        # The parser is usable again afterwards
+        dr = tm11.DiscoveryRequest(tm11.generate_message_id())
+        self.assertIsNotNone(request_utils.get_request_etree(self._make_request(dr.to_xml(), 'identity')))
+
+    def test_corrupt_body(self):
+        request = self._make_request('not compressed', 'gzip')
+        self.assertRaises(StatusMessageException, request_utils.get_request_etree, request)
+
+    def test_unsupported_encoding(self):
+        request = self._make_request(self.message.to_xml(), 'br')
+        self.assertRaises(StatusMessageException, request_utils.get_request_etree, request)